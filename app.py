@@ -1,14 +1,15 @@
 # app.py
 # -*- coding: utf-8 -*-
-import io, os, json, zipfile, datetime
-from flask import Flask, request, send_file, redirect, url_for, render_template_string, flash
+import io, os, re, gzip, json, time, zipfile, datetime, copy, hashlib, collections, itertools, contextlib, sqlite3
+import atexit, bisect, fcntl, functools, gc, mmap, queue, shutil, signal, struct, subprocess, tempfile, threading, uuid, zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from xml.sax.saxutils import escape as xml_escape
+from flask import Flask, Response, request, send_file, redirect, url_for, render_template, flash, jsonify, g, session
+from markupsafe import Markup
 from werkzeug.utils import safe_join
 
-from docx import Document
-from docx.shared import Pt, Cm
-from docx.oxml import OxmlElement
-from docx.oxml.ns import qn
-from docx.enum.table import WD_ROW_HEIGHT_RULE
+import print as printing  # 仓库里的 print.py（CUPS 打印机发现/打印）
 
 app = Flask(__name__)
 app.secret_key = "change-me"
@@ -27,6 +28,16 @@ FIXED_TITLES = [
 ]
 
 # ---------------- 工具函数 ----------------
+# 惰性单例（进程池、LibreOffice 槽位、教案存储）的创建锁：gthread worker 的多个请求线程
+# 和后台任务线程可能同时第一次用到，只能建一份。fork 出的子进程换一把新锁。
+_init_lock = threading.Lock()
+
+def _reset_init_lock():
+    global _init_lock
+    _init_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_init_lock)
+
 def human_size(n: int) -> str:
     if n < 1024: return f"{n} B"
     if n < 1024**2: return f"{n/1024:.1f} KB"
@@ -45,38 +56,273 @@ def lib_path(name: str) -> str:
         return None
     return p
 
-def next_conflict_name(orig_name: str) -> str:
+def lesson_name(name: str):
+    """库内教案名：jsons/ 顶层的 .json 文件名（不含目录）；不合法返回 None。"""
+    if not name or os.path.basename(name) != name or not lib_path(name):
+        return None
+    return name
+
+def not_modified(etag: str, last_modified: datetime.datetime):
+    """条件请求命中时返回 304 响应，否则 None（有 If-None-Match 时只看它）。"""
+    if request.if_none_match:
+        hit = request.if_none_match.contains(etag)
+    elif request.if_modified_since:
+        hit = last_modified.replace(microsecond=0) <= request.if_modified_since
+    else:
+        hit = False
+    if not hit:
+        return None
+    return with_validators(Response(status=304), etag, last_modified)
+
+def with_validators(response, etag: str, last_modified=None):
+    """last_modified 为 None 时不发 Last-Modified（首页列表没有单一的修改时间，只靠 ETag）。"""
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True  # 可以缓存，但每次都要回源校验
+    return response
+
+_CONFLICT_SUFFIX_RE = re.compile(r"（(\d+)）$")
+
+def split_conflict_name(name: str):
+    """'课时（3）.json' -> ('课时', 3, '.json')；无后缀时 n 为 0。"""
+    base, ext = os.path.splitext(name)
+    if ext.lower() != ".json":
+        ext = ".json"
+    m = _CONFLICT_SUFFIX_RE.search(base)
+    if m:
+        return base[:m.start()], int(m.group(1)), ext
+    return base, 0, ext
+
+def next_conflict_name(orig_name: str, conn=None) -> str:
     """
     名称冲突自动改为 '（n）'（中文全角括号）版。
     例如: 课时.json -> 课时（1）.json -> 课时（2）.json
+    n 取库索引 name_suffix 里该基名已用到的最大值 + 1，不再逐个探测文件是否存在。
     """
-    base, ext = os.path.splitext(orig_name)
-    if ext.lower() != ".json":
-        ext = ".json"
-    # 去掉末尾已存在的（n）
-    import re
-    m = re.search(r"（(\d+)）$", base)
-    if m:
-        base = re.sub(r"（\d+）$", "", base)
-    n = 1
-    while True:
-        candidate = f"{base}（{n}）{ext}"
-        if not os.path.exists(os.path.join(LIB_DIR, candidate)):
-            return candidate
+    base, _, ext = split_conflict_name(orig_name)
+    if conn is None:
+        with index_db() as conn:
+            return next_conflict_name(orig_name, conn)
+    row = conn.execute("SELECT max_n FROM name_suffix WHERE base=?", (base,)).fetchone()
+    n = (row[0] if row else 0) + 1
+    while lesson_store().stat(f"{base}（{n}）{ext}") is not None:  # 索引落后于库时兜底
         n += 1
+    return f"{base}（{n}）{ext}"
+
+# ---------------- 指标（Prometheus 文本格式） ----------------
+# 各阶段耗时（直方图）与请求/字节/文档数（计数器）先记在本进程内存里，
+# 后台线程每 METRICS_FLUSH_SECONDS 秒写到 METRICS_DIR/<组>.<pid>.json；/metrics 汇总所有进程的文件，
+# 这样 gunicorn 各 worker 及其导出进程池的数据都能看到。组是 gunicorn worker 的 pid，它的导出进程池子进程沿用：
+# worker 退出时 gunicorn.conf.py 的 child_exit 按组删掉它们的文件，master 启动时（on_starting）清空整个目录，
+# 已退出进程的旧数不会一直算在里面，pid 被复用时新进程也不会接着旧文件计数。
+# METRICS=0 时 span/observe/inc 都是空操作，计时包装与请求钩子也不会安装。
+METRICS_ENABLED = os.environ.get("METRICS", "1") != "0"
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(BASE_DIR, ".cache", "metrics"))
+METRICS_FLUSH_SECONDS = 1.0
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRIC_HELP = {
+    "lesson_stage_seconds": ("histogram", "各处理阶段耗时"),
+    "lesson_http_request_seconds": ("histogram", "路由耗时（含流式响应的发送）"),
+    "lesson_http_requests_total": ("counter", "请求数"),
+    "lesson_http_response_bytes_total": ("counter", "响应字节数"),
+    "lesson_documents_rendered_total": ("counter", "实际渲染的 DOCX 数（不含缓存命中）"),
+    "lesson_docx_cache_total": ("counter", "DOCX 渲染缓存查询数"),
+    "lesson_parse_cache_total": ("counter", "教案解析缓存查询数"),
+    "lesson_pdf_total": ("counter", "DOCX→PDF 转换数（按结果：cached/ok/timeout/error）"),
+    "lesson_admission_rejected_total": ("counter", "准入控制拒绝的请求数（503；full：队列已满，timeout：排队超时）"),
+    "lesson_admission_wait_seconds": ("histogram", "排队请求等到槽位的时间"),
+}
+
+_metrics_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [各桶计数..., +Inf 计数, sum]
+_metrics_dirty = False
+_flusher_started = False
+_flush_lock = threading.Lock()  # 后台刷写线程和 /metrics 可能同时刷，先后写出的快照不能颠倒
+_metrics_group = os.getpid()
+
+def _labels(kw) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in kw.items()))
+
+def _inc(name, value=1, **labels):
+    global _metrics_dirty
+    key = (name, _labels(labels))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+        _metrics_dirty = True
+    _start_flusher()
+
+def _observe(name, seconds, **labels):
+    global _metrics_dirty
+    key = (name, _labels(labels))
+    i = bisect.bisect_left(METRIC_BUCKETS, seconds)
+    with _metrics_lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(METRIC_BUCKETS) + 2)
+        h[i] += 1
+        h[-1] += seconds
+        _metrics_dirty = True
+    _start_flusher()
+
+class _Span:
+    __slots__ = ("stage", "t0")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _observe("lesson_stage_seconds", time.perf_counter() - self.t0, stage=self.stage)
+
+_NULL_SPAN = contextlib.nullcontext()
+
+def _noop(*args, **kwargs):
+    pass
+
+if METRICS_ENABLED:
+    inc, observe, span = _inc, _observe, _Span
+else:
+    inc, observe, span = _noop, _noop, (lambda stage: _NULL_SPAN)
+
+def timed(stage):
+    """函数计时装饰器（只在启用指标时套用）。"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _Span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def metrics_flush():
+    global _metrics_dirty
+    with _flush_lock:
+        with _metrics_lock:
+            if not _metrics_dirty:
+                return
+            snapshot = {
+                "counters": [[n, list(l), v] for (n, l), v in _counters.items()],
+                "histograms": [[n, list(l), h] for (n, l), h in _histograms.items()],
+            }
+            _metrics_dirty = False
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{_metrics_group}.{os.getpid()}.json")
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, path)
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        try:
+            metrics_flush()
+        except OSError:
+            pass
+
+def _start_flusher():
+    global _flusher_started
+    if not _flusher_started:
+        _flusher_started = True
+        threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+def _reset_metrics_after_fork():
+    """子进程不继承父进程已记的数（否则会重复计），也要自己起刷写线程。"""
+    global _metrics_lock, _flush_lock, _metrics_dirty, _flusher_started, _metrics_group
+    _metrics_lock, _flush_lock = threading.Lock(), threading.Lock()
+    _counters.clear(); _histograms.clear()
+    _metrics_dirty = _flusher_started = False
+    _metrics_group = os.getpid()
+
+def metrics_join_group(group: int):
+    """进程池子进程的 initializer：快照文件归到创建进程池的 worker 名下。"""
+    global _metrics_group
+    _metrics_group = group
+
+def metrics_forget(group: int):
+    """删掉一个 worker 及其进程池子进程的快照（gunicorn child_exit 里调用）。"""
+    for name in os.listdir(METRICS_DIR) if os.path.isdir(METRICS_DIR) else []:
+        if name.startswith(f"{group}."):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(METRICS_DIR, name))
+
+def metrics_reset():
+    """清空 METRICS_DIR（gunicorn master 启动时调用，上次运行留下的快照都作废）。"""
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+
+if METRICS_ENABLED:
+    os.register_at_fork(after_in_child=_reset_metrics_after_fork)
+    atexit.register(metrics_flush)
+
+def render_metrics() -> str:
+    """汇总 METRICS_DIR 下所有进程的快照，输出 Prometheus 文本格式。"""
+    counters, hists = {}, {}
+    for name in sorted(os.listdir(METRICS_DIR)) if os.path.isdir(METRICS_DIR) else []:
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name), "r", encoding="utf-8") as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for n, l, v in snap["counters"]:
+            key = (n, tuple(map(tuple, l)))
+            counters[key] = counters.get(key, 0) + v
+        for n, l, h in snap["histograms"]:
+            key = (n, tuple(map(tuple, l)))
+            acc = hists.setdefault(key, [0] * len(h))
+            for i, v in enumerate(h):
+                acc[i] += v
+
+    def fmt(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+    lines = []
+    for metric, (kind, help_text) in METRIC_HELP.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+        if kind == "counter":
+            for (n, labels), v in sorted(counters.items()):
+                if n == metric:
+                    lines.append(f"{metric}{fmt(labels)} {v}")
+            continue
+        for (n, labels), h in sorted(hists.items()):
+            if n != metric:
+                continue
+            cum = 0
+            for le, c in zip(METRIC_BUCKETS + ("+Inf",), h[:-1]):
+                cum += c
+                lines.append(f"{metric}_bucket{fmt(labels, [('le', le)])} {cum}")
+            lines.append(f"{metric}_sum{fmt(labels)} {h[-1]}")
+            lines.append(f"{metric}_count{fmt(labels)} {cum}")
+    return "\n".join(lines) + "\n"
 
 # ---------------- DOCX 生成（最终版式） ----------------
-def enforce_fonts(cell, bold=False):
-    for p in cell.paragraphs:
-        for r in p.runs:
-            r.font.size = Pt(10)
-            if bold:
-                r.font.bold = True
-            rPr = r._element.get_or_add_rPr()
-            rFonts = rPr.get_or_add_rFonts()
-            rFonts.set(qn('w:ascii'), 'Times New Roman')
-            rFonts.set(qn('w:hAnsi'), 'Times New Roman')
-            rFonts.set(qn('w:eastAsia'), 'SimSun')
+# python-docx / lxml 按需导入（约 100ms）：只看首页、检索、编辑的 worker 不必加载整套文档栈。
+# 所有文档操作都先经过 lesson_skeleton()，由它在首次构建骨架时调用 load_docx_stack() 填入这些全局名。
+Document = Pt = Cm = OxmlElement = qn = WD_ROW_HEIGHT_RULE = WD_STYLE_TYPE = _Cell = etree = None
+_docx_loaded = False
+
+def load_docx_stack():
+    global Document, Pt, Cm, OxmlElement, qn, WD_ROW_HEIGHT_RULE, WD_STYLE_TYPE, _Cell, etree, _docx_loaded
+    if _docx_loaded:
+        return
+    from lxml import etree
+    from docx import Document
+    from docx.shared import Pt, Cm
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+    from docx.enum.table import WD_ROW_HEIGHT_RULE
+    from docx.enum.style import WD_STYLE_TYPE
+    from docx.table import _Cell
+    _docx_loaded = True
 
 def align_cell(cell, horiz=None, vert=None):
     if horiz == "center":
@@ -124,7 +370,24 @@ def coerce_to_fixed_flow(data):
         fixed.append({FIXED_TITLES[i]: acts})
     return fixed
 
-def json_to_docx_bytes(data: dict, docx_name_hint="lesson_plan") -> bytes:
+# ---------------- DOCX 骨架模板（每个 worker 只构建一次） ----------------
+# 版式里固定不变的部分（页面、顶部四项、流程标题、表头、板书/反思、边框、字体）
+# 只构建一次并存成 bytes；每次渲染从 bytes 克隆，再只填可变单元格。
+# 字体不再逐 run 写 rPr/rFonts，而是放在表格样式 LESSON_TABLE_STYLE 上。
+TOP_KEYS = ["教学课题", "教学目标", "教学重点与难点", "教学准备"]
+LESSON_TABLE_STYLE = "Lesson Table"
+BORDER_SINGLE = {'val':'single','sz':'8','space':'0','color':'000000'}
+BORDER_NIL = {'val':'nil'}
+
+# 骨架表格的行号
+BANNER_ROW_IDX = len(TOP_KEYS)          # 教 · 学 · 流 · 程
+FLOW_HEADER_ROW_IDX = BANNER_ROW_IDX + 1  # 教师活动/学生活动/二次备课
+BOARD_ROW_IDX = FLOW_HEADER_ROW_IDX + 1   # 板书设计（流程行插在它前面）
+
+_skeleton = None  # (skeleton_bytes, {"first"/"middle"/"last": 流程行原型 <w:tr>})
+
+def build_lesson_skeleton():
+    load_docx_stack()
     doc = Document()
 
     sec = doc.sections[0]
@@ -135,98 +398,1938 @@ def json_to_docx_bytes(data: dict, docx_name_hint="lesson_plan") -> bytes:
     sec.left_margin = Cm(1.91)  # 左 1.91cm
     sec.right_margin = Cm(1.91)  # 右 1.91cm
 
+    # 表格样式：Times New Roman / 宋体 10pt
+    style = doc.styles.add_style(LESSON_TABLE_STYLE, WD_STYLE_TYPE.TABLE)
+    style.base_style = doc.styles["Table Grid"]
+    style.font.name = "Times New Roman"
+    style.font.size = Pt(10)
+    style.element.get_or_add_rPr().get_or_add_rFonts().set(qn('w:eastAsia'), 'SimSun')
 
-    table = doc.add_table(rows=0, cols=3, style="Table Grid")
+    table = doc.add_table(rows=0, cols=3, style=LESSON_TABLE_STYLE)
     table.autofit = True
 
-    # 顶部四项
-    for key in ["教学课题", "教学目标", "教学重点与难点", "教学准备"]:
+    # 顶部四项（内容格留空）
+    for key in TOP_KEYS:
         row_cells = table.add_row().cells
-        row_cells[0].text = key
+        row_cells[0].paragraphs[0].add_run(key).bold = True
+        align_cell(row_cells[0], "center", "center")
         merged = row_cells[1].merge(row_cells[2])
-        merged.text = str(data.get(key, "") or "")
-        enforce_fonts(row_cells[0], bold=True); align_cell(row_cells[0], "center", "center")
-        enforce_fonts(merged, bold=(key=="教学课题")); align_cell(merged, None, "center")
+        align_cell(merged, None, "center")
 
     # 教学流程标题
     row_cells = table.add_row().cells
-    row_cells[0].merge(row_cells[2]).text = "教 · 学 · 流 · 程"
-    enforce_fonts(row_cells[0], bold=True); align_cell(row_cells[0], "center", "center")
+    banner = row_cells[0].merge(row_cells[2])
+    banner.paragraphs[0].add_run("教 · 学 · 流 · 程").bold = True
+    align_cell(banner, "center", "center")
 
     # 表头
     row_cells = table.add_row().cells
-    row_cells[0].text = "教师活动"; row_cells[1].text = "学生活动"; row_cells[2].text = "二次备课"
-    for c in row_cells: enforce_fonts(c, True); align_cell(c, "center", "center")
-    flow_header_row_idx = len(table.rows)-1
+    for c, text in zip(row_cells, ["教师活动", "学生活动", "二次备课"]):
+        c.paragraphs[0].add_run(text).bold = True
+        align_cell(c, "center", "center")
 
-    # 教学流程（固定 5 节）
-    flow = coerce_to_fixed_flow(data)
-    flow_first_content_idx = None
-    for idx, block in enumerate(flow):
-        title = FIXED_TITLES[idx]
-        acts = block.get(title, [])
-        row_cells = table.add_row().cells
-        p = row_cells[0].paragraphs[0]
-        for r in list(p.runs): r.text = ""
-        rt = p.add_run(title); rt.bold = True
-        p.add_run("\n")
-        if acts:
-            p.add_run(f"1. {acts[0].get('tea','')}")
-            row_cells[1].text = "\n1. " + str(acts[0].get('stu','') or "")
-        else:
-            row_cells[1].text = ""
-        row_cells[2].text = ""
-        enforce_fonts(row_cells[0]); enforce_fonts(row_cells[1]); enforce_fonts(row_cells[2])
-
-        if flow_first_content_idx is None:
-            flow_first_content_idx = len(table.rows)-1
-
-        for j, step in enumerate(acts[1:], start=2):
-            row_cells = table.add_row().cells
-            row_cells[0].text = f"{j}. {step.get('tea','')}"
-            row_cells[1].text = f"{j}. {step.get('stu','')}"
-            row_cells[2].text = ""
-            enforce_fonts(row_cells[0]); enforce_fonts(row_cells[1]); enforce_fonts(row_cells[2])
-
-    last_flow_row_idx = len(table.rows)-1
+    # 流程行原型：首行保留上框线，末行保留下框线，其余上下都去掉
+    protos = {}
+    for kind, edges in (("first", {'bottom': BORDER_NIL}),
+                        ("middle", {'top': BORDER_NIL, 'bottom': BORDER_NIL}),
+                        ("last", {'top': BORDER_NIL})):
+        row = table.add_row()
+        for c in row.cells:
+            set_cell_border(c, left=BORDER_SINGLE, right=BORDER_SINGLE)
+            set_cell_border(c, **edges)
+        protos[kind] = row._tr
 
     # 板书设计
     row_cells = table.add_row().cells
-    row_cells[0].text = "板书设计"
-    merged = row_cells[1].merge(row_cells[2])
-    merged.text = str(data.get("板书设计","") or "")
-    enforce_fonts(row_cells[0], True); align_cell(row_cells[0], "center", "center")
-    enforce_fonts(merged, False)
+    row_cells[0].paragraphs[0].add_run("板书设计").bold = True
+    align_cell(row_cells[0], "center", "center")
+    row_cells[1].merge(row_cells[2])
 
     # 教学反思（固定空白 3cm）
     row_cells = table.add_row().cells
-    row_cells[0].text = "教学反思"
-    merged = row_cells[1].merge(row_cells[2]); merged.text = ""
-    enforce_fonts(row_cells[0], True); align_cell(row_cells[0], "center", "center")
+    row_cells[0].paragraphs[0].add_run("教学反思").bold = True
+    align_cell(row_cells[0], "center", "center")
+    row_cells[1].merge(row_cells[2])
     table.rows[-1].height = Cm(3); table.rows[-1].height_rule = WD_ROW_HEIGHT_RULE.EXACTLY
 
+    # 原型行从骨架中摘出，渲染时按活动数深拷贝
+    for tr in protos.values():
+        tr.getparent().remove(tr)
+
     # 边框：仅去掉流程内部横线；竖线/外框保留
-    row_count = len(table.rows)
-    for r in range(row_count):
-        for cell in table.rows[r].cells:
-            set_cell_border(cell,
-                left={'val':'single','sz':'8','space':'0','color':'000000'},
-                right={'val':'single','sz':'8','space':'0','color':'000000'})
-    for c in table.rows[flow_header_row_idx].cells:
-        set_cell_border(c, bottom={'val':'nil'})
-    if flow_first_content_idx is not None and flow_first_content_idx <= last_flow_row_idx:
-        for r in range(flow_first_content_idx, last_flow_row_idx):
-            for c in table.rows[r].cells: set_cell_border(c, bottom={'val':'nil'})
-            for c in table.rows[r+1].cells: set_cell_border(c, top={'val':'nil'})
-    for c in table.rows[0].cells: set_cell_border(c, top={'val':'single','sz':'8','space':'0','color':'000000'})
-    for c in table.rows[-1].cells: set_cell_border(c, bottom={'val':'single','sz':'8','space':'0','color':'000000'})
+    for row in table.rows:
+        for cell in row.cells:
+            set_cell_border(cell, left=BORDER_SINGLE, right=BORDER_SINGLE)
+    for c in table.rows[FLOW_HEADER_ROW_IDX].cells:
+        set_cell_border(c, bottom=BORDER_NIL)
+    for c in table.rows[0].cells: set_cell_border(c, top=BORDER_SINGLE)
+    for c in table.rows[-1].cells: set_cell_border(c, bottom=BORDER_SINGLE)
     table.alignment = 1
 
+    bio = io.BytesIO()
+    doc.save(bio)
+    return bio.getvalue(), protos
+
+def lesson_skeleton():
+    """返回 (骨架 bytes, 流程行原型)，每个进程首次调用时构建。"""
+    global _skeleton
+    if _skeleton is None:
+        _skeleton = build_lesson_skeleton()
+    return _skeleton
+
+def fill_cell(cell, *parts):
+    """往（骨架里的空）单元格首段追加 run；parts 为 text 或 (text, bold)。"""
+    p = cell.paragraphs[0]
+    for part in parts:
+        text, bold = part if isinstance(part, tuple) else (part, False)
+        run = p.add_run(text)
+        if bold:
+            run.bold = True
+
+def new_lesson_document():
+    """从骨架克隆一份待填写的文档。"""
+    skeleton_bytes, _ = lesson_skeleton()
+    return Document(io.BytesIO(skeleton_bytes))
+
+def fill_lesson_table(doc, data: dict):
+    """填写骨架表格的可变单元格，并按活动数插入流程行（边框已在原型行上）。"""
+    _, protos = lesson_skeleton()
+    table = doc.tables[0]
+    trs = table._tbl.tr_lst
+
+    # 顶部四项
+    for i, key in enumerate(TOP_KEYS):
+        fill_cell(_Cell(trs[i].tc_lst[1], table), (str(data.get(key, "") or ""), key == "教学课题"))
+
+    # 教学流程（固定 5 节）：先排好每行三格的内容，再按位置套用原型行
+    flow = coerce_to_fixed_flow(data)
+    flow_rows = []
+    for idx, block in enumerate(flow):
+        title = FIXED_TITLES[idx]
+        acts = block.get(title, [])
+        if acts:
+            flow_rows.append(([(title, True), "\n", f"1. {acts[0].get('tea','')}"],
+                              ["\n1. " + str(acts[0].get('stu','') or "")]))
+        else:
+            flow_rows.append(([(title, True), "\n"], []))
+        for j, step in enumerate(acts[1:], start=2):
+            flow_rows.append(([f"{j}. {step.get('tea','')}"], [f"{j}. {step.get('stu','')}"]))
+
+    board_tr = trs[BOARD_ROW_IDX]
+    last = len(flow_rows) - 1
+    for r, (tea_parts, stu_parts) in enumerate(flow_rows):
+        kind = "first" if r == 0 else ("last" if r == last else "middle")
+        tr = copy.deepcopy(protos[kind])
+        board_tr.addprevious(tr)
+        tcs = tr.tc_lst
+        fill_cell(_Cell(tcs[0], table), *tea_parts)
+        fill_cell(_Cell(tcs[1], table), *stu_parts)
+
+    # 板书设计
+    fill_cell(_Cell(board_tr.tc_lst[1], table), str(data.get("板书设计","") or ""))
+
+def save_docx(doc) -> bytes:
     bio = io.BytesIO()
     doc.save(bio); bio.seek(0)
     return bio.read()
 
+def json_to_docx_bytes(data: dict, docx_name_hint="lesson_plan") -> bytes:
+    doc = new_lesson_document()
+    fill_lesson_table(doc, data)
+    return save_docx(doc)
+
+# ---------------- DOCX 直写引擎（OOXML，批量导出用） ----------------
+# 不经过 Document/Cell 对象：把骨架的 document.xml 预先切成字符串片段，
+# 渲染时只拼接可变单元格的 run XML，再连同骨架里其余部件写成 zip。
+# 用环境变量 DOCX_ENGINE 选择引擎：python-docx（默认）/ ooxml。
+DOCX_ENGINE = os.environ.get("DOCX_ENGINE", "python-docx")
+
+_SLOT_PI = "<?slot ?>"
+_FLOW_PI = "<?flow ?>"
+_PROTO_PI = "<?proto ?>"
+_TABLE_PI = "<?table ?>"
+_XML_INVALID_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+_RUN_SPLIT_RE = re.compile(r"([\t\r\n])")
+
+_ooxml_template = None  # (其余部件 [(name, bytes)], {"prologue"/"epilogue": 表格前后, "head"/"tail"/kind: 片段列表})
+
+def build_ooxml_template():
+    skeleton_bytes, protos = lesson_skeleton()
+    with zipfile.ZipFile(io.BytesIO(skeleton_bytes)) as zf:
+        parts = [(n, zf.read(n)) for n in zf.namelist()]
+    doc_xml = dict(parts)["word/document.xml"]
+    root = etree.fromstring(doc_xml)
+    tbl = root.find(qn('w:body')).find(qn('w:tbl'))
+    tbl.addprevious(etree.ProcessingInstruction("table"))
+    tbl.addnext(etree.ProcessingInstruction("table"))
+    trs = tbl.findall(qn('w:tr'))
+
+    def mark(tc):
+        tc.find(qn('w:p')).append(etree.ProcessingInstruction("slot"))
+
+    for i in range(len(TOP_KEYS)):
+        mark(trs[i].findall(qn('w:tc'))[1])
+    mark(trs[BOARD_ROW_IDX].findall(qn('w:tc'))[1])
+
+    # 三种流程行原型也放进同一棵树里序列化，命名空间前缀与正文一致
+    board_tr = trs[BOARD_ROW_IDX]
+    board_tr.addprevious(etree.ProcessingInstruction("flow"))
+    for kind in ("first", "middle", "last"):
+        tr = copy.deepcopy(protos[kind])
+        tcs = tr.findall(qn('w:tc'))
+        mark(tcs[0]); mark(tcs[1])
+        board_tr.addprevious(etree.ProcessingInstruction("proto"))
+        board_tr.addprevious(tr)
+    board_tr.addprevious(etree.ProcessingInstruction("flow"))
+
+    xml = etree.tostring(root, encoding="UTF-8", standalone=True).decode("utf-8")
+    prologue, table_xml, epilogue = xml.split(_TABLE_PI)
+    head, proto_blob, tail = table_xml.split(_FLOW_PI)
+    frags = {"prologue": prologue, "epilogue": epilogue, "head": head.split(_SLOT_PI), "tail": tail.split(_SLOT_PI)}
+    for kind, blob in zip(("first", "middle", "last"), proto_blob.split(_PROTO_PI)[1:]):
+        frags[kind] = blob.split(_SLOT_PI)
+    return [(n, b) for n, b in parts if n != "word/document.xml"], frags
+
+def ooxml_template():
+    global _ooxml_template
+    if _ooxml_template is None:
+        _ooxml_template = build_ooxml_template()
+    return _ooxml_template
+
+def run_xml(text: str, bold=False) -> str:
+    """与 python-docx 的 Run.text 等价：\\t → <w:tab/>，\\r/\\n → <w:br/>。"""
+    if _XML_INVALID_RE.search(text):
+        raise ValueError("All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters")
+    out = ["<w:r><w:rPr><w:b/></w:rPr>" if bold else "<w:r>"]
+    for piece in _RUN_SPLIT_RE.split(text):
+        if not piece:
+            continue
+        if piece == "\t":
+            out.append("<w:tab/>")
+        elif piece in "\r\n":
+            out.append("<w:br/>")
+        elif len(piece.strip()) < len(piece):
+            out.append(f'<w:t xml:space="preserve">{xml_escape(piece)}</w:t>')
+        else:
+            out.append(f"<w:t>{xml_escape(piece)}</w:t>")
+    out.append("</w:r>")
+    return "".join(out)
+
+def lesson_table_xml(data: dict) -> str:
+    """一份教案的 <w:tbl>（不含文档头尾和 sectPr）。"""
+    _, frags = ooxml_template()
+
+    head = frags["head"]
+    out = [head[0]]
+    for i, key in enumerate(TOP_KEYS):
+        text = str(data.get(key, "") or "")
+        if text:
+            out.append(run_xml(text, bold=(key == "教学课题")))
+        out.append(head[i + 1])
+
+    flow = coerce_to_fixed_flow(data)
+    flow_rows = []
+    for idx, block in enumerate(flow):
+        title = FIXED_TITLES[idx]
+        acts = block.get(title, [])
+        tea = run_xml(title, bold=True) + run_xml("\n")
+        if acts:
+            tea += run_xml(f"1. {acts[0].get('tea','')}")
+            stu = run_xml("\n1. " + str(acts[0].get('stu','') or ""))
+        else:
+            stu = ""
+        flow_rows.append((tea, stu))
+        for j, step in enumerate(acts[1:], start=2):
+            flow_rows.append((run_xml(f"{j}. {step.get('tea','')}"), run_xml(f"{j}. {step.get('stu','')}")))
+
+    last = len(flow_rows) - 1
+    for r, (tea, stu) in enumerate(flow_rows):
+        f0, f1, f2 = frags["first" if r == 0 else ("last" if r == last else "middle")]
+        out += [f0, tea, f1, stu, f2]
+
+    tail = frags["tail"]
+    board = str(data.get("板书设计","") or "")
+    out += [tail[0], run_xml(board) if board else "", tail[1]]
+    return "".join(out)
+
+def write_ooxml_package(body_parts) -> bytes:
+    """document.xml 为 文档头 + body_parts + sectPr/文档尾，其余部件取自骨架；body_parts 可以是生成器，边产出边压缩。"""
+    parts, frags = ooxml_template()
+    bio = io.BytesIO()
+    with zipfile.ZipFile(bio, "w", zipfile.ZIP_DEFLATED) as zf:
+        with zf.open("word/document.xml", "w") as f:
+            f.write(frags["prologue"].encode("utf-8"))
+            for xml in body_parts:
+                f.write(xml.encode("utf-8"))
+            f.write(frags["epilogue"].encode("utf-8"))
+        for name, blob in parts:
+            zf.writestr(name, blob)
+    return bio.getvalue()
+
+def json_to_ooxml_bytes(data: dict, docx_name_hint="lesson_plan") -> bytes:
+    """与 json_to_docx_bytes 版式一致，直接拼 document.xml。"""
+    return write_ooxml_package([lesson_table_xml(data)])
+
+def render_docx(data: dict, docx_name_hint="lesson_plan") -> bytes:
+    """按 DOCX_ENGINE 选择渲染引擎。"""
+    inc("lesson_documents_rendered_total", engine=DOCX_ENGINE)
+    if DOCX_ENGINE == "ooxml":
+        return json_to_ooxml_bytes(data, docx_name_hint=docx_name_hint)
+    return json_to_docx_bytes(data, docx_name_hint=docx_name_hint)
+
+# ---------------- DOCX 渲染缓存（磁盘，内容寻址 + LRU） ----------------
+# 键 = sha256(版式版本 + 规范化后的教案 JSON)；各路由、各 gunicorn worker 共用同一目录。
+# 命中时刷新 mtime，超出容量时按 mtime 从旧到新淘汰。DOCX_CACHE_MAX_BYTES=0 关闭缓存。
+# 目录总量记在目录里的 .size 文件（flock 下累加，所有 worker 与导出进程池子进程共用）；
+# 每次写入只加这个数，超过容量才扫目录、淘汰并写回实际总量，未满时写入不再 stat 整个目录。
+LAYOUT_VERSION = "1"  # 版式有任何变化都要加一，旧缓存自然失效
+DOCX_CACHE_DIR = os.environ.get("DOCX_CACHE_DIR", os.path.join(BASE_DIR, ".cache", "docx"))
+DOCX_CACHE_MAX_BYTES = int(os.environ.get("DOCX_CACHE_MAX_BYTES", str(512 * 1024**2)))
+
+def normalize_lesson(data: dict) -> dict:
+    """只保留影响版式的字段，并统一成渲染时实际使用的形态。"""
+    out = {key: str(data.get(key, "") or "") for key in TOP_KEYS + ["板书设计"]}
+    out["教学流程"] = coerce_to_fixed_flow(data)
+    return out
+
+def lesson_hash(data: dict) -> str:
+    """规范化教案的哈希（与版式版本无关，可存进库索引）。"""
+    payload = json.dumps(normalize_lesson(data), ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def docx_key(lesson_digest: str) -> str:
+    """DOCX 的内容键 = 版式版本 + 规范化教案哈希；同时用作渲染缓存键与 DOCX 的 ETag。"""
+    return hashlib.sha256(f"{LAYOUT_VERSION}\n{lesson_digest}".encode("utf-8")).hexdigest()
+
+def lesson_cache_key(data: dict) -> str:
+    return docx_key(lesson_hash(data))
+
+def evict_cache(folder: str, suffix: str, max_bytes: int) -> int:
+    """目录里 *suffix 文件总量超过 max_bytes 时按 mtime 从旧到新删；返回剩下的总量。"""
+    entries, total = [], 0
+    try:
+        with os.scandir(folder) as it:
+            for e in it:
+                if not e.name.endswith(suffix):
+                    continue
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+    except FileNotFoundError:
+        return 0
+    if total <= max_bytes:
+        return total
+    entries.sort()
+    for _, size, p in entries:
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass  # 其他 worker 已删
+        total -= size
+        if total <= max_bytes:
+            break
+    return total
+
+CACHE_SIZE_FILE = ".size"
+
+def cache_account(folder: str, suffix: str, added: int, max_bytes: int):
+    """新写入 added 字节后更新目录的总量计数；计数超过 max_bytes（或还没有计数）时才扫目录淘汰。
+    同一个键被两个进程同时写会多计一次，只会让下次扫描提前，扫描后计数回到实际值。"""
+    fd = os.open(os.path.join(folder, CACHE_SIZE_FILE), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            total = int(os.pread(fd, 32, 0)) + added
+        except ValueError:
+            total = None  # 新目录或计数损坏：扫一次
+        if total is None or total > max_bytes:
+            total = evict_cache(folder, suffix, max_bytes)
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, str(total).encode("ascii"), 0)
+    finally:
+        os.close(fd)
+
+def cache_read(path: str):
+    """命中返回 bytes 并刷新 mtime（LRU），否则 None。"""
+    try:
+        with open(path, "rb") as f:
+            blob = f.read()
+        os.utime(path)
+        return blob
+    except FileNotFoundError:
+        return None
+
+def cache_write(path: str, blob: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(blob)
+    os.replace(tmp, path)  # 原子替换，其他 worker 不会读到半个文件
+
+def docx_cache_get(key: str):
+    """命中返回 bytes，否则 None。"""
+    if DOCX_CACHE_MAX_BYTES <= 0:
+        return None
+    blob = cache_read(os.path.join(DOCX_CACHE_DIR, key + ".docx"))
+    inc("lesson_docx_cache_total", result="miss" if blob is None else "hit")
+    return blob
+
+def render_docx_cached(data: dict, docx_name_hint="lesson_plan") -> bytes:
+    if DOCX_CACHE_MAX_BYTES <= 0:
+        return render_docx(data, docx_name_hint=docx_name_hint)
+    key = lesson_cache_key(data)
+    blob = docx_cache_get(key)
+    if blob is not None:
+        return blob
+
+    blob = render_docx(data, docx_name_hint=docx_name_hint)
+    cache_write(os.path.join(DOCX_CACHE_DIR, key + ".docx"), blob)
+    cache_account(DOCX_CACHE_DIR, ".docx", len(blob), DOCX_CACHE_MAX_BYTES)
+    return blob
+
+# ---------------- 教案存储（目录 / 打包文件，两种后端） ----------------
+# 所有路由都经 lesson_store() 按名字（jsons/ 里的文件名）读写教案，不直接碰路径。
+# LESSON_STORE=dir（默认）：LIB_DIR 下一个教案一个 .json 文件，布局与以前相同。
+# LESSON_STORE=pack：全部教案追加写进一个打包文件 LESSON_PACK，读经 mmap，省掉逐个文件的 open/stat，
+#   网络盘上也只有一个文件。每条记录 = 头（魔数、crc32、名字长度、内容长度、mtime_ns）+ 名字 + 内容，
+#   同名后写的覆盖先写的；偏移索引在内存里，首次打开顺序扫一遍，之后别的 worker 追加了只扫新增的尾巴。
+#   写入在 LESSON_PACK.lock 的 flock 下追加；写到一半崩溃留下的半截记录，下次写入前截掉。
+#   文件中间的坏记录（魔数/crc 不对）不截：扫描时跳到下一条完整记录继续，后面的教案都还在。
+#   被覆盖的旧记录超过一半（且超过 PACK_COMPACT_MIN_BYTES）时自动整理：按名字顺序重写活记录再原子替换，
+#   同一年级/单元的教案在文件里相邻，批量导出、建索引读到的是连续区间。也可手动 flask --app app compact-pack。
+#   打包文件不存在时，首次打开会把 LIB_DIR 里现有的教案导进去。
+LESSON_STORE = os.environ.get("LESSON_STORE", "dir")
+LESSON_PACK = os.environ.get("LESSON_PACK", os.path.join(BASE_DIR, "jsons.pack"))
+PACK_COMPACT_MIN_BYTES = int(os.environ.get("PACK_COMPACT_MIN_BYTES", str(16 * 1024**2)))
+
+LessonStat = collections.namedtuple("LessonStat", "size mtime_ns")
+
+class DirStore:
+    """默认后端：LIB_DIR 下一个教案一个 .json 文件。"""
+    kind = "dir"
+
+    def generation(self) -> str:
+        """库有增删改就会变的标记（目录 mtime；写入都是新建或 os.replace）。"""
+        return str(os.stat(LIB_DIR).st_mtime_ns)
+
+    def scan(self):
+        """产出 (name, LessonStat)，顺序不定。"""
+        with os.scandir(LIB_DIR) as it:
+            for e in it:
+                if e.name.lower().endswith(".json") and e.is_file():
+                    st = e.stat()
+                    yield e.name, LessonStat(st.st_size, st.st_mtime_ns)
+
+    def stat(self, name: str):
+        """不存在返回 None。"""
+        try:
+            st = os.stat(os.path.join(LIB_DIR, name))
+        except FileNotFoundError:
+            return None
+        return LessonStat(st.st_size, st.st_mtime_ns)
+
+    def read(self, name: str):
+        """返回 (LessonStat, bytes)；不存在抛 KeyError。"""
+        try:
+            with open(os.path.join(LIB_DIR, name), "rb") as f:
+                st = os.fstat(f.fileno())
+                return LessonStat(st.st_size, st.st_mtime_ns), f.read()
+        except FileNotFoundError:
+            raise KeyError(name) from None
+
+    def iter_read(self, names):
+        """批量读：产出 (name, LessonStat, bytes)，不存在的跳过；顺序由后端决定（要按勾选顺序请逐个 read）。"""
+        for name in names:
+            try:
+                st, raw = self.read(name)
+            except KeyError:
+                continue
+            yield name, st, raw
+
+    def write(self, name: str, raw: bytes, exclusive=False):
+        """覆盖写走临时文件 + os.replace，其他 worker 不会读到半个文件；exclusive 时同名已存在抛 FileExistsError。"""
+        path = os.path.join(LIB_DIR, name)
+        if exclusive:
+            with open(path, "xb") as f:
+                f.write(raw)
+            return
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(raw)
+        os.replace(tmp, path)
+
+    @contextlib.contextmanager
+    def lock(self):
+        """库目录上的排他 flock：跨 gunicorn worker 串行化“读-改-写”。"""
+        fd = os.open(LIB_DIR, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+_PACK_MAGIC = b"LESSONPACK1\n"
+_REC = struct.Struct("<4sIIIQ")  # 魔数, crc32(名字 + 内容), 名字长度, 内容长度, mtime_ns
+_REC_MAGIC = b"LREC"
+
+def pack_record(name: str, raw: bytes, mtime_ns: int) -> bytes:
+    nb = name.encode("utf-8")
+    return _REC.pack(_REC_MAGIC, zlib.crc32(raw, zlib.crc32(nb)), len(nb), len(raw), mtime_ns) + nb + raw
+
+class PackStore:
+    """追加写的打包文件 + 内存偏移索引，读经 mmap（接口同 DirStore）。"""
+    kind = "pack"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mu = threading.Lock()   # 保护下面几项；mmap 只换不关，读到一半的旧映射仍然有效
+        self._tls = threading.local()  # 本线程是否已持有 flock（lock() 可重入）
+        self._mm = None
+        self._ino = self._size = None
+        self._stamp = None  # 上次映射时文件的 (inode, 大小, mtime_ns)
+        self._index = {}   # name -> (内容偏移, LessonStat)
+        self._end = 0      # 已扫描的完整记录的末尾
+        self._garbage = 0  # 被覆盖的旧记录字节数
+        if not os.path.exists(path):
+            self._create()
+
+    def _after_fork(self):
+        """fork 时别的线程可能正持有 _mu / flock 标记：子进程换新的（由模块级钩子对当前单例调用）。"""
+        self._mu = threading.Lock()
+        self._tls = threading.local()
+
+    def _create(self):
+        """新建打包文件，并导入 LIB_DIR 里现有的教案（按名字排序）。"""
+        with self.lock():
+            if os.path.exists(self.path):  # 别的 worker 已经建好
+                return
+            src = DirStore()
+            names = sorted(name for name, _ in src.scan())
+            self._rewrite((name, st.mtime_ns, raw) for name, st, raw in src.iter_read(names))
+
+    def _rewrite(self, records):
+        """records: (name, mtime_ns, bytes)；写成新文件后原子替换（调用方持有 flock）。"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(_PACK_MAGIC)
+            for name, mtime_ns, raw in records:
+                f.write(pack_record(name, raw, mtime_ns))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def _refresh(self):
+        """（持有 _mu）文件被替换则从头重建索引，变长了则重新映射并只扫新增部分。"""
+        st = os.stat(self.path)
+        if (st.st_ino, st.st_size, st.st_mtime_ns) == self._stamp:
+            return
+        with open(self.path, "rb") as f:
+            st = os.fstat(f.fileno())
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if st.st_ino != self._ino:
+            if mm[:len(_PACK_MAGIC)] != _PACK_MAGIC:
+                raise RuntimeError(f"{self.path} 不是教案打包文件")
+            self._ino, self._index, self._end, self._garbage = st.st_ino, {}, len(_PACK_MAGIC), 0
+        self._mm, self._size = mm, st.st_size
+        self._scan()
+
+    @staticmethod
+    def _record_at(mm, pos):
+        """pos 处是完整且校验通过的记录时返回 (名字, 内容偏移, LessonStat, 记录末尾)，否则 None。"""
+        if pos + _REC.size > len(mm):
+            return None
+        magic, crc, nlen, dlen, mtime_ns = _REC.unpack_from(mm, pos)
+        start = pos + _REC.size + nlen
+        end = start + dlen
+        if magic != _REC_MAGIC or end > len(mm):
+            return None
+        nb = mm[pos + _REC.size:start]
+        if zlib.crc32(mm[start:end], zlib.crc32(nb)) != crc:
+            return None
+        try:
+            return nb.decode("utf-8"), start, LessonStat(dlen, mtime_ns), end
+        except UnicodeDecodeError:
+            return None
+
+    def _resync(self, mm, pos):
+        """从坏记录 pos 往后找下一条完整记录的开头；找不到返回 None（pos 之后只是半截的尾巴）。"""
+        nxt = mm.find(_REC_MAGIC, pos + 1)
+        while nxt != -1:
+            if self._record_at(mm, nxt):
+                return nxt
+            nxt = mm.find(_REC_MAGIC, nxt + 1)
+        return None
+
+    def _scan(self):
+        mm, pos = self._mm, self._end
+        while pos < len(mm):
+            rec = self._record_at(mm, pos)
+            if rec is None:
+                # 坏记录后面还有完整记录：是中间的损坏，跳过这段（记作垃圾，整理时丢掉）；
+                # 后面没有了：是正在写（或写到一半崩溃）的尾巴，停在它前面，只有它会在下次写入前被截掉
+                nxt = self._resync(mm, pos)
+                if nxt is None:
+                    break
+                app.logger.warning("%s 偏移 %d 处有 %d 字节损坏的记录，已跳过", self.path, pos, nxt - pos)
+                self._garbage += nxt - pos
+                pos = nxt
+                continue
+            name, start, st, end = rec
+            old = self._index.get(name)
+            if old:
+                self._garbage += start - pos + old[1].size
+            self._index[name] = (start, st)
+            pos = end
+        self._end = pos
+
+    def generation(self) -> str:
+        with self._mu:
+            self._refresh()
+            return f"{self._ino}:{self._end}"
+
+    def scan(self):
+        with self._mu:
+            self._refresh()
+            return [(name, st) for name, (_, st) in self._index.items()]
+
+    def stat(self, name: str):
+        with self._mu:
+            self._refresh()
+            hit = self._index.get(name)
+        return hit[1] if hit else None
+
+    def read(self, name: str):
+        with self._mu:
+            self._refresh()
+            hit, mm = self._index.get(name), self._mm
+        if hit is None:
+            raise KeyError(name)
+        off, st = hit
+        return st, mm[off:off + st.size]
+
+    def iter_read(self, names):
+        """按文件内偏移顺序产出，整批是一次顺序扫过打包文件。"""
+        with self._mu:
+            self._refresh()
+            mm = self._mm
+            hits = sorted((self._index[n][0], n, self._index[n][1]) for n in set(names) if n in self._index)
+        for off, name, st in hits:
+            yield name, st, mm[off:off + st.size]
+
+    def write(self, name: str, raw: bytes, exclusive=False):
+        with self.lock():
+            with self._mu:
+                self._refresh()
+                if exclusive and name in self._index:
+                    raise FileExistsError(name)
+                end, size = self._end, self._size
+            with open(self.path, "r+b") as f:
+                if size > end:
+                    app.logger.warning("截掉 %s 末尾 %d 字节的半截记录", self.path, size - end)
+                    f.truncate(end)
+                f.seek(end)
+                f.write(pack_record(name, raw, time.time_ns()))
+            with self._mu:
+                self._refresh()
+                garbage, end = self._garbage, self._end
+            if garbage > PACK_COMPACT_MIN_BYTES and garbage * 2 > end:
+                self.compact()
+
+    def compact(self) -> int:
+        """按名字顺序只保留每个教案的最新记录；返回回收的字节数。"""
+        with self.lock():
+            with self._mu:
+                self._refresh()
+                mm, size = self._mm, self._size
+                live = sorted((name, off, st) for name, (off, st) in self._index.items())
+            self._rewrite((name, st.mtime_ns, mm[off:off + st.size]) for name, off, st in live)
+            with self._mu:
+                self._refresh()
+                return size - self._size
+
+    @contextlib.contextmanager
+    def lock(self):
+        """打包文件旁 .lock 文件上的排他 flock（整理会替换打包文件本身，锁不能加在它上面）；同一线程可重入。"""
+        if getattr(self._tls, "locked", False):
+            yield
+            return
+        with open(self.path + ".lock", "ab") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            self._tls.locked = True
+            try:
+                yield
+            finally:
+                self._tls.locked = False
+
+_lesson_store = None
+
+def lesson_store():
+    global _lesson_store
+    if _lesson_store is None:
+        with _init_lock:
+            if _lesson_store is None:
+                if LESSON_STORE == "pack":
+                    _lesson_store = PackStore(LESSON_PACK)
+                elif LESSON_STORE == "dir":
+                    _lesson_store = DirStore()
+                else:
+                    raise ValueError(f"未知的 LESSON_STORE：{LESSON_STORE!r}（可选 dir / pack）")
+    return _lesson_store
+
+def _reset_lesson_store_after_fork():
+    # 只登记一次：每个 PackStore 各登记一个钩子会让换掉的旧实例永远留在 fork 钩子表里
+    if isinstance(_lesson_store, PackStore):
+        _lesson_store._after_fork()
+
+os.register_at_fork(after_in_child=_reset_lesson_store_after_fork)
+
+@app.cli.command("compact-pack")
+def compact_pack_command():
+    """整理教案打包文件（LESSON_STORE=pack 时）。"""
+    store = lesson_store()
+    if store.kind != "pack":
+        print("当前 LESSON_STORE 不是 pack，无需整理")
+        return
+    print(f"已整理 {store.path}，回收 {human_size(store.compact())}")
+
+# ---------------- 教案解析缓存 ----------------
+# 进程内 LRU：教案名 -> 已解析并规范化流程的 dict，以存储给出的 (mtime_ns, size) 判断是否过期。
+# 打开编辑器、单个导出、批量导出都经 load_lesson 读取；写库的地方（save_file / 上传）主动失效。
+# 容量按文件字节数累计（内存里的 dict 约为其数倍）；返回的 dict 是共享的，调用方不要修改。
+LESSON_CACHE_MAX_BYTES = int(os.environ.get("LESSON_CACHE_MAX_BYTES", str(32 * 1024**2)))
+
+_lesson_cache = collections.OrderedDict()  # name -> (mtime_ns, size, data)
+_lesson_cache_bytes = 0
+_lesson_cache_lock = threading.Lock()
+
+def _reset_lesson_cache_lock():
+    """导出进程池在多线程的 worker 里按需 fork：fork 那一刻别的线程可能正持有这把锁，子进程换一把新的。"""
+    global _lesson_cache_lock
+    _lesson_cache_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_lesson_cache_lock)
+
+def lesson_cache_forget(name: str):
+    global _lesson_cache_bytes
+    with _lesson_cache_lock:
+        hit = _lesson_cache.pop(name, None)
+        if hit:
+            _lesson_cache_bytes -= hit[1]
+
+def _lesson_cache_put(name: str, mtime_ns: int, size: int, data: dict):
+    global _lesson_cache_bytes
+    if size > LESSON_CACHE_MAX_BYTES:
+        return
+    with _lesson_cache_lock:
+        old = _lesson_cache.pop(name, None)
+        if old:
+            _lesson_cache_bytes -= old[1]
+        _lesson_cache[name] = (mtime_ns, size, data)
+        _lesson_cache_bytes += size
+        while _lesson_cache_bytes > LESSON_CACHE_MAX_BYTES:
+            _, (_, evicted, _) = _lesson_cache.popitem(last=False)
+            _lesson_cache_bytes -= evicted
+
+def parse_lesson(raw: bytes) -> dict:
+    """解析教案 JSON 并规范化教学流程。"""
+    data = dict(json.loads(raw) or {})
+    data["教学流程"] = coerce_to_fixed_flow(data)
+    return data
+
+def load_lesson(name: str) -> dict:
+    """读库里的教案并规范化教学流程；内容未变时直接返回缓存的结果。不存在抛 KeyError。"""
+    store = lesson_store()
+    st = store.stat(name)
+    if st is not None:
+        with _lesson_cache_lock:
+            hit = _lesson_cache.get(name)
+            if hit and hit[0] == st.mtime_ns and hit[1] == st.size:
+                _lesson_cache.move_to_end(name)
+                inc("lesson_parse_cache_total", result="hit")
+                return hit[2]
+    st, raw = store.read(name)
+    inc("lesson_parse_cache_total", result="miss")
+    data = parse_lesson(raw)
+    _lesson_cache_put(name, st.mtime_ns, st.size, data)
+    return data
+
+# ---------------- 批量渲染（多进程） ----------------
+# 批量导出把渲染分发到进程池（每个 gunicorn worker 首次批量导出时创建，之后复用），默认每个可用 CPU 一个子进程；
+# 只有一个可用 CPU 时不开进程池，直接串行渲染（进程池在单核上只多出进程间传输的开销）。
+# 结果按勾选顺序产出；已提交但未写入压缩包的文档最多 EXPORT_MAX_INFLIGHT 份。
+def usable_cpus() -> int:
+    """本进程能用的 CPU 数：taskset/cpuset 限过的容器里 os.cpu_count() 报的是整机，按它开进程池只有开销。"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # macOS 没有 sched_getaffinity
+        return os.cpu_count() or 1
+
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", "0")) or usable_cpus()
+EXPORT_MAX_INFLIGHT = int(os.environ.get("EXPORT_MAX_INFLIGHT", "0")) or EXPORT_WORKERS * 2
+
+_export_pool = None
+
+def render_lib_file(name: str) -> bytes:
+    """渲染库中一份教案（进程池任务，只传名字，避免在进程间搬运 JSON）。"""
+    return render_docx_cached(load_lesson(name), docx_name_hint=os.path.splitext(name)[0])
+
+def export_pool():
+    global _export_pool
+    if _export_pool is None:
+        with _init_lock:
+            if _export_pool is None:
+                _export_pool = ProcessPoolExecutor(max_workers=EXPORT_WORKERS, initializer=metrics_join_group,
+                                                   initargs=(os.getpid(),))
+    return _export_pool
+
+def iter_pool_map(fn, items):
+    """在进程池上按输入顺序产出 (item, fn(item))；items 可以是生成器，只会提前取 EXPORT_MAX_INFLIGHT 个。"""
+    if EXPORT_WORKERS <= 1 or (hasattr(items, "__len__") and len(items) <= 1):
+        for item in items:
+            yield item, fn(item)
+        return
+
+    global _export_pool
+    pool = export_pool()
+    todo = iter(items)
+    pending = collections.deque((x, pool.submit(fn, x)) for x in itertools.islice(todo, EXPORT_MAX_INFLIGHT))
+    while pending:
+        item, fut = pending.popleft()
+        try:
+            result = fut.result()
+        except BrokenProcessPool:
+            _export_pool = None  # 子进程异常退出：丢弃旧池，下次重建
+            raise
+        for nxt in itertools.islice(todo, 1):
+            pending.append((nxt, pool.submit(fn, nxt)))
+        yield item, result
+
+def iter_rendered_docx(names):
+    """按输入顺序产出 (name, docx bytes)。"""
+    return iter_pool_map(render_lib_file, names)
+
+# ---------------- 合并导出（多份教案一个 DOCX） ----------------
+# 每份教案只渲染成一张 <w:tbl>（进程池里并行），按勾选顺序用分页段落隔开，
+# 共用骨架的样式、页面设置和其余部件，整个文档只打包一次。始终走直写引擎，与 DOCX_ENGINE 无关。
+PAGE_BREAK_XML = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+
+def render_lib_table(name: str) -> str:
+    """进程池任务：库中一份教案 → 表格 XML。"""
+    return lesson_table_xml(load_lesson(name))
+
+def iter_merged_body(names):
+    for i, (_, xml) in enumerate(iter_pool_map(render_lib_table, names)):
+        if i:
+            yield PAGE_BREAK_XML  # 两张表之间必须隔一个段落，否则 Word 会把它们并成一张
+        yield xml
+
+def merged_docx_bytes(names) -> bytes:
+    inc("lesson_documents_rendered_total", engine="merged")
+    return write_ooxml_package(iter_merged_body(names))
+
+def merged_docx_name() -> str:
+    return datetime.datetime.now().strftime("merged_%Y%m%d_%H%M%S.docx")
+
+# ---------------- DOCX → PDF（常驻 LibreOffice 进程池） ----------------
+# 每个 web 进程最多 PDF_WORKERS 个常驻的 headless LibreOffice，各用自己的用户配置目录，
+# 第一次用到时启动、之后复用；转换经 UNO 管道下发（需 python3-uno，venv 要 --system-site-packages）。
+# 没有 uno 时退化为每份文档起一次 soffice --convert-to（仍复用该槽位已初始化好的配置目录）。
+# 单份超过 PDF_TIMEOUT 秒就杀掉该 office 进程并记为失败，下次自动重启。
+# 结果按 DOCX 内容的 sha256 缓存在 PDF_CACHE_DIR（同样按 mtime 做 LRU）。
+SOFFICE = os.environ.get("SOFFICE") or shutil.which("soffice") or shutil.which("libreoffice")
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", "2"))
+PDF_TIMEOUT = float(os.environ.get("PDF_TIMEOUT", "120"))
+PDF_PROFILE_DIR = os.environ.get("PDF_PROFILE_DIR", os.path.join(BASE_DIR, ".cache", "soffice"))
+PDF_CACHE_DIR = os.environ.get("PDF_CACHE_DIR", os.path.join(BASE_DIR, ".cache", "pdf"))
+PDF_CACHE_MAX_BYTES = int(os.environ.get("PDF_CACHE_MAX_BYTES", str(1024**3)))
+
+class PdfError(RuntimeError):
+    pass
+
+_uno = False  # False：还没试过导入；None：不可用
+
+def uno_module():
+    global _uno
+    if _uno is False:
+        try:
+            import uno
+            _uno = uno
+        except ImportError:
+            _uno = None
+    return _uno
+
+def uno_props(**kw):
+    from com.sun.star.beans import PropertyValue
+    return tuple(PropertyValue(Name=k, Value=v) for k, v in kw.items())
+
+class OfficeWorker:
+    """一个转换槽位：一个常驻 soffice 进程（或无 uno 时的一次性进程）加一个专用配置目录。"""
+
+    def __init__(self, slot: int):
+        self.profile = os.path.join(PDF_PROFILE_DIR, f"{os.getpid()}-{slot}")
+        self.pipe = f"lessonpdf-{os.getpid()}-{slot}"
+        self.proc = None
+        self.desktop = None
+
+    def office_args(self):
+        return [SOFFICE, "--headless", "--invisible", "--nologo", "--norestore", "--nolockcheck", "--nodefault",
+                f"-env:UserInstallation=file://{self.profile}"]
+
+    def start(self):
+        uno = uno_module()
+        self.proc = subprocess.Popen(self.office_args() + [f"--accept=pipe,name={self.pipe};urp;StarOffice.ComponentContext"],
+                                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                     start_new_session=True)
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+        deadline = time.monotonic() + PDF_TIMEOUT
+        while True:
+            try:
+                ctx = resolver.resolve(f"uno:pipe,name={self.pipe};urp;StarOffice.ComponentContext")
+                break
+            except Exception:  # NoConnectException：还在启动（首次还要初始化配置目录）
+                if self.proc.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise PdfError("LibreOffice 启动失败")
+                time.sleep(0.2)
+        self.desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+
+    def stop(self):
+        proc, self.proc, self.desktop = self.proc, None, None
+        if proc and proc.poll() is None:
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+
+    def convert(self, src: str, dst: str):
+        uno = uno_module()
+        if uno is None:
+            return self.convert_cli(src, dst)
+        if self.desktop is None:
+            self.start()
+        timed_out = threading.Event()
+        def kill():
+            timed_out.set()
+            self.stop()
+        timer = threading.Timer(PDF_TIMEOUT, kill)
+        timer.start()
+        try:
+            doc = self.desktop.loadComponentFromURL(uno.systemPathToFileUrl(src), "_blank", 0,
+                                                    uno_props(Hidden=True, ReadOnly=True))
+            try:
+                doc.storeToURL(uno.systemPathToFileUrl(dst), uno_props(FilterName="writer_pdf_Export"))
+            finally:
+                doc.close(True)
+        except Exception as e:
+            self.stop()  # 连接/进程状态不明，下次重启
+            raise PdfError("转换超时" if timed_out.is_set() else f"转换失败：{e}") from e
+        finally:
+            timer.cancel()
+
+    def convert_cli(self, src: str, dst: str):
+        outdir = os.path.dirname(dst)
+        proc = subprocess.Popen(self.office_args() + ["--convert-to", "pdf:writer_pdf_Export", "--outdir", outdir, src],
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                start_new_session=True)
+        try:
+            _, err = proc.communicate(timeout=PDF_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(proc.pid, signal.SIGKILL)
+            proc.communicate()
+            raise PdfError("转换超时")
+        out = os.path.join(outdir, os.path.splitext(os.path.basename(src))[0] + ".pdf")
+        if proc.returncode or not os.path.exists(out):
+            raise PdfError(f"转换失败：{err.decode('utf-8', 'replace').strip() or proc.returncode}")
+        os.replace(out, dst)
+
+_pdf_idle = None  # 空闲槽位队列
+_pdf_pool = None
+
+def pdf_slots() -> queue.Queue:
+    global _pdf_idle
+    if _pdf_idle is None:
+        with _init_lock:
+            if _pdf_idle is None:
+                slots = [OfficeWorker(i) for i in range(PDF_WORKERS)]
+                idle = queue.Queue()
+                for w in slots:
+                    idle.put(w)
+                atexit.register(lambda: [w.stop() for w in slots])
+                _pdf_idle = idle
+    return _pdf_idle
+
+def pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is None:
+        with _init_lock:
+            if _pdf_pool is None:
+                _pdf_pool = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix="pdf")
+    return _pdf_pool
+
+def docx_to_pdf(docx_bytes: bytes) -> bytes:
+    """DOCX bytes -> PDF bytes；占用一个空闲槽位（没有就等），失败抛 PdfError。"""
+    if not SOFFICE:
+        raise PdfError("未找到 LibreOffice（soffice），请安装或用 SOFFICE 指定路径")
+    cache_path = os.path.join(PDF_CACHE_DIR, hashlib.sha256(docx_bytes).hexdigest() + ".pdf")
+    blob = cache_read(cache_path) if PDF_CACHE_MAX_BYTES > 0 else None
+    if blob is not None:
+        inc("lesson_pdf_total", result="cached")
+        return blob
+
+    slots = pdf_slots()
+    worker = slots.get()
+    try:
+        with tempfile.TemporaryDirectory(prefix="lessonpdf-") as tmp:
+            src, dst = os.path.join(tmp, "lesson.docx"), os.path.join(tmp, "lesson-out.pdf")
+            with open(src, "wb") as f:
+                f.write(docx_bytes)
+            with span("pdf_convert"):
+                worker.convert(src, dst)
+            with open(dst, "rb") as f:
+                blob = f.read()
+    except PdfError as e:
+        inc("lesson_pdf_total", result="timeout" if "超时" in str(e) else "error")
+        raise
+    finally:
+        slots.put(worker)
+    inc("lesson_pdf_total", result="ok")
+    if PDF_CACHE_MAX_BYTES > 0:
+        cache_write(cache_path, blob)
+        cache_account(PDF_CACHE_DIR, ".pdf", len(blob), PDF_CACHE_MAX_BYTES)
+    return blob
+
+def iter_rendered_pdf(names):
+    """按输入顺序产出 (name, pdf bytes 或 PdfError)：渲染走进程池，转换在 PDF_WORKERS 个槽位上并发，
+    已提交未取走的最多 2×PDF_WORKERS 份。"""
+    pool, pending = pdf_pool(), collections.deque()
+    def ready():
+        name, fut = pending.popleft()
+        try:
+            return name, fut.result()
+        except PdfError as e:
+            return name, e
+    for name, doc_bytes in iter_rendered_docx(names):
+        pending.append((name, pool.submit(docx_to_pdf, doc_bytes)))
+        if len(pending) >= 2 * PDF_WORKERS:
+            yield ready()
+    while pending:
+        yield ready()
+
+# ---------------- 流式 ZIP ----------------
+# 每写完一个条目就把已生成的字节交给客户端，内存占用与勾选数量无关。
+# DOCX 本身已是 deflate 过的 zip，直接 STORED；JSON 照常 DEFLATED。
+class ZipStream(io.RawIOBase):
+    """只写、不可 seek 的输出缓冲：zipfile 往里写，生成器取走。"""
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+STREAM_ERROR_ENTRY = "导出失败.txt"
+
+def stream_zip(entries, error_entry=None):
+    """entries 产出 (ZipInfo, bytes)；逐条目产出压缩包字节。
+    第一块产出之前 entries 出错照常抛出；给了 error_entry 时，之后再出错就写一个同名说明文件并收尾，
+    客户端拿到的仍是完整可读的压缩包（响应头已经发出，改不了状态码）。"""
+    out, entries, sent = ZipStream(), iter(entries), False
+    with zipfile.ZipFile(out, "w") as zf:
+        while True:
+            try:
+                zinfo, data = next(entries)
+            except StopIteration:
+                break
+            except Exception as e:
+                if not sent or error_entry is None:
+                    raise
+                app.logger.exception("流式导出中途失败")
+                zinfo = zip_entry(error_entry, zipfile.ZIP_DEFLATED)
+                data, entries = f"导出中途失败，压缩包里只有此前的文件：{e}\n".encode("utf-8"), iter(())
+            with span("zip_write"):
+                zf.writestr(zinfo, data)
+            yield out.drain()
+            sent = True
+    yield out.drain()  # 中央目录
+
+def zip_entry(arcname: str, compress_type, mtime_ns=None) -> zipfile.ZipInfo:
+    when = datetime.datetime.fromtimestamp(mtime_ns / 1e9) if mtime_ns else datetime.datetime.now()
+    zinfo = zipfile.ZipInfo(arcname, date_time=when.timetuple()[:6])
+    zinfo.compress_type = compress_type
+    return zinfo
+
+def export_entries(names, action):
+    """批量导出的压缩包条目：action 为 'json' 时原样打包，'pdf' 时渲染并转换（失败的列进一个说明文件），
+    否则渲染成 DOCX。"""
+    if action == "json":
+        store = lesson_store()
+        for name in names:
+            st, data = store.read(name)
+            yield zip_entry(name, zipfile.ZIP_DEFLATED, mtime_ns=st.mtime_ns), data
+    elif action == "pdf":
+        failed = []
+        for name, pdf in iter_rendered_pdf(names):
+            stem = os.path.splitext(name)[0]
+            if isinstance(pdf, PdfError):
+                failed.append(f"{stem}: {pdf}")
+                continue
+            yield zip_entry(stem + ".pdf", zipfile.ZIP_STORED), pdf
+        if failed:
+            yield zip_entry("转换失败.txt", zipfile.ZIP_DEFLATED), ("\n".join(failed) + "\n").encode("utf-8")
+    else:
+        for name, doc_bytes in iter_rendered_docx(names):
+            arcname = os.path.splitext(name)[0] + ".docx"
+            yield zip_entry(arcname, zipfile.ZIP_STORED), doc_bytes
+
+def export_archive_name(action) -> str:
+    suffix = action if action in ("json", "pdf") else "docx"
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"export_{suffix}_{stamp}.zip"
+
+# ---------------- 后台导出任务 ----------------
+# 大批量导出不占着请求：提交后由本进程的线程池在后台打包，进度与结果落在
+# EXPORT_JOBS_DIR/<任务号>/ 下（status.json + archive.zip），任何 worker 都能查询/下载。
+# 完成（或失败）超过 EXPORT_JOB_TTL 秒的任务目录会被清理；执行它的进程已退出、没来得及记完成时间的任务，
+# 按 status.json 最后一次写入的时间算。提交、查询进度、下载时都会顺带清理（每个进程最多每 EXPORT_JOB_SWEEP_SECONDS 秒一次），
+# 服务器空闲时下次有人用到导出任务就会清掉。
+EXPORT_JOBS_DIR = os.environ.get("EXPORT_JOBS_DIR", os.path.join(BASE_DIR, ".cache", "export_jobs"))
+EXPORT_JOB_THREADS = int(os.environ.get("EXPORT_JOB_THREADS", "1"))
+EXPORT_JOB_TTL = int(os.environ.get("EXPORT_JOB_TTL", "3600"))
+EXPORT_JOB_SWEEP_SECONDS = 60
+_JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+_job_pool = None
+
+def job_pool():
+    global _job_pool
+    if _job_pool is None:
+        with _init_lock:
+            if _job_pool is None:
+                _job_pool = ThreadPoolExecutor(max_workers=EXPORT_JOB_THREADS, thread_name_prefix="export-job")
+    return _job_pool
+
+def write_export_job(job: dict):
+    path = os.path.join(EXPORT_JOBS_DIR, job["id"], "status.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def read_export_job(job_id: str):
+    if not _JOB_ID_RE.match(job_id):
+        return None
+    try:
+        with open(os.path.join(EXPORT_JOBS_DIR, job_id, "status.json"), "r", encoding="utf-8") as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if job["state"] in ("queued", "running") and not pid_alive(job["pid"]):
+        job.update(state="failed", error="执行任务的进程已退出")
+    return job
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def job_view(job: dict) -> dict:
+    view = {k: job[k] for k in ("id", "state", "done", "total", "action", "error")}
+    view["status_url"] = url_for("export_job_status", job_id=job["id"])
+    if job["action"] == "print":
+        view["printer"] = job["printer"]
+        view["files"] = job["files"]
+    elif job["state"] == "done":
+        view["download_url"] = url_for("export_job_download", job_id=job["id"])
+    return view
+
+_last_sweep = 0.0
+
+def export_job_age(name: str, now: float):
+    """任务结束了多少秒；还在执行返回 None。进程已退出的任务（以及读不出 status.json 的目录）按最后写入时间算。"""
+    job = read_export_job(name)
+    if job and job.get("finished"):
+        return now - job["finished"]
+    if job and job["state"] in ("queued", "running"):
+        return None
+    folder = os.path.join(EXPORT_JOBS_DIR, name)
+    try:
+        mtime = os.stat(os.path.join(folder, "status.json")).st_mtime
+    except FileNotFoundError:
+        try:
+            mtime = os.stat(folder).st_mtime
+        except FileNotFoundError:
+            return None  # 别的 worker 刚删掉
+    return now - mtime
+
+def expire_export_jobs(force=True):
+    """删掉过期的任务目录；force=False 时同一进程 EXPORT_JOB_SWEEP_SECONDS 秒内只扫一次（给频繁轮询的路由用）。"""
+    global _last_sweep
+    if not force and time.monotonic() - _last_sweep < EXPORT_JOB_SWEEP_SECONDS:
+        return
+    _last_sweep = time.monotonic()
+    now = time.time()
+    try:
+        names = os.listdir(EXPORT_JOBS_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        age = export_job_age(name, now)
+        if age is not None and age > EXPORT_JOB_TTL:
+            shutil.rmtree(os.path.join(EXPORT_JOBS_DIR, name), ignore_errors=True)
+
+def run_export_job(job: dict, names):
+    job_dir = os.path.join(EXPORT_JOBS_DIR, job["id"])
+    job["state"] = "running"
+    write_export_job(job)
+    last_write = time.monotonic()
+    try:
+        with open(os.path.join(job_dir, "archive.zip.part"), "wb") as f:
+            for chunk in stream_zip(export_entries(names, job["action"])):
+                f.write(chunk)
+                job["done"] = min(job["done"] + 1, job["total"])  # 最后一块是中央目录
+                if time.monotonic() - last_write > 0.5:
+                    write_export_job(job)
+                    last_write = time.monotonic()
+        os.replace(os.path.join(job_dir, "archive.zip.part"), os.path.join(job_dir, "archive.zip"))
+        job.update(state="done", done=job["total"])
+    except Exception as e:
+        job.update(state="failed", error=str(e))
+    job["finished"] = time.time()
+    write_export_job(job)
+
+def submit_export_job(names, action) -> dict:
+    expire_export_jobs()
+    job = {
+        "id": uuid.uuid4().hex, "state": "queued", "done": 0, "total": len(names),
+        "action": action if action in ("json", "pdf") else "docx", "error": None,
+        "download_name": export_archive_name(action), "created": time.time(), "finished": None,
+        "pid": os.getpid(),
+    }
+    os.makedirs(os.path.join(EXPORT_JOBS_DIR, job["id"]))
+    write_export_job(job)
+    job_pool().submit(run_export_job, dict(job), names)
+    return job
+
+# ---------------- 打印流水线（JSON → DOCX → PDF → lp） ----------------
+# 与后台导出共用任务目录和进度查询（/export_jobs/<id>），action 为 "print"，status.json 里逐个文件记录：
+#   queued → converted（PDF 已就绪，等打印机）→ submitted（已交给 CUPS，job 为任务号）→ completed；出错为 failed
+# 渲染在进程池、转换在 PDF 槽位、lp 在单独线程，三段之间都是有界缓冲：第一份转好就开始打印，
+# 打印跟不上时前面自动停下等待，总耗时接近最慢的一段。
+# 多批可以同时渲染/转换（PRINT_JOB_THREADS），只有 lp 提交在本 worker 内一批一批来。
+# 提交完就把任务交给本进程唯一的 print-poll 线程，由它按打印机合并轮询队列，直到任务都打印完（或超过 PRINT_WAIT_TIMEOUT）；
+# 提交线程立即去处理下一批，卡住的打印机不会让后面的批次干等。
+PRINT_QUEUE_SIZE = int(os.environ.get("PRINT_QUEUE_SIZE", "4"))
+PRINT_WAIT_TIMEOUT = float(os.environ.get("PRINT_WAIT_TIMEOUT", "3600"))
+PRINT_POLL_SECONDS = 5
+PRINT_JOB_THREADS = int(os.environ.get("PRINT_JOB_THREADS", "2"))
+
+_print_pool = None
+_print_lp_lock = threading.Lock()  # 本 worker 内同一时刻只有一批在往打印机提交，各批的页不会交错
+
+def print_pool():
+    global _print_pool
+    if _print_pool is None:
+        with _init_lock:
+            if _print_pool is None:
+                _print_pool = ThreadPoolExecutor(max_workers=PRINT_JOB_THREADS, thread_name_prefix="print-job")
+    return _print_pool
+
+def run_print_job(job: dict, names):
+    job_dir = os.path.join(EXPORT_JOBS_DIR, job["id"])
+    files = job["files"]
+    lock = threading.Lock()
+    last_write = [0.0]
+
+    def mark(i=None, force=False, **fields):
+        with lock:
+            if i is not None:
+                files[i].update(fields)
+                if fields.get("status") in ("submitted", "failed"):
+                    job["done"] += 1  # 进度按提交计；之后打印完成/被取消由轮询线程改状态，不再计
+            if force or time.monotonic() - last_write[0] > 0.5:
+                write_export_job(job)
+                last_write[0] = time.monotonic()
+
+    opts = printing.lp_options(job["copies"], job["two_sided"])
+    to_printer = queue.Queue(maxsize=PRINT_QUEUE_SIZE)
+
+    def lp_stage():
+        with _print_lp_lock:  # 只串行提交：后一批照常渲染/转换，转好的先在 to_printer 里排着
+            while True:
+                item = to_printer.get()
+                if item is None:
+                    return
+                i, pdf_path = item
+                try:
+                    mark(i, status="submitted", job=printing.submit_lp(job["printer"], [pdf_path], opts))
+                except RuntimeError as e:
+                    mark(i, status="failed", error=str(e))
+
+    job["state"] = "running"
+    mark(force=True)
+    lp_thread = threading.Thread(target=lp_stage, name="print-lp", daemon=True)
+    lp_thread.start()
+    try:
+        for i, (name, pdf) in enumerate(iter_rendered_pdf(names)):
+            if isinstance(pdf, PdfError):
+                mark(i, status="failed", error=str(pdf))
+                continue
+            pdf_path = os.path.join(job_dir, f"{i:04d}.pdf")
+            with open(pdf_path, "wb") as f:
+                f.write(pdf)
+            mark(i, status="converted")
+            to_printer.put((i, pdf_path))  # 满了就等打印线程
+    except Exception as e:
+        broken = f"渲染/转换中断：{e}"
+    else:
+        broken = None
+    finally:
+        to_printer.put(None)
+        lp_thread.join()
+
+    mark(force=True)
+    watch_print_job(job, broken)
+
+# 交给轮询线程的 (job, 截止时刻, 渲染/转换中断的原因)；线程之后独占这些 job dict
+_print_watches = queue.Queue()
+_print_poller = None
+
+def _reset_print_poller():
+    global _print_watches, _print_poller, _print_lp_lock
+    _print_watches, _print_poller, _print_lp_lock = queue.Queue(), None, threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_print_poller)
+
+def watch_print_job(job: dict, broken=None):
+    global _print_poller
+    with _init_lock:
+        if _print_poller is None or not _print_poller.is_alive():
+            _print_poller = threading.Thread(target=_poll_print_jobs, name="print-poll", daemon=True)
+            _print_poller.start()
+    _print_watches.put((job, time.monotonic() + PRINT_WAIT_TIMEOUT, broken))
+
+def finish_print_job(job: dict, broken=None):
+    files = job["files"]
+    failed = sum(f["status"] == "failed" for f in files)
+    job["error"] = broken or (f"{failed} 个文件失败" if failed else None)
+    job.update(state="failed" if broken or failed == len(files) else "done", finished=time.time())
+    write_export_job(job)
+
+def poll_print_jobs(jobs):
+    """每台打印机查一次队列，更新这些任务里已结束文件的状态并写回 status.json。"""
+    by_printer = collections.defaultdict(list)
+    for job in jobs:
+        by_printer[job["printer"]].append(job)
+    for printer, group in by_printer.items():
+        waiting = {f["job"] for job in group for f in job["files"] if f["status"] == "submitted"}
+        if not waiting:
+            continue
+        finished = printing.poll_jobs(printer, waiting) or {}  # lpstat 失败：这一轮不改状态
+        for job in group:
+            changed = False
+            for f in job["files"]:
+                if f["status"] != "submitted" or f["job"] not in finished:
+                    continue
+                reason = finished[f["job"]]
+                if reason is None:
+                    f["status"] = "completed"
+                else:
+                    f.update(status="failed", error=f"任务 {f['job']} 未打印完成：{reason}")
+                changed = True
+            if changed:
+                write_export_job(job)
+
+def _poll_print_jobs():
+    watching = {}  # 任务号 -> (job, 截止时刻, 中断原因)
+    while True:
+        if not watching:
+            job, deadline, broken = _print_watches.get()  # 没有要盯的任务时在这里睡着
+            watching[job["id"]] = (job, deadline, broken)
+        while not _print_watches.empty():
+            job, deadline, broken = _print_watches.get_nowait()
+            watching[job["id"]] = (job, deadline, broken)
+        try:
+            poll_print_jobs([job for job, _, _ in watching.values()])
+            for job_id, (job, deadline, broken) in list(watching.items()):
+                if time.monotonic() > deadline or not any(f["status"] == "submitted" for f in job["files"]):
+                    finish_print_job(job, broken)
+                    del watching[job_id]
+        except Exception:
+            app.logger.exception("轮询打印队列失败")
+        if watching:
+            time.sleep(PRINT_POLL_SECONDS)
+
+def submit_print_job(names, printer: str, copies=1, two_sided=True) -> dict:
+    expire_export_jobs()
+    job = {
+        "id": uuid.uuid4().hex, "state": "queued", "done": 0, "total": len(names), "action": "print",
+        "error": None, "download_name": None, "created": time.time(), "finished": None, "pid": os.getpid(),
+        "printer": printer, "copies": copies, "two_sided": two_sided,
+        "files": [{"name": name, "status": "queued", "job": None, "error": None} for name in names],
+    }
+    os.makedirs(os.path.join(EXPORT_JOBS_DIR, job["id"]))
+    write_export_job(job)
+    print_pool().submit(run_print_job, job, names)
+    return job
+
+# ---------------- 本地库索引（SQLite） ----------------
+# 库里教案的元数据（大小、mtime、内容哈希、教学课题）持久化在 SQLite 里。
+# upload_to_lib / save_file 写入后直接更新对应行；首页只在存储的 generation 变化时才对账，
+# 变了的教案用 iter_read 批量读（打包存储下是一次顺序读）。
+# 全文检索：可检索文本按字符二元组（bigram）建倒排表 grams，中文无需分词；
+# 候选集再用原文 instr 校验，避免二元组拼凑出的误命中。
+LIB_INDEX_DB = os.environ.get("LIB_INDEX_DB", os.path.join(BASE_DIR, ".cache", "library.sqlite3"))
+INDEX_SCHEMA_VERSION = 4  # 表结构/索引内容变化时加一，旧库会整体重建
+PAGE_SIZE = 50
+SORT_COLUMNS = {"name": "name", "size": "size", "mtime": "mtime_ns"}
+SEARCH_FIELDS = ["教学课题", "教学目标", "教学重点与难点"]
+_WS_RE = re.compile(r"\s+")
+
+_index_ready = False
+
+@contextlib.contextmanager
+def index_db():
+    """打开索引库；with 块正常结束时提交。"""
+    global _index_ready
+    if not _index_ready:
+        os.makedirs(os.path.dirname(LIB_INDEX_DB), exist_ok=True)
+    conn = sqlite3.connect(LIB_INDEX_DB, timeout=30)
+    try:
+        if not _index_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < INDEX_SCHEMA_VERSION:
+                with conn:
+                    for table in ("lessons", "meta", "lesson_text", "grams", "name_suffix"):
+                        conn.execute(f"DROP TABLE IF EXISTS {table}")
+                    conn.execute(f"PRAGMA user_version={INDEX_SCHEMA_VERSION}")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS lessons(
+                    name TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    title TEXT NOT NULL DEFAULT '',
+                    lesson_hash TEXT NOT NULL DEFAULT '',
+                    canonical_hash TEXT NOT NULL DEFAULT ''
+                );
+                CREATE INDEX IF NOT EXISTS lessons_size ON lessons(size);
+                CREATE INDEX IF NOT EXISTS lessons_mtime ON lessons(mtime_ns);
+                CREATE INDEX IF NOT EXISTS lessons_sha256 ON lessons(sha256);
+                CREATE INDEX IF NOT EXISTS lessons_canonical ON lessons(canonical_hash);
+                CREATE TABLE IF NOT EXISTS name_suffix(base TEXT PRIMARY KEY, max_n INTEGER NOT NULL);
+                CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS lesson_text(name TEXT PRIMARY KEY, body TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS grams(
+                    gram TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    PRIMARY KEY(gram, name)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS grams_name ON grams(name);
+            """)
+            _index_ready = True
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def normalize_search_text(text: str) -> str:
+    return _WS_RE.sub(" ", text).strip().casefold()
+
+def text_grams(text: str) -> set:
+    """字符二元组；跨空白的不要（字段之间用换行分隔，也就不会跨字段）。"""
+    return {text[i:i+2] for i in range(len(text) - 1) if not text[i].isspace() and not text[i+1].isspace()}
+
+def canonical_hash(raw: bytes) -> str:
+    """JSON 等价即相同（键序、缩进、转义不同也算一份）；解析不了就按字节。"""
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return hashlib.sha256(raw).hexdigest()
+    return hashlib.sha256(json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+def lesson_meta(raw: bytes):
+    """返回 (教学课题, 规范化后的可检索文本, 规范化教案哈希)；解析失败时哈希为空。"""
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return "", "", ""
+    if not isinstance(data, dict):
+        return "", "", ""
+    parts = [str(data.get(key, "") or "") for key in SEARCH_FIELDS]
+    for block in coerce_to_fixed_flow(data):
+        for acts in block.values():
+            for act in acts:
+                parts += [act["tea"], act["stu"]]
+    body = "\n".join(normalize_search_text(p) for p in parts if p)
+    return str(data.get("教学课题", "") or ""), body, lesson_hash(data)
+
+def index_forget(conn, names):
+    rows = [(n,) for n in names]
+    for table in ("lessons", "lesson_text", "grams"):
+        conn.executemany(f"DELETE FROM {table} WHERE name=?", rows)
+
+def index_file(conn, name: str):
+    """（重新）索引库里的一份教案；已不存在则删掉对应行。"""
+    try:
+        st, raw = lesson_store().read(name)
+    except KeyError:
+        index_forget(conn, [name])
+        return
+    index_lesson(conn, name, st, raw)
+
+def index_lesson(conn, name: str, st: LessonStat, raw: bytes):
+    title, body, digest = lesson_meta(raw)
+    conn.execute(
+        "INSERT OR REPLACE INTO lessons(name, size, mtime_ns, sha256, title, lesson_hash, canonical_hash) VALUES(?,?,?,?,?,?,?)",
+        (name, st.size, st.mtime_ns, hashlib.sha256(raw).hexdigest(), title, digest, canonical_hash(raw)),
+    )
+    base, n, _ = split_conflict_name(name)
+    if n:
+        conn.execute("INSERT INTO name_suffix(base, max_n) VALUES(?,?) "
+                     "ON CONFLICT(base) DO UPDATE SET max_n=max(max_n, excluded.max_n)", (base, n))
+    conn.execute("INSERT OR REPLACE INTO lesson_text(name, body) VALUES(?,?)", (name, body))
+    conn.execute("DELETE FROM grams WHERE name=?", (name,))
+    conn.executemany("INSERT INTO grams(gram, name) VALUES(?,?)", [(g, name) for g in text_grams(body)])
+
+def search_clause(q: str):
+    """把检索词翻译成 lessons 上的 WHERE 子句与参数；q 为空返回 ("", [])。"""
+    q = normalize_search_text(q)
+    if not q:
+        return "", []
+    sql = "name IN (SELECT name FROM lesson_text WHERE instr(body, ?) > 0)"
+    params = [q]
+    grams = sorted(text_grams(q))
+    if grams:
+        sql = (f"name IN (SELECT name FROM grams WHERE gram IN ({','.join('?' * len(grams))})"
+               f" GROUP BY name HAVING COUNT(*) = ?) AND " + sql)
+        params = grams + [len(grams)] + params
+    return "WHERE " + sql, params
+
+def reconcile_index(conn):
+    """存储的 generation 未变则什么也不做；否则按 (size, mtime_ns) 增量对账。"""
+    store = lesson_store()
+    generation = f"{store.kind}:{store.generation()}"
+    row = conn.execute("SELECT value FROM meta WHERE key='store_generation'").fetchone()
+    if row and row[0] == generation:
+        return
+    known = {name: (size, mtime) for name, size, mtime in conn.execute("SELECT name, size, mtime_ns FROM lessons")}
+    current = dict(store.scan())
+    stale = [name for name, st in current.items() if known.get(name) != (st.size, st.mtime_ns)]
+    for name, st, raw in store.iter_read(stale):
+        index_lesson(conn, name, st, raw)
+    index_forget(conn, known.keys() - current.keys())
+    conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES('store_generation', ?)", (generation,))
+
+def lib_file_meta(name: str):
+    """只 stat、查索引，得到 (LessonStat, 内容 sha256, 规范化教案哈希)；索引过期则当场重建该行。不存在抛 KeyError。"""
+    st = lesson_store().stat(name)
+    if st is None:
+        raise KeyError(name)
+    with index_db() as conn:
+        row = conn.execute("SELECT size, mtime_ns, sha256, lesson_hash FROM lessons WHERE name=?", (name,)).fetchone()
+        if not row or (row[0], row[1]) != (st.size, st.mtime_ns):
+            index_file(conn, name)
+            row = conn.execute("SELECT size, mtime_ns, sha256, lesson_hash FROM lessons WHERE name=?", (name,)).fetchone()
+    return st, row[2], row[3]
+
+def index_update(*names):
+    with index_db() as conn:
+        for name in names:
+            index_file(conn, name)
+
+# ---------------- 上传入库（去重 + 冲突命名） ----------------
+# 一批上传一次对账、一个事务：与库里（或同批里）字节相同/JSON 等价的文件直接跳过；
+# 重名按 name_suffix 分配下一个（n），用独占创建写入，多个 worker 并发上传也不会互相覆盖。
+def import_lessons(items):
+    """items: [(原文件名, bytes)]；返回逐个文件的结果 [{file, status, name, detail}]。
+    status: saved / renamed / duplicate / invalid"""
+    outcomes = []
+    with index_db() as conn:
+        reconcile_index(conn)
+        batch = {}  # 同批内 canonical_hash -> 已入库名
+        for filename, raw in items:
+            name = lesson_name(os.path.basename(filename or ""))  # 保留中文/空格
+            if not name:
+                outcomes.append({"file": filename, "status": "invalid", "name": None, "detail": "不是 .json 或文件名非法"})
+                continue
+            sha, canon = hashlib.sha256(raw).hexdigest(), canonical_hash(raw)
+            dup = batch.get(canon) or batch.get(sha)
+            if not dup:
+                row = conn.execute("SELECT name FROM lessons WHERE sha256=? OR canonical_hash=? LIMIT 1", (sha, canon)).fetchone()
+                dup = row[0] if row else None
+            if dup:
+                outcomes.append({"file": filename, "status": "duplicate", "name": dup, "detail": f"与 {dup} 内容相同"})
+                continue
+
+            status = "saved"
+            while True:
+                try:
+                    lesson_store().write(name, raw, exclusive=True)
+                    lesson_cache_forget(name)
+                    break
+                except FileExistsError:
+                    name = next_conflict_name(name, conn)
+                    status = "renamed"
+            index_file(conn, name)
+            batch[canon] = batch[sha] = name
+            outcomes.append({"file": filename, "status": status, "name": name, "detail": None})
+    return outcomes
+
+MAX_LESSON_BYTES = 5 * 1024**2  # 单个教案 JSON 的上限（也防 zip 炸弹）
+
+def validate_lesson(raw: bytes):
+    """按教案结构校验；合格返回 None，否则返回错误说明。"""
+    try:
+        data = json.loads(raw)
+    except ValueError as e:
+        return f"JSON 解析错误：{e}"
+    return lesson_error(data)
+
+def lesson_error(data):
+    """validate_lesson 的结构部分（入参已是解析好的对象）。"""
+    if not isinstance(data, dict):
+        return "顶层应为对象"
+    if not isinstance(data.get("教学课题"), str):
+        return "缺少字符串字段 教学课题"
+    for key in TOP_KEYS + ["板书设计"]:
+        if not isinstance(data.get(key, ""), str):
+            return f"字段 {key} 应为字符串"
+    flow = data.get("教学流程")
+    if not isinstance(flow, list):
+        return "缺少列表字段 教学流程"
+    for i, block in enumerate(flow, 1):
+        if not isinstance(block, dict) or len(block) != 1:
+            return f"教学流程第 {i} 节应为只有一个键（小节标题）的对象"
+        acts = next(iter(block.values()))
+        if not isinstance(acts, list):
+            return f"教学流程第 {i} 节的活动应为列表"
+        for k, act in enumerate(acts, 1):
+            if not isinstance(act, dict) or not all(isinstance(act.get(f, ""), str) for f in ("tea", "stu")):
+                return f"教学流程第 {i} 节第 {k} 个活动应为含字符串 tea/stu 的对象"
+    return None
+
+def validate_zip_item(item):
+    """进程池任务：item 为 (条目名, bytes)。"""
+    return validate_lesson(item[1])
+
+def zip_member_name(zinfo: zipfile.ZipInfo) -> str:
+    """未标 UTF-8 的条目名按 cp437 解码过，Windows/macOS 中文压缩包多半其实是 UTF-8 或 GBK。"""
+    name = zinfo.filename
+    if not zinfo.flag_bits & 0x800:
+        raw = name.encode("cp437")
+        for enc in ("utf-8", "gbk"):
+            try:
+                name = raw.decode(enc)
+                break
+            except UnicodeDecodeError:
+                pass
+    return name
+
+def zip_lesson_members(zf: zipfile.ZipFile):
+    """压缩包里要入库的条目：.json 文件，跳过目录、__MACOSX 与隐藏文件。"""
+    for zinfo in zf.infolist():
+        name = zip_member_name(zinfo)
+        base = os.path.basename(name)
+        if zinfo.is_dir() or name.startswith("__MACOSX/") or base.startswith(".") or not base.lower().endswith(".json"):
+            continue
+        yield zinfo, base
+
+def read_zip_member(zf: zipfile.ZipFile, zinfo: zipfile.ZipInfo) -> bytes:
+    with zf.open(zinfo) as f:
+        raw = f.read(MAX_LESSON_BYTES + 1)
+    if len(raw) > MAX_LESSON_BYTES:
+        raise ValueError(f"超过 {MAX_LESSON_BYTES // 1024**2} MB")
+    return raw
+
+def import_lesson_zip(fileobj):
+    """两遍读取压缩包（上传已落在临时文件里，可 seek）：
+    第一遍逐条解压、在进程池上并行校验，只保留错误；全部合格才第二遍逐条入库。
+    返回 (errors, outcomes)；有错误时什么都不写。"""
+    errors = []
+    try:
+        with zipfile.ZipFile(fileobj) as zf:
+            def items():
+                for zinfo, base in zip_lesson_members(zf):
+                    try:
+                        yield base, read_zip_member(zf, zinfo)
+                    except (ValueError, zipfile.BadZipFile, RuntimeError) as e:
+                        errors.append((base, str(e)))
+            for (base, _), err in iter_pool_map(validate_zip_item, items()):
+                if err:
+                    errors.append((base, err))
+            if errors:
+                return errors, []
+            outcomes = import_lessons((base, read_zip_member(zf, zinfo)) for zinfo, base in zip_lesson_members(zf))
+    except zipfile.BadZipFile as e:
+        return [("", f"不是有效的 zip：{e}")], []
+    return [], outcomes
+
+def flash_import_outcomes(outcomes):
+    counts = collections.Counter(o["status"] for o in outcomes)
+    stored = counts["saved"] + counts["renamed"]
+    flash(f"已上传 {stored} 个文件到 jsons/（其中重名改名 {counts['renamed']} 个），"
+          f"重复跳过 {counts['duplicate']} 个，无效 {counts['invalid']} 个", "ok" if stored else "err")
+    details = [o for o in outcomes if o["status"] != "saved"]
+    for o in details[:20]:
+        if o["status"] == "renamed":
+            flash(f"{o['file']} → {o['name']}", "ok")
+        else:
+            flash(f"{o['file']}：{o['detail']}", "err")
+    if len(details) > 20:
+        flash(f"……另有 {len(details) - 20} 条未列出", "err")
+
+# ---------------- 增量保存（JSON Patch） ----------------
+# 编辑器只把改动作为 RFC 6902 JSON Patch 发来（PATCH /lesson/<name>，If-Match 带打开时的版本）。
+# 版本即教案内容的 sha256（与 download_json 的 ETag 相同）；服务端在存储的写锁内读当前内容、
+# 校验版本、应用补丁、校验结构，再原子写回（目录存储是临时文件 + os.replace，打包存储是追加一条记录）。
+PATCH_FIELDS = set(TOP_KEYS + ["板书设计", "教学反思", "教学流程"])
+
+class PatchError(ValueError):
+    pass
+
+def split_pointer(pointer: str):
+    """JSON Pointer（RFC 6901）-> token 列表。"""
+    if not isinstance(pointer, str) or not pointer.startswith("/"):
+        raise PatchError(f"非法路径：{pointer!r}")
+    return [t.replace("~1", "/").replace("~0", "~") for t in pointer[1:].split("/")]
+
+def _patch_parent(doc, tokens):
+    for t in tokens[:-1]:
+        doc = _patch_child(doc, t)
+    return doc, tokens[-1]
+
+def _patch_child(doc, token):
+    try:
+        if isinstance(doc, list):
+            return doc[_patch_index(doc, token)]
+        return doc[token]
+    except (KeyError, IndexError, TypeError):
+        raise PatchError(f"路径不存在：{token}")
+
+def _patch_index(seq, token, insert=False):
+    if insert and token == "-":
+        return len(seq)
+    if not token.isdigit() or (token != "0" and token.startswith("0")):
+        raise PatchError(f"非法下标：{token}")
+    i = int(token)
+    if i > len(seq) or (i == len(seq) and not insert):
+        raise PatchError(f"下标越界：{token}")
+    return i
+
+def _patch_get(doc, tokens):
+    for t in tokens:
+        doc = _patch_child(doc, t)
+    return doc
+
+def _patch_remove(doc, tokens):
+    parent, last = _patch_parent(doc, tokens)
+    if isinstance(parent, list):
+        return parent.pop(_patch_index(parent, last))
+    if not isinstance(parent, dict) or last not in parent:
+        raise PatchError(f"路径不存在：{last}")
+    return parent.pop(last)
+
+def _patch_add(doc, tokens, value):
+    parent, last = _patch_parent(doc, tokens)
+    if isinstance(parent, list):
+        parent.insert(_patch_index(parent, last, insert=True), value)
+    elif isinstance(parent, dict):
+        parent[last] = value
+    else:
+        raise PatchError(f"路径不存在：{last}")
+
+def apply_json_patch(doc: dict, ops) -> dict:
+    """在 doc 上原地应用补丁（add/remove/replace/move/copy/test）；只允许改顶层字段与教学流程。"""
+    if not isinstance(ops, list):
+        raise PatchError("补丁应为操作列表")
+    for op in ops:
+        if not isinstance(op, dict):
+            raise PatchError("补丁操作应为对象")
+        kind, tokens = op.get("op"), split_pointer(op.get("path"))
+        if tokens[0] not in PATCH_FIELDS:
+            raise PatchError(f"不允许修改字段：{tokens[0]}")
+        if kind in ("add", "replace", "test") and "value" not in op:
+            raise PatchError(f"{kind} 缺少 value")
+        if kind == "add":
+            _patch_add(doc, tokens, copy.deepcopy(op["value"]))
+        elif kind == "remove":
+            _patch_remove(doc, tokens)
+        elif kind == "replace":
+            _patch_remove(doc, tokens)
+            _patch_add(doc, tokens, copy.deepcopy(op["value"]))
+        elif kind in ("move", "copy"):
+            src = split_pointer(op.get("from"))
+            if src[0] not in PATCH_FIELDS:
+                raise PatchError(f"不允许修改字段：{src[0]}")
+            if kind == "move" and tokens[:len(src)] == src and tokens != src:
+                raise PatchError("不能移动到自身内部")
+            value = _patch_remove(doc, src) if kind == "move" else copy.deepcopy(_patch_get(doc, src))
+            _patch_add(doc, tokens, value)
+        elif kind == "test":
+            if _patch_get(doc, tokens) != op["value"]:
+                raise PatchError(f"test 不成立：{op['path']}")
+        else:
+            raise PatchError(f"不支持的操作：{kind!r}")
+    return doc
+
+def patch_lesson_file(name: str, version: str, ops):
+    """校验版本并应用补丁；返回新版本。版本不符返回 None。补丁非法抛 PatchError。"""
+    store = lesson_store()
+    with store.lock():
+        _, raw = store.read(name)
+        if hashlib.sha256(raw).hexdigest() != version:
+            return None
+        data = json.loads(raw)
+        if not isinstance(data, dict):
+            raise PatchError("库文件顶层不是对象")
+        data["教学流程"] = coerce_to_fixed_flow(data)  # 与编辑器里的形态一致，补丁路径才对得上
+        apply_json_patch(data, ops)
+        err = lesson_error(data)
+        if err:
+            raise PatchError(err)
+        out = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+        store.write(name, out)
+    lesson_cache_forget(name)
+    index_update(name)
+    return hashlib.sha256(out).hexdigest()
+
+# ---------------- 页面静态资源（指纹 URL + 长缓存） ----------------
+# 页面的 CSS/JS 放在下面的字符串常量里，启动时登记：按内容哈希生成文件名（index.3f2a9c1d.css），
+# 预先 gzip 好；内容一变 URL 就变，所以可以让浏览器缓存一年、不再回源校验。
+ASSET_MIMETYPES = {".css": "text/css; charset=utf-8", ".js": "text/javascript; charset=utf-8"}
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+_assets = {}       # 指纹文件名 -> (原文 bytes, gzip bytes, mimetype)
+_asset_names = {}  # 逻辑文件名 -> 指纹文件名
+
+def register_asset(name: str, text: str):
+    body = text.encode("utf-8")
+    stem, ext = os.path.splitext(name)
+    fingerprinted = f"{stem}.{hashlib.sha256(body).hexdigest()[:12]}{ext}"
+    _assets[fingerprinted] = (body, gzip.compress(body, 9, mtime=0), ASSET_MIMETYPES[ext])
+    _asset_names[name] = fingerprinted
+
+@app.template_global()
+def asset_url(name: str) -> str:
+    return url_for("asset", name=_asset_names[name])
+
+def script_json(obj) -> Markup:
+    """内联到 <script> 里的 JSON：转义 < > & 防止提前闭合标签，中文原样输出。"""
+    text = json.dumps(obj, ensure_ascii=False)
+    return Markup(text.replace("<", "\\u003c").replace(">", "\\u003e").replace("&", "\\u0026")
+                  .replace("\u2028", "\\u2028").replace("\u2029", "\\u2029"))
+
 # ---------------- 首页（本地库 + 上传/批量导出） ----------------
+INDEX_CSS = """
+body{ font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,"PingFang SC","Hiragino Sans GB","Microsoft YaHei","Helvetica Neue",Arial,sans-serif; margin:2rem auto; max-width:1000px; color:#222; }
+h1{ margin-bottom:.25rem; }
+.muted{ color:#666; }
+.card{ border:1px solid #e5e7eb; border-radius:12px; padding:1rem 1.25rem; margin:1rem 0; box-shadow:0 1px 2px rgba(0,0,0,.04); }
+table{ width:100%; border-collapse:collapse; }
+th,td{ border-bottom:1px solid #eee; padding:.55rem .4rem; font-size:14px; }
+th{ text-align:left; color:#555; }
+.right{ text-align:right; }
+.row{ display:flex; gap:10px; align-items:center; flex-wrap:wrap; }
+.btn{ display:inline-block; border:1px solid #111; padding:.4rem .75rem; border-radius:10px; text-decoration:none; background:#fff; color:#111; cursor:pointer; font-size:14px; }
+.btn:hover{ background:#111; color:#fff; }
+.btn.light{ border-color:#bbb; color:#333; }
+.btn.light:hover{ background:#f5f5f5; color:#111; }
+input[type=file]{ padding:.5rem; border:1px dashed #bbb; border-radius:8px; width:100%; }
+.ok{ color:#076d2d; } .err{ color:#b91c1c; }
+"""
+
+INDEX_JS = """
+function toggleAll(cb){
+  document.querySelectorAll('input[name=selected]').forEach(x=>x.checked=cb.checked);
+}
+async function startExportJob(action){
+  const fd=new FormData(document.getElementById('bulkExport')); fd.set('action',action);
+  const box=document.getElementById('jobStatus');
+  const r=await fetch(document.getElementById('bulkExport').dataset.jobUrl,{method:'POST',body:fd});
+  let job=await r.json();
+  if(!r.ok){ box.className='err'; box.textContent=job.error; return; }
+  box.className='muted';
+  while(job.state==='queued'||job.state==='running'){
+    box.textContent=`后台导出中：${job.done}/${job.total}`;
+    await new Promise(res=>setTimeout(res,1000));
+    const s=await fetch(job.status_url); job=await s.json();
+    if(!s.ok){ box.className='err'; box.textContent=job.error; return; }
+  }
+  if(job.state==='done'){ box.className='ok'; box.textContent=`导出完成：${job.total} 个文件`; window.location=job.download_url; }
+  else { box.className='err'; box.textContent='导出失败：'+(job.error||''); }
+}
+
+const PRINT_STATUS={queued:'排队', converted:'已转 PDF，等待打印机', submitted:'已送打印机', completed:'已打印', failed:'失败'};
+async function loadPrinters(){
+  const sel=document.getElementById('printer');
+  try{
+    const r=await fetch(document.getElementById('bulkExport').dataset.printersUrl);
+    const printers=(await r.json()).printers||[];
+    sel.innerHTML='';
+    printers.forEach(p=>{
+      const o=document.createElement('option'); o.value=p.name;
+      o.textContent=p.name+(p.default?'（默认）':'')+(p.accepting===false||p.enabled===false?'（停用）':'');
+      o.selected=p.default; sel.appendChild(o);
+    });
+    if(!printers.length) sel.innerHTML='<option value="">（没有打印机）</option>';
+  }catch(e){ sel.innerHTML='<option value="">（读取打印机失败）</option>'; }
+}
+function showPrintFiles(files){
+  const ul=document.getElementById('printFiles'); ul.innerHTML='';
+  files.forEach(f=>{
+    const li=document.createElement('li');
+    li.textContent=`${f.name}：${PRINT_STATUS[f.status]||f.status}${f.job?'（'+f.job+'）':''}${f.error?' — '+f.error:''}`;
+    if(f.status==='failed') li.className='err';
+    ul.appendChild(li);
+  });
+}
+async function startPrintJob(){
+  const form=document.getElementById('bulkExport'), fd=new FormData(form);
+  fd.set('printer',document.getElementById('printer').value);
+  fd.set('copies',document.getElementById('copies').value||'1');
+  fd.set('two_sided',document.getElementById('twoSided').checked?'1':'0');
+  const box=document.getElementById('jobStatus');
+  const r=await fetch(form.dataset.printUrl,{method:'POST',body:fd});
+  let job=await r.json();
+  if(!r.ok){ box.className='err'; box.textContent=job.error; return; }
+  box.className='muted';
+  while(true){
+    const printed=job.files.filter(f=>f.status==='completed').length;
+    box.textContent=`打印 → ${job.printer}：已送出 ${job.done}/${job.total}，已打印 ${printed}`;
+    showPrintFiles(job.files);
+    if(job.state!=='queued'&&job.state!=='running') break;
+    await new Promise(res=>setTimeout(res,1500));
+    const s=await fetch(job.status_url); job=await s.json();
+    if(!s.ok){ box.className='err'; box.textContent=job.error; return; }
+  }
+  box.className=job.error?'err':'ok';
+  box.textContent+= job.error ? `（${job.error}）` : '，全部完成';
+}
+loadPrinters();
+"""
+
 INDEX_HTML = """
 <!doctype html>
 <html>
@@ -234,23 +2337,7 @@ INDEX_HTML = """
   <meta charset="utf-8">
   <title>英语教案编辑器</title>
   <link rel="icon" href="data:,">
-  <style>
-    body{ font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,"PingFang SC","Hiragino Sans GB","Microsoft YaHei","Helvetica Neue",Arial,sans-serif; margin:2rem auto; max-width:1000px; color:#222; }
-    h1{ margin-bottom:.25rem; }
-    .muted{ color:#666; }
-    .card{ border:1px solid #e5e7eb; border-radius:12px; padding:1rem 1.25rem; margin:1rem 0; box-shadow:0 1px 2px rgba(0,0,0,.04); }
-    table{ width:100%; border-collapse:collapse; }
-    th,td{ border-bottom:1px solid #eee; padding:.55rem .4rem; font-size:14px; }
-    th{ text-align:left; color:#555; }
-    .right{ text-align:right; }
-    .row{ display:flex; gap:10px; align-items:center; flex-wrap:wrap; }
-    .btn{ display:inline-block; border:1px solid #111; padding:.4rem .75rem; border-radius:10px; text-decoration:none; background:#fff; color:#111; cursor:pointer; font-size:14px; }
-    .btn:hover{ background:#111; color:#fff; }
-    .btn.light{ border-color:#bbb; color:#333; }
-    .btn.light:hover{ background:#f5f5f5; color:#111; }
-    input[type=file]{ padding:.5rem; border:1px dashed #bbb; border-radius:8px; width:100%; }
-    .ok{ color:#076d2d; } .err{ color:#b91c1c; }
-  </style>
+  <link rel="stylesheet" href="{{ asset_url('index.css') }}">
 </head>
 <body>
   <h1>英语教案编辑器</h1>
@@ -264,16 +2351,27 @@ INDEX_HTML = """
     {% endif %}
   {% endwith %}
 
+  {% macro sort_link(col, label) -%}
+    {%- set next_order = 'desc' if sort == col and order == 'asc' else 'asc' -%}
+    <a href="{{ url_for('index', q=q or None, sort=col, order=next_order) }}" style="color:inherit;">{{ label }}{% if sort == col %} {{ '▲' if order == 'asc' else '▼' }}{% endif %}</a>
+  {%- endmacro %}
   <div class="card">
     <h3 style="margin-top:0;">本地 JSON 教案库（jsons/）</h3>
-    <form id="bulkExport" action="{{ url_for('export_selected') }}" method="post">
+    <form action="{{ url_for('index') }}" method="get" class="row" style="margin-bottom:.75rem;">
+      <input type="search" name="q" value="{{ q }}" placeholder="检索课题、目标、重难点、师生活动…" style="flex:1; padding:.45rem .6rem; border:1px solid #cfcfcf; border-radius:8px;">
+      <button class="btn" type="submit">检索</button>
+      {% if q %}<a class="btn light" href="{{ url_for('index') }}">清除</a>{% endif %}
+    </form>
+    <form id="bulkExport" action="{{ url_for('export_selected') }}" method="post" data-job-url="{{ url_for('create_export_job') }}"
+          data-print-url="{{ url_for('create_print_job') }}" data-printers-url="{{ url_for('printers') }}">
       <table>
         <thead>
           <tr>
             <th style="width:32px;"><input type="checkbox" onclick="toggleAll(this)"></th>
-            <th>文件名</th>
-            <th>大小</th>
-            <th>修改时间</th>
+            <th>{{ sort_link('name', '文件名') }}</th>
+            <th>教学课题</th>
+            <th>{{ sort_link('size', '大小') }}</th>
+            <th>{{ sort_link('mtime', '修改时间') }}</th>
             <th class="right">操作</th>
           </tr>
         </thead>
@@ -282,6 +2380,7 @@ INDEX_HTML = """
           <tr>
             <td><input type="checkbox" name="selected" value="{{ f.name }}"></td>
             <td>{{ f.name }}</td>
+            <td class="muted">{{ f.title }}</td>
             <td>{{ f.size }}</td>
             <td>{{ f.mtime }}</td>
             <td class="right">
@@ -292,26 +2391,42 @@ INDEX_HTML = """
           </tr>
           {% endfor %}
           {% if not files %}
-          <tr><td colspan="5" class="muted">暂无文件</td></tr>
+          <tr><td colspan="6" class="muted">{{ '没有匹配的教案' if q else '暂无文件' }}</td></tr>
           {% endif %}
         </tbody>
       </table>
-      <div class="row" style="justify-content:flex-end; margin-top:.75rem;">
+      <div class="row" style="justify-content:space-between; margin-top:.75rem;">
+        <div class="row muted">
+          共 {{ total }} 个文件，第 {{ page }}/{{ pages }} 页
+          {% if page > 1 %}<a class="btn light" href="{{ url_for('index', q=q or None, sort=sort, order=order, page=page-1) }}">上一页</a>{% endif %}
+          {% if page < pages %}<a class="btn light" href="{{ url_for('index', q=q or None, sort=sort, order=order, page=page+1) }}">下一页</a>{% endif %}
+        </div>
+        <div class="row">
         <button class="btn" name="action" value="docx" type="submit">批量导出 DOCX（ZIP）</button>
         <button class="btn light" name="action" value="json" type="submit">批量下载 JSON（ZIP）</button>
+        <button class="btn light" name="action" value="pdf" type="submit">批量导出 PDF（ZIP）</button>
+        <button class="btn light" name="action" value="merged" type="submit">合并为一个 DOCX</button>
+        <button class="btn light" type="button" onclick="startExportJob('docx')">后台导出 DOCX</button>
+        <button class="btn light" type="button" onclick="startExportJob('pdf')">后台导出 PDF</button>
+        </div>
       </div>
     </form>
-    <script>
-      function toggleAll(cb){
-        document.querySelectorAll('input[name=selected]').forEach(x=>x.checked=cb.checked);
-      }
-    </script>
+    <script src="{{ asset_url('index.js') }}"></script>
+    <p id="jobStatus" class="muted"></p>
+    <div class="row" style="margin-top:.5rem;">
+      <select id="printer" style="padding:.35rem;"><option value="">（读取打印机…）</option></select>
+      <label class="muted">份数 <input id="copies" type="number" min="1" value="1" style="width:4em;"></label>
+      <label class="muted"><input id="twoSided" type="checkbox" checked> 双面</label>
+      <button class="btn light" type="button" onclick="startPrintJob()">打印所选</button>
+    </div>
+    <ul id="printFiles" class="muted" style="font-size:14px;"></ul>
   </div>
 
   <div class="card">
     <h3 style="margin-top:0;">上传到本地库（jsons/）</h3>
+    <p class="muted" style="margin-top:0;">可多选 .json，也可上传打包好的 .zip（压缩包内任一文件不合格则整包不入库）。</p>
     <form action="{{ url_for('upload_to_lib') }}" method="post" enctype="multipart/form-data">
-      <input type="file" name="files" accept=".json" multiple required>
+      <input type="file" name="files" accept=".json,.zip" multiple required>
       <div class="row" style="justify-content:flex-end; margin-top:.75rem;">
         <button class="btn" type="submit">上传到 jsons/</button>
       </div>
@@ -321,54 +2436,51 @@ INDEX_HTML = """
 </html>
 """
 
+register_asset("index.css", INDEX_CSS)
+register_asset("index.js", INDEX_JS)
+
 # ---------------- 编辑器（沿用你前一版的 flex + 分割线 + 保存/导出按钮） ----------------
-EDITOR_HTML = """
-<!doctype html>
-<html>
-<head>
-  <meta charset="utf-8">
-  <title>英语教案编辑器</title>
-  
-  <link rel="icon" href="data:,">
-  <style>
-    :root{ --gap:14px; }
-    *{ box-sizing:border-box; }
-    body{ font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,"PingFang SC","Hiragino Sans GB","Microsoft YaHei","Helvetica Neue",Arial,sans-serif; margin:1rem auto; max-width:1100px; color:#222; }
-    .grid{ display:grid; grid-template-columns:180px 1fr; gap:10px; }
-    .card{ border:1px solid #e5e7eb; border-radius:12px; padding:1rem 1.25rem; margin:1rem 0; box-shadow:0 1px 2px rgba(0,0,0,.04); }
-    .row{ display:flex; gap:10px; align-items:center; flex-wrap:wrap; }
-    .btn{ display:inline-block; border:1px solid #111; padding:.35rem .7rem; border-radius:8px; text-decoration:none; cursor:pointer; font-size:14px; line-height:1.2; }
-    .btn.primary{ background:#111; color:#fff; }
-    .btn.primary:hover{ background:#222; }
-    .btn.secondary{ background:#fff; color:#111; }
-    .btn.secondary:hover{ background:#111; color:#fff; }
-    .btn.danger{ border-color:#b91c1c; color:#b91c1c; background:#fff; }
-    .btn.danger:hover{ background:#b91c1c; color:#fff; }
-    .btn.blue{ border-color:#0080FF; color:#0080FF; background:#fff; }
-    .btn.blue:hover{ background:#0080FF; color:#fff; }
-    input[type=text], textarea{ width:100%; padding:.55rem .65rem; border:1px solid #cfcfcf; border-radius:10px; background:#fff; }
-    textarea{ min-height:92px; resize:vertical; }
-    #board{ min-height:500px; }
-    .muted{ color:#666; }
-    .tiny{ font-size:.9rem; color:#777; }
-    .pill{ background:#f5f5f5; border-radius:999px; padding:.1rem .6rem; font-size:.85rem; }
-    .sec{ border:1px solid #e5e7eb; border-radius:12px; padding:12px; margin:.85rem 0; }
-    .sec-hdr{ display:flex; justify-content:space-between; align-items:center; gap:12px; flex-wrap:wrap; }
-    .hdr-left{ display:flex; gap:10px; align-items:center; }
-    .title{ font-weight:700; }
-    .activity-row{ display:flex; align-items:center; gap:var(--gap); padding:0.8rem 0.4rem; flex-wrap:wrap; border-bottom:1px solid #e5e7eb; border-radius:8px; }
-    .activity-row:last-child{ border-bottom:none; }
-    .activity-row .idx{ flex:0 0 36px; text-align:center; padding-top:.4rem; }
-    .activity-row .col{ flex:1 1 360px; min-width:260px; }
-    .activity-row .controls{ flex:0 0 160px; display:flex; flex-direction:column; gap:6px; }
-    .activity-row .controls .row{ display:flex; gap:8px; }
-    .activity-row .controls .row .btn{ flex:1; }
-    .activity-row:hover{ background:#f0f0f0; }
-    .fab{ position:fixed; right:24px; bottom:24px; background:#0080FF; color:#fff; border:none; border-radius:999px; padding:.9rem 1.2rem; font-size:16px; box-shadow:0 8px 24px rgba(0,0,0,.16); cursor:pointer; z-index:9999; }
-    .fab:hover{ background:#2060CF; }
-    .save{ position:fixed; right:24px; bottom:82px; background:#10b981; color:#fff; border:none; border-radius:999px; padding:.6rem 1rem; font-size:14px; box-shadow:0 8px 24px rgba(0,0,0,.16); cursor:pointer; z-index:9999; }
-    .save:hover{ background:#059669; }
-    .back {
+EDITOR_CSS = """
+:root{ --gap:14px; }
+*{ box-sizing:border-box; }
+body{ font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,"PingFang SC","Hiragino Sans GB","Microsoft YaHei","Helvetica Neue",Arial,sans-serif; margin:1rem auto; max-width:1100px; color:#222; }
+.grid{ display:grid; grid-template-columns:180px 1fr; gap:10px; }
+.card{ border:1px solid #e5e7eb; border-radius:12px; padding:1rem 1.25rem; margin:1rem 0; box-shadow:0 1px 2px rgba(0,0,0,.04); }
+.row{ display:flex; gap:10px; align-items:center; flex-wrap:wrap; }
+.btn{ display:inline-block; border:1px solid #111; padding:.35rem .7rem; border-radius:8px; text-decoration:none; cursor:pointer; font-size:14px; line-height:1.2; }
+.btn.primary{ background:#111; color:#fff; }
+.btn.primary:hover{ background:#222; }
+.btn.secondary{ background:#fff; color:#111; }
+.btn.secondary:hover{ background:#111; color:#fff; }
+.btn.danger{ border-color:#b91c1c; color:#b91c1c; background:#fff; }
+.btn.danger:hover{ background:#b91c1c; color:#fff; }
+.btn.blue{ border-color:#0080FF; color:#0080FF; background:#fff; }
+.btn.blue:hover{ background:#0080FF; color:#fff; }
+input[type=text], textarea{ width:100%; padding:.55rem .65rem; border:1px solid #cfcfcf; border-radius:10px; background:#fff; }
+textarea{ min-height:92px; resize:vertical; }
+#board{ min-height:500px; }
+.muted{ color:#666; }
+.tiny{ font-size:.9rem; color:#777; }
+.pill{ background:#f5f5f5; border-radius:999px; padding:.1rem .6rem; font-size:.85rem; }
+.sec{ border:1px solid #e5e7eb; border-radius:12px; padding:12px; margin:.85rem 0; }
+.sec-hdr{ display:flex; justify-content:space-between; align-items:center; gap:12px; flex-wrap:wrap; }
+.hdr-left{ display:flex; gap:10px; align-items:center; }
+.title{ font-weight:700; }
+.activity-row{ display:flex; align-items:center; gap:var(--gap); padding:0.8rem 0.4rem; flex-wrap:wrap; border-bottom:1px solid #e5e7eb; border-radius:8px; }
+.activity-row:last-child{ border-bottom:none; }
+.activity-row .idx{ flex:0 0 36px; text-align:center; padding-top:.4rem; }
+.activity-row .col{ flex:1 1 360px; min-width:260px; }
+.activity-row .controls{ flex:0 0 160px; display:flex; flex-direction:column; gap:6px; }
+.activity-row .controls .row{ display:flex; gap:8px; }
+.activity-row .controls .row .btn{ flex:1; }
+.activity-row:hover{ background:#f0f0f0; }
+.activity-row{ content-visibility:auto; contain-intrinsic-size:auto 140px; } /* 屏幕外的行不排版不绘制 */
+.more{ padding:.6rem; text-align:center; color:#777; }
+.fab{ position:fixed; right:24px; bottom:24px; background:#0080FF; color:#fff; border:none; border-radius:999px; padding:.9rem 1.2rem; font-size:16px; box-shadow:0 8px 24px rgba(0,0,0,.16); cursor:pointer; z-index:9999; }
+.fab:hover{ background:#2060CF; }
+.save{ position:fixed; right:24px; bottom:82px; background:#10b981; color:#fff; border:none; border-radius:999px; padding:.6rem 1rem; font-size:14px; box-shadow:0 8px 24px rgba(0,0,0,.16); cursor:pointer; z-index:9999; }
+.save:hover{ background:#059669; }
+.back {
   position: fixed;
   right: 24px;
   bottom: 128px; /* 在保存按钮(.save, bottom:82px)上方 */
@@ -383,7 +2495,209 @@ EDITOR_HTML = """
   z-index: 9999;
 }
 .back:hover { background:#e5e7eb; }
-  </style>
+"""
+
+EDITOR_JS = """
+const FIXED = [
+  "I.Warming up and Revision",
+  "II.Leading-in",
+  "Ⅲ. Listening & reading Activities",
+  "Ⅳ. Further Development",
+  "Ⅴ. Homework"
+];
+function coerceFlow(data){
+  let src = Array.isArray(data['教学流程']) ? data['教学流程'] : [];
+  const out = [];
+  for (let i=0;i<5;i++){
+    let acts=[];
+    if(i<src.length && typeof src[i]==='object' && src[i]){
+      const k0=Object.keys(src[i])[0]; const arr=src[i][k0];
+      if(Array.isArray(arr)){ acts=arr.map(x=>({tea:(x&&x.tea)||"", stu:(x&&x.stu)||""})) }
+    }
+    const o={}; o[FIXED[i]]=acts; out.push(o);
+  }
+  return out;
+}
+
+const PAGE=window.EDITOR_PAGE;
+const state = PAGE.lesson;
+state['教学课题']=state['教学课题']||"";
+state['教学目标']=state['教学目标']||"";
+state['教学重点与难点']=state['教学重点与难点']||"";
+state['教学准备']=state['教学准备']||"";
+state['板书设计']=state['板书设计']||"";
+state['教学流程']=coerceFlow(state);
+
+document.getElementById('kemu').value=state['教学课题'];
+document.getElementById('mubiao').value=state['教学目标'];
+document.getElementById('zhongdian').value=state['教学重点与难点'];
+document.getElementById('zhunbei').value=state['教学准备'];
+document.getElementById('board').value=state['板书设计'];
+
+// 活动行与 state 里的活动对象一一对应（按对象而非下标绑定），增删/上下移只改动受影响的行；
+// 很长的小节先建 CHUNK 行，滚动到附近再接着建。
+const CHUNK=100;
+const secs=[];  // 每节 {key, box, sentinel, rendered}；box 的前 rendered 个子元素依次是活动 0..rendered-1
+const lazy=('IntersectionObserver' in window) ? new IntersectionObserver(entries=>{
+  entries.forEach(e=>{ if(e.isIntersecting) renderMore(+e.target.dataset.sec, CHUNK); });
+}, {rootMargin:'800px'}) : null;
+
+function ensureActs(secObj){ const key=Object.keys(secObj)[0]; if(!Array.isArray(secObj[key])) secObj[key]=[]; return key; }
+function actsOf(i){ return state['教学流程'][i][secs[i].key]; }
+
+function makeRow(i,act){
+  const row=document.createElement('div'); row.className="activity-row";
+  row.innerHTML=`
+    <div class="idx"></div>
+    <div class="col"><div class="tiny">教师活动</div><textarea data-f="tea"></textarea></div>
+    <div class="col"><div class="tiny">学生活动</div><textarea data-f="stu"></textarea></div>
+    <div class="controls">
+      <div class="row">
+        <button class="btn secondary" data-op="up">上移</button>
+        <button class="btn secondary" data-op="down">下移</button>
+      </div>
+      <button class="btn danger" data-op="del">删除</button>
+    </div>`;
+  row.querySelectorAll('textarea').forEach(t=>{ t.value=act[t.dataset.f]||""; t.oninput=()=>{ act[t.dataset.f]=t.value; }; });
+  row.querySelectorAll('button').forEach(b=>{ b.onclick=()=>{
+    const k=actsOf(i).indexOf(act);
+    if(b.dataset.op==='del') delAct(i,k); else moveAct(i,k,b.dataset.op);
+  }; });
+  return row;
+}
+function renumber(i,from,to){
+  const s=secs[i], rows=s.box.children;
+  for(let k=from;k<Math.min(to,s.rendered);k++) rows[k].firstElementChild.textContent=(k+1)+".";
+}
+function renderMore(i,n){
+  const s=secs[i], acts=actsOf(i), from=s.rendered, end=Math.min(acts.length, from+n);
+  const frag=document.createDocumentFragment();
+  for(let k=from;k<end;k++) frag.appendChild(makeRow(i,acts[k]));
+  s.box.insertBefore(frag, s.sentinel);
+  s.rendered=end; renumber(i,from,end);
+  const left=acts.length-end;
+  s.sentinel.style.display=left>0?'':'none';
+  s.sentinel.textContent=`还有 ${left} 个活动，继续下拉加载…`;
+  if(lazy){ lazy.unobserve(s.sentinel); if(left>0) lazy.observe(s.sentinel); }  // 重新观察：哨兵仍在视口附近时会再触发一次
+}
+
+function addAct(i){
+  const acts=actsOf(i), act={tea:"",stu:""}; acts.push(act);
+  renderMore(i, acts.length);
+  const row=secs[i].box.children[acts.length-1];
+  row.scrollIntoView({block:'center'}); row.querySelector('textarea').focus();
+}
+function delAct(i,k){
+  if(!confirm("确认删除该活动？"))return;
+  const s=secs[i]; actsOf(i).splice(k,1);
+  s.box.children[k].remove(); s.rendered--;
+  renumber(i,k,s.rendered);
+}
+function moveAct(i,k,dir){
+  const s=secs[i], acts=actsOf(i), j=k+(dir==='up'?-1:1);
+  if(j<0||j>=acts.length)return;
+  if(j>=s.rendered) renderMore(i, j-s.rendered+1);
+  [acts[k],acts[j]]=[acts[j],acts[k]];
+  // 挪动相邻的那一行，被点的行留在原地（焦点不丢）
+  const rows=s.box.children, lo=Math.min(k,j), hi=Math.max(k,j);
+  if(j<k) s.box.insertBefore(rows[lo], rows[hi].nextSibling); else s.box.insertBefore(rows[hi], rows[lo]);
+  renumber(i,lo,hi+1);
+}
+
+function renderSections(){
+  const box=document.getElementById('secList'); box.innerHTML=""; secs.length=0;
+  state['教学流程'].forEach((secObj,i)=>{
+    const key=ensureActs(secObj);
+    const wrap=document.createElement('div'); wrap.className="sec";
+    const hdr=document.createElement('div'); hdr.className="sec-hdr";
+    hdr.innerHTML=`<div class="hdr-left"><span class="pill">Section ${i+1}</span><div class="title">${key}</div></div><div class="row"><button class="btn secondary blue" onclick="addAct(${i});return false;">新增活动（Create Activity）</button></div>`;
+    const list=document.createElement('div');
+    const sentinel=document.createElement('div'); sentinel.className="more"; sentinel.dataset.sec=i;
+    list.appendChild(sentinel);
+    wrap.appendChild(hdr); wrap.appendChild(list); box.appendChild(wrap);
+    secs.push({key, box:list, sentinel, rendered:0});
+    renderMore(i, lazy ? CHUNK : Infinity);
+  });
+}
+renderSections();
+
+// 增量保存：与上次保存（或打开时）的快照比较，只把改动作为 JSON Patch 发给服务端
+const PATCH_URL=PAGE.patchUrl;
+let version=PAGE.version;
+function snapshot(){
+  const o={};
+  ["教学课题","教学目标","教学重点与难点","教学准备","板书设计"].forEach(k=>{ o[k]=state[k]||""; });
+  o['教学流程']=JSON.parse(JSON.stringify(state['教学流程']));
+  return o;
+}
+let saved=snapshot();
+function ptr(...parts){ return parts.map(p=>'/'+String(p).replace(/~/g,'~0').replace(/\\//g,'~1')).join(''); }
+function sameAct(a,b){ return a.tea===b.tea && a.stu===b.stu; }
+function makePatch(prev,cur){
+  const ops=[];
+  Object.keys(cur).forEach(k=>{ if(k!=='教学流程' && prev[k]!==cur[k]) ops.push({op:'add',path:ptr(k),value:cur[k]}); });
+  cur['教学流程'].forEach((secObj,i)=>{
+    const key=Object.keys(secObj)[0], now=secObj[key], was=Object.values(prev['教学流程'][i])[0];
+    // 去掉相同的首尾，只处理中间变化的一段
+    let s=0; while(s<was.length && s<now.length && sameAct(was[s],now[s])) s++;
+    let e=0; while(e<was.length-s && e<now.length-s && sameAct(was[was.length-1-e],now[now.length-1-e])) e++;
+    const oldMid=was.length-s-e, newMid=now.length-s-e;
+    if(oldMid===newMid){
+      for(let k=s;k<s+newMid;k++) ['tea','stu'].forEach(f=>{ if(was[k][f]!==now[k][f]) ops.push({op:'replace',path:ptr('教学流程',i,key,k,f),value:now[k][f]}); });
+    }else{
+      for(let k=s+oldMid-1;k>=s;k--) ops.push({op:'remove',path:ptr('教学流程',i,key,k)});
+      for(let k=s;k<s+newMid;k++) ops.push({op:'add',path:ptr('教学流程',i,key,k),value:now[k]});
+    }
+  });
+  return ops;
+}
+function showStatus(msg,err){
+  const box=document.getElementById('saveStatus');
+  box.innerHTML=`<div style="background:${err?'#fef2f2':'#ecfdf5'};color:${err?'#991b1b':'#065f46'};border:1px solid ${err?'#fecaca':'#a7f3d0'};border-radius:10px;padding:.5rem .75rem;"></div>`;
+  box.firstChild.textContent=msg;
+  if(!err) setTimeout(()=>{ if(box.firstChild && box.firstChild.textContent===msg) box.innerHTML=""; }, 1800);
+}
+let saving=false;
+async function saveJson(){
+  if(saving) return;
+  const cur=snapshot(), ops=makePatch(saved,cur);
+  if(!ops.length){ showStatus("没有改动"); return; }
+  saving=true;
+  try{
+    const r=await fetch(PATCH_URL,{method:'PATCH',headers:{'Content-Type':'application/json-patch+json','If-Match':'"'+version+'"'},body:JSON.stringify(ops)});
+    const res=await r.json().catch(()=>({}));
+    if(r.ok){ version=res.version; saved=cur; showStatus("已保存 ✅"); }
+    else showStatus(res.error||("保存失败：HTTP "+r.status), true);
+  }catch(err){
+    showStatus("保存失败：网络错误", true);
+  }finally{
+    saving=false;
+  }
+}
+function submitDocx(){
+  const payload={
+    "教学课题":document.getElementById('kemu').value||"",
+    "教学目标":document.getElementById('mubiao').value||"",
+    "教学重点与难点":document.getElementById('zhongdian').value||"",
+    "教学准备":document.getElementById('zhunbei').value||"",
+    "教学流程":state['教学流程'],
+    "板书设计":document.getElementById('board').value||"",
+    "教学反思":""
+  };
+  document.getElementById('json_text').value=JSON.stringify(payload);
+  document.getElementById('hiddenForm').submit();
+}
+"""
+
+EDITOR_HTML = """
+<!doctype html>
+<html>
+<head>
+  <meta charset="utf-8">
+  <title>英语教案编辑器</title>
+  
+  <link rel="icon" href="data:,">
+  <link rel="stylesheet" href="{{ asset_url('editor.css') }}">
 </head>
 <body>
   <h2>英语教案编辑器</h2>
@@ -431,218 +2745,398 @@ EDITOR_HTML = """
     <input type="hidden" name="json_text" id="json_text">
     <input type="hidden" name="source_filename" id="source_filename" value="{{ filename }}">
   </form>
-  <form id="saveForm" action="{{ url_for('save_file') }}" method="post" style="display:none;">
-    <input type="hidden" name="json_text" id="save_json_text">
-    <input type="hidden" name="source_filename" id="save_source_filename" value="{{ filename }}">
-  </form>
+  <div id="saveStatus" style="position:fixed;right:24px;bottom:176px;z-index:9999;"></div>
   
  
 
 
-  <script>
-    const FIXED = [
-      "I.Warming up and Revision",
-      "II.Leading-in",
-      "Ⅲ. Listening & reading Activities",
-      "Ⅳ. Further Development",
-      "Ⅴ. Homework"
-    ];
-    function coerceFlow(data){
-      let src = Array.isArray(data['教学流程']) ? data['教学流程'] : [];
-      const out = [];
-      for (let i=0;i<5;i++){
-        let acts=[];
-        if(i<src.length && typeof src[i]==='object' && src[i]){
-          const k0=Object.keys(src[i])[0]; const arr=src[i][k0];
-          if(Array.isArray(arr)){ acts=arr.map(x=>({tea:(x&&x.tea)||"", stu:(x&&x.stu)||""})) }
-        }
-        const o={}; o[FIXED[i]]=acts; out.push(o);
-      }
-      return out;
-    }
-
-    const state = {{ json_str | safe }};
-    state['教学课题']=state['教学课题']||"";
-    state['教学目标']=state['教学目标']||"";
-    state['教学重点与难点']=state['教学重点与难点']||"";
-    state['教学准备']=state['教学准备']||"";
-    state['板书设计']=state['板书设计']||"";
-    state['教学流程']=coerceFlow(state);
-
-    document.getElementById('kemu').value=state['教学课题'];
-    document.getElementById('mubiao').value=state['教学目标'];
-    document.getElementById('zhongdian').value=state['教学重点与难点'];
-    document.getElementById('zhunbei').value=state['教学准备'];
-    document.getElementById('board').value=state['板书设计'];
-
-    function ensureActs(secObj){ const key=Object.keys(secObj)[0]; if(!Array.isArray(secObj[key])) secObj[key]=[]; return key; }
-    function addAct(i){ const sec=state['教学流程'][i]; const key=ensureActs(sec); sec[key].push({tea:"",stu:""}); renderSections(); }
-    function delAct(i,k){ const sec=state['教学流程'][i]; const key=ensureActs(sec); if(!confirm("确认删除该活动？"))return; sec[key].splice(k,1); renderSections(); }
-    function moveAct(i,k,dir){ const sec=state['教学流程'][i]; const key=ensureActs(sec); const j=k+(dir==='up'?-1:1); if(j<0||j>=sec[key].length)return; [sec[key][k],sec[key][j]]=[sec[key][j],sec[key][k]]; renderSections(); }
-    function changeTea(i,k,val){ const sec=state['教学流程'][i]; const key=ensureActs(sec); sec[key][k].tea=val; }
-    function changeStu(i,k,val){ const sec=state['教学流程'][i]; const key=ensureActs(sec); sec[key][k].stu=val; }
-
-    function renderSections(){
-      const box=document.getElementById('secList'); box.innerHTML="";
-      state['教学流程'].forEach((secObj,i)=>{
-        const key=Object.keys(secObj)[0]; const acts=secObj[key];
-        const wrap=document.createElement('div'); wrap.className="sec";
-        const hdr=document.createElement('div'); hdr.className="sec-hdr";
-        hdr.innerHTML=`<div class="hdr-left"><span class="pill">Section ${i+1}</span><div class="title">${key}</div></div><div class="row"><button class="btn secondary blue" onclick="addAct(${i});return false;">新增活动（Create Activity）</button></div>`;
-        wrap.appendChild(hdr);
-        acts.forEach((a,k)=>{
-          const row=document.createElement('div'); row.className="activity-row";
-          row.innerHTML=`
-            <div class="idx">${k+1}.</div>
-            <div class="col"><div class="tiny">教师活动</div><textarea oninput="changeTea(${i},${k}, this.value)">${(a.tea||"")}</textarea></div>
-            <div class="col"><div class="tiny">学生活动</div><textarea oninput="changeStu(${i},${k}, this.value)">${(a.stu||"")}</textarea></div>
-            <div class="controls">
-              <div class="row">
-                <button class="btn secondary" onclick="moveAct(${i},${k},'up');return false;">上移</button>
-                <button class="btn secondary" onclick="moveAct(${i},${k},'down');return false;">下移</button>
-              </div>
-              <button class="btn danger" onclick="delAct(${i},${k});return false;">删除</button>
-            </div>`;
-          wrap.appendChild(row);
-        });
-        box.appendChild(wrap);
-      });
-    }
-    renderSections();
-
-    function saveJson(){
-      const payload={
-        "教学课题":document.getElementById('kemu').value||"",
-        "教学目标":document.getElementById('mubiao').value||"",
-        "教学重点与难点":document.getElementById('zhongdian').value||"",
-        "教学准备":document.getElementById('zhunbei').value||"",
-        "教学流程":state['教学流程'],
-        "板书设计":document.getElementById('board').value||"",
-        "教学反思":""
-      };
-      document.getElementById('save_json_text').value=JSON.stringify(payload);
-      document.getElementById('saveForm').submit();
-    }
-    function submitDocx(){
-      const payload={
-        "教学课题":document.getElementById('kemu').value||"",
-        "教学目标":document.getElementById('mubiao').value||"",
-        "教学重点与难点":document.getElementById('zhongdian').value||"",
-        "教学准备":document.getElementById('zhunbei').value||"",
-        "教学流程":state['教学流程'],
-        "板书设计":document.getElementById('board').value||"",
-        "教学反思":""
-      };
-      document.getElementById('json_text').value=JSON.stringify(payload);
-      document.getElementById('hiddenForm').submit();
-    }
-  </script>
+  <script>window.EDITOR_PAGE={{ page_data }};</script>
+  <script src="{{ asset_url('editor.js') }}"></script>
   
 </body>
 </html>
 """
+
+register_asset("editor.css", EDITOR_CSS)
+register_asset("editor.js", EDITOR_JS)
+
+# ---------------- 准入控制（按路由分级限流） ----------------
+# 路由按代价分三级，各有全服务器（跨 gunicorn worker）的并发上限和有界等待队列：
+#   bulk：批量导出（ZIP / 合并 DOCX）；docx：单份渲染（行内导出、编辑页导出）；
+#   interactive：首页、检索、编辑、保存、上传、任务查询。/assets 与 /metrics 不限。
+# 重活的上限远小于 worker 线程总数（见 deploy.sh 的 gthread 配置），导出高峰时总有线程留给编辑。
+# 槽位是 ADMISSION_DIR 下的锁文件，持有某个文件的 flock 就占一个槽位（进程崩溃时内核自动释放）：
+# 运行槽位满了先占一个等待槽位再轮询，最多等 ADMISSION_WAIT 秒；等待槽位也满、或等超时，
+# 直接 503 + Retry-After，不让请求堆在 worker 里。等待者之间不保证先来先服务。
+# 流式响应（批量 ZIP）要等发送完才释放槽位。槽位 fd 不传给 exec 的子进程（O_CLOEXEC），
+# 只 fork 不 exec 的（导出进程池的 worker）在子进程里关掉，否则子进程活多久槽位就占多久。ADMISSION=0 关闭。
+ADMISSION_ENABLED = os.environ.get("ADMISSION", "1") != "0"
+ADMISSION_DIR = os.environ.get("ADMISSION_DIR", os.path.join(BASE_DIR, ".cache", "admission"))
+ADMISSION_LIMITS = {  # 级别 -> (并发上限, 等待队列长度)
+    "bulk": (int(os.environ.get("ADMISSION_BULK_LIMIT", "2")), int(os.environ.get("ADMISSION_BULK_QUEUE", "2"))),
+    "docx": (int(os.environ.get("ADMISSION_DOCX_LIMIT", "4")), int(os.environ.get("ADMISSION_DOCX_QUEUE", "8"))),
+    "interactive": (int(os.environ.get("ADMISSION_INTERACTIVE_LIMIT", "32")),
+                    int(os.environ.get("ADMISSION_INTERACTIVE_QUEUE", "64"))),
+}
+ADMISSION_WAIT = float(os.environ.get("ADMISSION_WAIT", "10"))
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", "5"))
+
+_held_slots = set()  # 本进程持有的槽位 fd
+
+def _close_inherited_slots():
+    """fork 出的子进程（导出进程池的 worker 随 submit 按需 fork，随时可能发生）关掉继承来的槽位 fd：
+    flock 要等所有指向它的 fd 都关了才释放，子进程留着一份，父进程关掉自己的也放不掉槽位。"""
+    for fd in _held_slots:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    _held_slots.clear()
+
+os.register_at_fork(after_in_child=_close_inherited_slots)
+
+def release_slot(fd: int):
+    _held_slots.discard(fd)
+    os.close(fd)
+
+def _slot_path(route_class: str, kind: str, i: int) -> str:
+    return os.path.join(ADMISSION_DIR, f"{route_class}.{kind}{i}.lock")
+
+def try_slot(route_class: str, kind: str, n: int):
+    """在 n 个槽位里找一个没人持有的，拿到返回持锁的 fd，否则 None。"""
+    start = threading.get_ident() % n if n else 0  # 各线程从不同位置试起，少撞几次
+    for k in range(n):
+        fd = os.open(_slot_path(route_class, kind, (start + k) % n), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            _held_slots.add(fd)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+    return None
+
+def admission_enter(route_class: str):
+    """返回 (运行槽位 fd, None)，或 (None, 拒绝原因 'full' / 'timeout')。"""
+    limit, queue_len = ADMISSION_LIMITS[route_class]
+    fd = try_slot(route_class, "run", limit)
+    if fd is not None:
+        return fd, None
+    waiting = try_slot(route_class, "wait", queue_len)
+    if waiting is None:
+        return None, "full"
+    t0 = time.monotonic()
+    delay = 0.01
+    try:
+        while time.monotonic() - t0 < ADMISSION_WAIT:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+            fd = try_slot(route_class, "run", limit)
+            if fd is not None:
+                observe("lesson_admission_wait_seconds", time.monotonic() - t0, route_class=route_class)
+                return fd, None
+    finally:
+        release_slot(waiting)
+    return None, "timeout"
+
+def admission_rejected(route_class: str, reason: str):
+    inc("lesson_admission_rejected_total", route_class=route_class, reason=reason)
+    msg = "服务器繁忙，请稍后重试"
+    if request.accept_mimetypes.best == "text/html":  # 浏览器表单提交/页面跳转
+        resp = Response(msg + "\n", status=503, mimetype="text/plain")
+    else:
+        resp = jsonify({"error": msg})
+        resp.status_code = 503
+    resp.headers["Retry-After"] = str(ADMISSION_RETRY_AFTER)
+    return resp
+
+def admit(route_class: str):
+    """路由装饰器：先拿到 route_class 的运行槽位再执行视图。"""
+    def deco(view):
+        if not ADMISSION_ENABLED:
+            return view
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            fd, reason = admission_enter(route_class)
+            if fd is None:
+                return admission_rejected(route_class, reason)
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except BaseException:
+                release_slot(fd)
+                raise
+            if response.direct_passthrough or not response.is_streamed:
+                release_slot(fd)  # 内容已经生成好了（send_file 的直通响应也不会触发 close 回调）
+            else:
+                response.call_on_close(lambda: release_slot(fd))
+            return response
+        return wrapper
+    return deco
+
+def admission_gauges() -> str:
+    """各级当前运行/排队的请求数（Prometheus gauge）：逐个试锁槽位文件，试到的立即放掉。"""
+    lines = []
+    for metric, kind, help_text in (("lesson_admission_inflight", "run", "正在执行的请求数"),
+                                    ("lesson_admission_queued", "wait", "排队等待槽位的请求数")):
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+        for route_class, (limit, queue_len) in ADMISSION_LIMITS.items():
+            busy = 0
+            for i in range(limit if kind == "run" else queue_len):
+                fd = os.open(_slot_path(route_class, kind, i), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    busy += 1
+                finally:
+                    os.close(fd)
+            lines.append(f'{metric}{{route_class="{route_class}"}} {busy}')
+    return "\n".join(lines) + "\n"
+
+if ADMISSION_ENABLED:
+    os.makedirs(ADMISSION_DIR, exist_ok=True)
+
 # ---------------- 路由：主页 ----------------
+# 模板只编译一次；首页 ETag 也要随样式/脚本变化
+INDEX_TEMPLATE = app.jinja_env.from_string(INDEX_HTML)
+EDITOR_TEMPLATE = app.jinja_env.from_string(EDITOR_HTML)
+INDEX_TEMPLATE_DIGEST = hashlib.sha256((INDEX_HTML + INDEX_CSS + INDEX_JS).encode("utf-8")).hexdigest()
+
+def query_library(q="", sort="name", order="asc", page=1):
+    """按检索词/排序/分页查询索引；返回 (rows, total, page, pages)。"""
+    where, params = search_clause(q)
+    with index_db() as conn:
+        reconcile_index(conn)
+        total = conn.execute(f"SELECT COUNT(*) FROM lessons {where}", params).fetchone()[0]
+        pages = max((total + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+        page = min(page, pages)
+        rows = conn.execute(
+            f"SELECT name, size, mtime_ns, title FROM lessons {where} ORDER BY {SORT_COLUMNS[sort]} {order}, name LIMIT ? OFFSET ?",
+            params + [PAGE_SIZE, (page - 1) * PAGE_SIZE],
+        ).fetchall()
+    return rows, total, page, pages
+
+def listing_args():
+    sort = request.args.get("sort", "name")
+    if sort not in SORT_COLUMNS:
+        sort = "name"
+    order = "desc" if request.args.get("order") == "desc" else "asc"
+    page = max(request.args.get("page", 1, type=int), 1)
+    return request.args.get("q", "").strip(), sort, order, page
+
 @app.route("/", methods=["GET"])
+@admit("interactive")
 def index():
-    files = []
-    for name in sorted(os.listdir(LIB_DIR)):
-        if not name.lower().endswith(".json"): continue
-        p = os.path.join(LIB_DIR, name)
-        st = os.stat(p)
-        files.append({
-            "name": name,
-            "size": human_size(st.st_size),
-            "mtime": datetime.datetime.fromtimestamp(st.st_mtime).strftime("%Y-%m-%d %H:%M"),
-        })
-    return render_template_string(INDEX_HTML, files=files)
-
-# 上传到库（仅保存到 jsons/，名称冲突自动 “（n）”）
+    q, sort, order, page = listing_args()
+    rows, total, page, pages = query_library(q, sort, order, page)
+    # 有待显示的 flash 消息时页面内容不只取决于列表，不走 304
+    etag = None
+    if not session.get("_flashes"):
+        etag = hashlib.sha256(repr((INDEX_TEMPLATE_DIGEST, q, sort, order, page, pages, total, rows)).encode("utf-8")).hexdigest()
+        if request.if_none_match.contains_weak(etag):  # 压缩后的响应带弱 ETag
+            return with_validators(Response(status=304), etag)
+    files = [{
+        "name": name,
+        "title": title,
+        "size": human_size(size),
+        "mtime": datetime.datetime.fromtimestamp(mtime_ns / 1e9).strftime("%Y-%m-%d %H:%M"),
+    } for name, size, mtime_ns, title in rows]
+    resp = Response(render_template(INDEX_TEMPLATE, files=files, total=total, page=page, pages=pages, sort=sort, order=order, q=q))
+    return with_validators(resp, etag) if etag else resp
+
+# 页面 CSS/JS（指纹文件名，长缓存）
+@app.route("/assets/<name>", methods=["GET"])
+def asset(name):
+    if name not in _assets:
+        return Response("not found\n", status=404, mimetype="text/plain")
+    body, gz, mimetype = _assets[name]
+    resp = Response(body, mimetype=mimetype)
+    if "gzip" in request.accept_encodings:
+        resp.set_data(gz)
+        resp.headers["Content-Encoding"] = "gzip"
+    resp.vary.add("Accept-Encoding")
+    resp.cache_control.public = True
+    resp.cache_control.max_age = ASSET_MAX_AGE
+    resp.cache_control.immutable = True
+    return resp
+
+# 全文检索（JSON）
+@app.route("/search", methods=["GET"])
+@admit("interactive")
+def search():
+    q, sort, order, page = listing_args()
+    rows, total, page, pages = query_library(q, sort, order, page)
+    return jsonify({
+        "q": q, "total": total, "page": page, "pages": pages,
+        "results": [{"name": name, "title": title, "size": size, "mtime_ns": mtime_ns}
+                    for name, size, mtime_ns, title in rows],
+    })
+
+# 上传到库（仅保存到 jsons/，内容重复跳过，名称冲突自动 “（n）”；.zip 先整体校验再入库）
 @app.route("/upload_to_lib", methods=["POST"])
+@admit("interactive")
 def upload_to_lib():
-    files = request.files.getlist("files")
-    cnt = 0
-    for f in files:
-        if not f or not f.filename.lower().endswith(".json"):  # 仅 JSON
-            continue
-        name = os.path.basename(f.filename)  # 保留中文/空格
-        path = lib_path(name)
-        if not path:
-            # 非法名或越界，跳过
+    items, outcomes, rejected = [], [], []
+    for f in request.files.getlist("files"):
+        if not f or not f.filename:
             continue
-        # 冲突处理
-        if os.path.exists(path):
-            name = next_conflict_name(name)
-            path = lib_path(name)
-        f.save(path)
-        cnt += 1
-    flash(f"已上传 {cnt} 个文件到 jsons/", "ok" if cnt else "err")
+        if f.filename.lower().endswith(".zip"):
+            errors, zip_outcomes = import_lesson_zip(f.stream)
+            outcomes += zip_outcomes
+            rejected += [{"archive": f.filename, "file": name, "error": err} for name, err in errors]
+        else:
+            items.append((f.filename, f.read()))
+    outcomes = import_lessons(items) + outcomes
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({"outcomes": outcomes, "rejected": rejected})
+    if outcomes or not rejected:
+        flash_import_outcomes(outcomes)
+    for r in rejected[:20]:
+        flash(f"{r['archive']} 未入库：{r['file'] + '：' if r['file'] else ''}{r['error']}", "err")
     return redirect(url_for("index"))
 
 # 下载单个 JSON
 @app.route("/download_json/<path:name>", methods=["GET"])
+@admit("interactive")
 def download_json(name):
-    path = lib_path(name)
-    if not path or not os.path.isfile(path):
+    name = existing_lesson(name)
+    if not name:
         flash("文件不存在", "err"); return redirect(url_for("index"))
-    return send_file(path, as_attachment=True, download_name=os.path.basename(path), mimetype="application/json")
+    st, sha, _ = lib_file_meta(name)
+    last_modified = lesson_mtime(st)
+    resp = not_modified(sha, last_modified)
+    if resp:
+        return resp
+    _, raw = lesson_store().read(name)
+    return with_validators(send_file(io.BytesIO(raw), as_attachment=True, download_name=name,
+                                     mimetype="application/json", etag=False, conditional=False),
+                           sha, last_modified)
+
+def existing_lesson(name: str):
+    """校验名字并确认库里有这份教案；返回名字，否则 None。"""
+    name = lesson_name(name)
+    return name if name and lesson_store().stat(name) is not None else None
 
-# 选中项导出（DOCX 或 JSON ZIP）
+def lesson_mtime(st: LessonStat) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(st.mtime_ns / 1e9, datetime.timezone.utc)
+
+def selected_lib_names(selected):
+    return [name for name in map(existing_lesson, selected) if name]
+
+# 选中项导出（DOCX / JSON / PDF 的 ZIP，或合并成一个 DOCX）
 @app.route("/export_selected", methods=["POST"])
+@admit("bulk")
 def export_selected():
     selected = request.form.getlist("selected")
-    action = request.form.get("action")  # 'docx' or 'json'
+    action = request.form.get("action")  # 'docx' / 'json' / 'pdf' / 'merged'
     if not selected:
         flash("请至少勾选一个文件", "err")
         return redirect(url_for("index"))
+    if action == "pdf" and not SOFFICE:
+        flash("服务器未安装 LibreOffice，无法导出 PDF", "err")
+        return redirect(url_for("index"))
 
-    mem = io.BytesIO()
-    with zipfile.ZipFile(mem, "w", zipfile.ZIP_DEFLATED) as zf:
-        for name in selected:
-            path = lib_path(name)
-            if not path or not os.path.isfile(path):
-                continue
-            if action == "json":
-                zf.write(path, arcname=os.path.basename(path))
-            else:
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                data["教学流程"] = coerce_to_fixed_flow(data)
-                doc_bytes = json_to_docx_bytes(data, docx_name_hint=os.path.splitext(os.path.basename(path))[0])
-                zf.writestr(os.path.splitext(os.path.basename(path))[0] + ".docx", doc_bytes)
-    mem.seek(0)
-    suffix = "docx" if action=="docx" else "json"
-    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    return send_file(mem, as_attachment=True, download_name=f"export_{suffix}_{stamp}.zip", mimetype="application/zip")
+    names = selected_lib_names(selected)
+    if action == "merged":
+        return send_file(io.BytesIO(merged_docx_bytes(names)), as_attachment=True, download_name=merged_docx_name(),
+                         mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+    # 先取出第一块再发响应头：第一份就渲染失败时还能照常报错，而不是发出一个 200 的坏压缩包
+    chunks = stream_zip(export_entries(names, action), error_entry=STREAM_ERROR_ENTRY)
+    try:
+        first = next(chunks)
+    except Exception as e:
+        app.logger.exception("导出失败")
+        flash(f"导出失败：{e}", "err")
+        return redirect(url_for("index"))
+    return Response(itertools.chain([first], chunks), mimetype="application/zip",
+                    headers={"Content-Disposition": f"attachment; filename={export_archive_name(action)}"})
+
+# 后台导出：提交任务，返回任务号
+@app.route("/export_jobs", methods=["POST"])
+@admit("interactive")
+def create_export_job():
+    selected = request.form.getlist("selected")
+    action = request.form.get("action")
+    if not selected:
+        return jsonify({"error": "请至少勾选一个文件"}), 400
+    if action == "pdf" and not SOFFICE:
+        return jsonify({"error": "服务器未安装 LibreOffice，无法导出 PDF"}), 400
+    job = submit_export_job(selected_lib_names(selected), action)
+    return jsonify(job_view(job)), 202
+
+# 打印所选：渲染 → PDF → 送打印机（进度同样用 /export_jobs/<id> 查询）
+@app.route("/print_jobs", methods=["POST"])
+@admit("interactive")
+def create_print_job():
+    selected = request.form.getlist("selected")
+    printer = request.form.get("printer", "").strip()
+    if not selected:
+        return jsonify({"error": "请至少勾选一个文件"}), 400
+    if not SOFFICE:
+        return jsonify({"error": "服务器未安装 LibreOffice，无法转换 PDF"}), 400
+    if printer not in {p["name"] for p in printing.discover_printers()}:
+        return jsonify({"error": f"找不到打印机：{printer}"}), 400
+    copies = max(request.form.get("copies", 1, type=int), 1)
+    two_sided = request.form.get("two_sided", "1") != "0"
+    job = submit_print_job(selected_lib_names(selected), printer, copies, two_sided)
+    return jsonify(job_view(job)), 202
+
+# 后台导出：进度
+@app.route("/export_jobs/<job_id>", methods=["GET"])
+@admit("interactive")
+def export_job_status(job_id):
+    expire_export_jobs(force=False)
+    job = read_export_job(job_id)
+    if not job:
+        return jsonify({"error": "任务不存在或已过期"}), 404
+    return jsonify(job_view(job))
+
+# 后台导出：下载结果
+@app.route("/export_jobs/<job_id>/download", methods=["GET"])
+@admit("interactive")
+def export_job_download(job_id):
+    expire_export_jobs(force=False)
+    job = read_export_job(job_id)
+    if not job or job["state"] != "done" or job["action"] == "print":
+        flash("导出任务不存在、未完成或已过期", "err"); return redirect(url_for("index"))
+    return send_file(os.path.join(EXPORT_JOBS_DIR, job_id, "archive.zip"), as_attachment=True,
+                     download_name=job["download_name"], mimetype="application/zip")
 
 # 行内一键导出 DOCX
 @app.route("/export_one_docx/<path:name>", methods=["GET"])
+@admit("docx")
 def export_one_docx(name):
-    path = lib_path(name)
-    if not path or not os.path.isfile(path):
+    name = existing_lesson(name)
+    if not name:
         flash("文件不存在", "err"); return redirect(url_for("index"))
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    data["教学流程"] = coerce_to_fixed_flow(data)
-    doc_bytes = json_to_docx_bytes(data, docx_name_hint=os.path.splitext(os.path.basename(path))[0])
-    return send_file(io.BytesIO(doc_bytes), as_attachment=True,
-                     download_name=os.path.splitext(os.path.basename(path))[0] + ".docx",
+    st, _, digest = lib_file_meta(name)
+    etag = docx_key(digest) if digest else None
+    last_modified = lesson_mtime(st)
+    if etag:
+        resp = not_modified(etag, last_modified)
+        if resp:
+            return resp
+    doc_bytes = (docx_cache_get(etag) if etag else None) or render_lib_file(name)
+    resp = send_file(io.BytesIO(doc_bytes), as_attachment=True,
+                     download_name=os.path.splitext(name)[0] + ".docx",
                      mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+    return with_validators(resp, etag, last_modified) if etag else resp
 
 # 打开编辑器
 @app.route("/edit_file/<path:name>", methods=["GET"])
+@admit("interactive")
 def edit_file(name):
-    path = lib_path(name)
-    if not path or not os.path.isfile(path):
+    name = existing_lesson(name)
+    if not name:
         flash("文件不存在", "err"); return redirect(url_for("index"))
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    data = dict(data or {})
-    data["教学流程"] = coerce_to_fixed_flow(data)
+    data = load_lesson(name)
+    _, version, _ = lib_file_meta(name)
     # 这里把完整 HTML 送出（你的 EDITOR_HTML 需替换为前面确认的版本）
-    return render_template_string(EDITOR_HTML, json_str=json.dumps(data, ensure_ascii=False), filename=os.path.basename(path))
+    page_data = {"lesson": data, "version": version, "patchUrl": url_for("patch_file", name=name)}
+    return render_template(EDITOR_TEMPLATE, page_data=script_json(page_data), filename=name)
 
 # 保存回库文件
 @app.route("/save_file", methods=["POST"])
+@admit("interactive")
 def save_file():
     text = request.form.get("json_text", "").strip()
     name = request.form.get("source_filename", "").strip()
@@ -655,8 +3149,7 @@ def save_file():
             return redirect(url_for("edit_file", name=name, saved=int(error_msg is None)))
         return redirect(url_for("index"))
 
-    path = lib_path(name)
-    if not path or not os.path.isfile(path):
+    if not existing_lesson(name):
         return back_to_editor("保存失败：文件名非法或文件不存在")
 
     if not text:
@@ -667,15 +3160,41 @@ def save_file():
     except Exception as e:
         return back_to_editor(f"保存失败：JSON 解析错误：{e}")
 
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    lesson_store().write(name, json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"))
+    lesson_cache_forget(name)
+    index_update(name)
 
-    flash(f"已保存到 jsons/{os.path.basename(path)}", "ok")
-    return redirect(url_for("edit_file", name=os.path.basename(path), saved=1))
+    flash(f"已保存到 jsons/{name}", "ok")
+    return redirect(url_for("edit_file", name=name, saved=1))
+
+
+# 增量保存：body 为 JSON Patch，If-Match 为打开编辑器时的版本
+@app.route("/lesson/<path:name>", methods=["PATCH"])
+@admit("interactive")
+def patch_file(name):
+    name = existing_lesson(name)
+    if not name:
+        return jsonify({"error": "文件名非法或文件不存在"}), 404
+    if not request.if_match or request.if_match.star_tag:
+        return jsonify({"error": "缺少 If-Match 版本"}), 428
+    ops = request.get_json(force=True, silent=True)
+    if ops is None:
+        return jsonify({"error": "补丁不是合法 JSON"}), 400
+    expected = next(iter(request.if_match.as_set()), "")
+    try:
+        version = patch_lesson_file(name, expected, ops)
+    except PatchError as e:
+        return jsonify({"error": f"补丁无法应用：{e}"}), 422
+    if not version:
+        return jsonify({"error": "文件已被其他人修改，请刷新后再编辑"}), 412
+    resp = jsonify({"version": version})
+    resp.set_etag(version)
+    return resp
 
 
 # 从编辑页导出 DOCX
 @app.route("/generate_from_editor", methods=["POST"])
+@admit("docx")
 def generate_from_editor():
     text = request.form.get("json_text", "").strip()
     name = request.form.get("source_filename", "edited.json").strip() or "edited.json"
@@ -688,11 +3207,12 @@ def generate_from_editor():
     if not text:
         return back_with_error("没有收到 JSON 内容")
     try:
-        data = json.loads(text)
+        with span("json_parse"):
+            data = json.loads(text)
     except Exception as e:
         return back_with_error(f"JSON 解析失败：{e}")
 
-    doc_bytes = json_to_docx_bytes(data, docx_name_hint=os.path.splitext(name)[0])
+    doc_bytes = render_docx_cached(data, docx_name_hint=os.path.splitext(name)[0])
     return send_file(
         io.BytesIO(doc_bytes),
         as_attachment=True,
@@ -701,6 +3221,94 @@ def generate_from_editor():
     )
 
 
+# 打印机列表（JSON；结果在 print.py 里按 TTL 缓存，?refresh=1 强制重新探测）
+@app.route("/printers", methods=["GET"])
+@admit("interactive")
+def printers():
+    return jsonify({"printers": printing.discover_printers(refresh=request.args.get("refresh") == "1")})
+
+
+# ---------------- 指标：阶段计时、路由钩子、/metrics ----------------
+if METRICS_ENABLED:
+    load_lesson = timed("lesson_load")(load_lesson)          # 读文件 + json 解析 + 规范化
+    new_lesson_document = timed("docx_clone")(new_lesson_document)
+    fill_lesson_table = timed("docx_table")(fill_lesson_table)  # 含流程行与边框（边框已在原型行上）
+    save_docx = timed("docx_save")(save_docx)
+    json_to_ooxml_bytes = timed("ooxml_render")(json_to_ooxml_bytes)
+    merged_docx_bytes = timed("docx_merge")(merged_docx_bytes)
+
+    @app.before_request
+    def _metrics_start():
+        g.metrics_t0 = time.perf_counter()
+
+    @app.after_request
+    def _metrics_finish(response):
+        route = request.endpoint or "unknown"
+        t0 = g.get("metrics_t0", time.perf_counter())
+        sent = [response.content_length or 0]
+
+        if response.content_length is None and response.is_streamed:
+            body = response.response
+            def counting():
+                for chunk in body:
+                    sent[0] += len(chunk)
+                    yield chunk
+            response.response = counting()
+
+        def done():
+            observe("lesson_http_request_seconds", time.perf_counter() - t0, route=route)
+            inc("lesson_http_requests_total", route=route, status=response.status_code)
+            inc("lesson_http_response_bytes_total", sent[0], route=route)
+        if response.direct_passthrough:
+            done()  # send_file 的文件直通响应不会触发 close 回调
+        else:
+            response.call_on_close(done)
+        return response
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    if not METRICS_ENABLED:
+        return Response("metrics disabled\n", status=404, mimetype="text/plain")
+    metrics_flush()
+    body = render_metrics() + (admission_gauges() if ADMISSION_ENABLED else "")
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+# ---------------- HTML 压缩 ----------------
+# 放在指标钩子之后注册（after_request 逆序执行），指标记的是压缩后的字节数。
+GZIP_MIN_BYTES = 1024
+
+@app.after_request
+def gzip_html(response):
+    if (response.mimetype != "text/html" or response.status_code != 200 or response.direct_passthrough
+            or response.is_streamed or "Content-Encoding" in response.headers
+            or "gzip" not in request.accept_encodings):
+        return response
+    body = response.get_data()
+    if len(body) < GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(body, 6))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)  # 字节变了，强 ETag 不再成立
+    return response
+
+
+# ---------------- 预热（gunicorn --preload） ----------------
+# 带 --preload 启动时 wsgi.py 在 master 里调用 warm_up()：导入文档栈、构建两种骨架模板，
+# 再 gc.freeze() 把这些对象移出 GC 追踪（否则 GC 扫描会弄脏页面，破坏写时复制）。
+# 之后 fork 出的 worker（包括按 max-requests 回收后重生的）直接共享，首个导出请求不再多等。
+# 不带 --preload 时什么都不做，文档栈仍在各 worker 首次用到时才加载。
+def warm_up():
+    lesson_store()  # 打包存储：偏移索引在 master 里建好，worker 直接继承
+    load_docx_stack()
+    lesson_skeleton()
+    ooxml_template()
+    gc.freeze()
+
+
 if __name__ == "__main__":
     # python app.py
     app.run(host="0.0.0.0", port=5001, debug=True)
@@ -0,0 +1,258 @@
+# bench.py — 渲染/导出热点基准
+# 用法：
+#   python bench.py                                  # 全部用例，结果写 bench_results.json
+#   python bench.py --only docx,coerce --acts 1,50,300
+#   python bench.py --baseline old.json --threshold 0.2
+#       与上次结果比较，中位数变慢超过 20% 记为回退，退出码 1
+#   python bench.py --only export_parallel --files 48 --workers 2,4,8
+#   python bench.py --only startup       # 新 worker 的启动代价（按需导入 vs 预热）
+#   python bench.py --only store --library 10000   # 教案存储：目录 vs 打包文件
+import os, sys, json, time, shutil, atexit, tempfile, argparse, platform, statistics, datetime, subprocess
+
+os.environ.setdefault("DOCX_CACHE_MAX_BYTES", "0")  # 测渲染本身，不走磁盘缓存
+_tmp = tempfile.mkdtemp(prefix="bench_")
+atexit.register(shutil.rmtree, _tmp, True)
+os.environ.setdefault("LIB_INDEX_DB", os.path.join(_tmp, "library.sqlite3"))
+import app
+
+ZH = "能听懂、会说、会读与学校场所相关的词汇，并能在真实情境中运用句型进行交流。"
+EN = "Students look at the pictures, listen to the tape and answer: What can you see? "
+
+def make_text(n: int, i: int = 0) -> str:
+    """长度约 n 的中英混排文本。"""
+    s = f"{i}. " + (ZH + EN) * (n // (len(ZH) + len(EN)) + 1)
+    return s[:max(n, 1)]
+
+def make_lesson(i: int, acts: int, text_len: int = 60) -> dict:
+    """合成一份教案：5 个小节，每节 acts 个活动，每段活动文字约 text_len 字。"""
+    return {
+        "教学课题": f"Unit {i} Synthetic Lesson",
+        "教学目标": make_text(text_len * 3, i),
+        "教学重点与难点": make_text(text_len * 2, i),
+        "教学准备": "computer, Cards, Picture, ppt",
+        "教学流程": [
+            {title: [{"tea": make_text(text_len, k), "stu": make_text(text_len, k + 1)} for k in range(acts)]}
+            for title in app.FIXED_TITLES
+        ],
+        "板书设计": "Unit {}\nI like ...\nI love ...".format(i),
+    }
+
+def write_library(folder: str, files: int, acts: int, text_len: int = 60):
+    """在 folder 里写 files 份教案，返回库内名字。"""
+    names = []
+    for i in range(files):
+        name = f"Unit {i}.json"
+        with open(os.path.join(folder, name), "w", encoding="utf-8") as f:
+            json.dump(make_lesson(i, acts, text_len), f, ensure_ascii=False)
+        names.append(name)
+    return names
+
+def use_library(folder: str):
+    """切换库目录；进程池的子进程是按旧目录 fork 的，一并丢掉。"""
+    app.LIB_DIR = folder
+    if app._export_pool is not None:
+        app._export_pool.shutdown()
+        app._export_pool = None
+
+def timeit(fn, repeat: int):
+    """调用 repeat 次，返回 {median, min, runs}（秒）。"""
+    samples = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return {"median": statistics.median(samples), "min": min(samples), "runs": repeat}
+
+# ---------------- 用例 ----------------
+def case_coerce(args, out):
+    for acts in args.acts:
+        data = make_lesson(0, acts, args.text_len)
+        out[f"coerce[acts={acts}]"] = timeit(lambda: app.coerce_to_fixed_flow(data), args.repeat * 10)
+
+def case_docx(args, out):
+    """python-docx 引擎按阶段拆开：克隆骨架 / 填表（含流程行与边框）/ doc.save；另测直写引擎。"""
+    app.lesson_skeleton(); app.ooxml_template()  # 预热
+    for acts in args.acts:
+        data = make_lesson(0, acts, args.text_len)
+        docs = []
+        out[f"docx.clone[acts={acts}]"] = timeit(lambda: docs.append(app.new_lesson_document()), args.repeat)
+        filled = iter(docs)
+        out[f"docx.table[acts={acts}]"] = timeit(lambda: app.fill_lesson_table(next(filled), data), args.repeat)
+        saved = iter(docs)
+        out[f"docx.save[acts={acts}]"] = timeit(lambda: app.save_docx(next(saved)), args.repeat)
+        out[f"docx.total[acts={acts}]"] = timeit(lambda: app.json_to_docx_bytes(data), args.repeat)
+        out[f"ooxml.total[acts={acts}]"] = timeit(lambda: app.json_to_ooxml_bytes(data), args.repeat)
+
+def case_export(args, out):
+    """export_selected 整个请求（含流式 ZIP / 合并 DOCX），N 个文件。"""
+    client = app.app.test_client()
+    with tempfile.TemporaryDirectory() as folder:
+        use_library(folder)
+        names = write_library(folder, args.files, args.acts[0], args.text_len)
+        for action in ("docx", "json", "merged"):
+            def run():
+                # 流式响应要 close 才会释放准入槽位
+                with client.post("/export_selected", data={"selected": names, "action": action}) as r:
+                    assert r.status_code == 200 and r.data
+            out[f"export_selected.{action}[files={args.files}]"] = timeit(run, max(args.repeat // 2, 1))
+
+def case_export_parallel(args, out):
+    """批量渲染：串行 vs 进程池（--workers 可给多个，如 2,4,8，看加速比随进程数的变化）。"""
+    def run(names, workers):
+        app.EXPORT_WORKERS = workers
+        app.EXPORT_MAX_INFLIGHT = workers * 2
+        for _ in app.iter_rendered_docx(names):
+            pass
+    with tempfile.TemporaryDirectory() as folder:
+        use_library(folder)
+        names = write_library(folder, args.files, args.acts[0], args.text_len)
+        app.render_lib_file(names[0])
+        out[f"export_parallel.serial[files={args.files}]"] = timeit(lambda: run(names, 1), 1)
+        serial = out[f"export_parallel.serial[files={args.files}]"]["median"]
+        for workers in args.workers:
+            if workers <= 1:
+                continue
+            use_library(folder)  # 每个进程数各用一个新池
+            run(names[:workers], workers)  # 预热进程池
+            r = out[f"export_parallel.workers={workers}[files={args.files}]"] = timeit(lambda: run(names, workers), 1)
+            print(f"  workers={workers}: 加速 {serial / r['median']:.2f}x（可用 CPU {app.usable_cpus()} 个）")
+
+def case_index(args, out):
+    """首页：库里 args.library 个文件；首次（建索引）与之后（目录未变）分开计。"""
+    client = app.app.test_client()
+    with tempfile.TemporaryDirectory() as folder:
+        use_library(folder)
+        lesson = json.dumps(make_lesson(0, 3, 20), ensure_ascii=False)
+        for i in range(args.library):
+            with open(os.path.join(folder, f"Unit {i:05d}.json"), "w", encoding="utf-8") as f:
+                f.write(lesson)
+        def run():
+            with client.get("/", query_string={"page": 3, "sort": "mtime", "order": "desc"}) as r:
+                assert r.status_code == 200
+        out[f"index.cold[library={args.library}]"] = timeit(run, 1)
+        out[f"index.warm[library={args.library}]"] = timeit(run, args.repeat)
+
+STARTUP_SNIPPET = """
+import json, sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+if sys.argv[1] == "warm":
+    app.warm_up()
+t2 = time.perf_counter()
+app.LIB_DIR = sys.argv[2]
+assert app.app.test_client().get("/").status_code == 200
+t3 = time.perf_counter()
+app.render_docx(json.loads(sys.argv[3]))
+t4 = time.perf_counter()
+print(json.dumps({"import": t1 - t0, "warm_up": t2 - t1, "first_index": t3 - t2, "first_docx": t4 - t3}))
+"""
+
+def case_startup(args, out):
+    """每次起一个新解释器：导入 app、（预热）、首个首页请求、首个 DOCX 渲染。
+    lazy 是不带 --preload 的 worker（各阶段都由 worker 自己付）；
+    warm 模式下 import + warm_up 在 gunicorn master 里只付一次，fork 出的 worker 只付 first_*。"""
+    lesson = json.dumps(make_lesson(0, 3, args.text_len), ensure_ascii=False)
+    with tempfile.TemporaryDirectory() as folder:
+        write_library(folder, 20, 3, 20)
+        for mode in ("lazy", "warm"):
+            samples = []
+            for _ in range(args.repeat):
+                r = subprocess.run([sys.executable, "-c", STARTUP_SNIPPET, mode, folder, lesson],
+                                   cwd=os.path.dirname(os.path.abspath(app.__file__)),
+                                   capture_output=True, text=True, check=True)
+                samples.append(json.loads(r.stdout.strip().splitlines()[-1]))
+            for stage in samples[0]:
+                if mode == "lazy" and stage == "warm_up":
+                    continue
+                xs = [x[stage] for x in samples]
+                out[f"startup.{mode}.{stage}"] = {"median": statistics.median(xs), "min": min(xs), "runs": len(xs)}
+
+def case_store(args, out):
+    """教案存储，库里 args.library 份：列目录/扫索引（scan）、整库批量读（iter_read）、逐份 read；
+    打包文件另计打开（从头建偏移索引）。"""
+    with tempfile.TemporaryDirectory() as folder:
+        use_library(folder)
+        lesson = json.dumps(make_lesson(0, 3, 20), ensure_ascii=False).encode("utf-8")
+        names = [f"Unit {i:05d}.json" for i in range(args.library)]
+        dir_store = app.DirStore()
+        for name in names:
+            dir_store.write(name, lesson)
+        pack_path = os.path.join(folder, "library.pack")
+        pack_store = app.PackStore(pack_path)  # 首次打开时从目录导入
+        out[f"store.pack.open[library={args.library}]"] = timeit(lambda: app.PackStore(pack_path).scan(), args.repeat)
+        for store in (dir_store, pack_store):
+            tag = f"store.{store.kind}"
+            out[f"{tag}.scan[library={args.library}]"] = timeit(lambda: list(store.scan()), args.repeat)
+            out[f"{tag}.iter_read[library={args.library}]"] = timeit(lambda: sum(1 for _ in store.iter_read(names)), args.repeat)
+            out[f"{tag}.read[library={args.library}]"] = timeit(lambda: [store.read(n) for n in names], args.repeat)
+
+CASES = {
+    "coerce": case_coerce,
+    "docx": case_docx,
+    "export": case_export,
+    "export_parallel": case_export_parallel,
+    "index": case_index,
+    "startup": case_startup,
+    "store": case_store,
+}
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """返回回退列表 [(用例, 旧中位数, 新中位数, 比值)]。"""
+    regressions = []
+    for key, cur in results.items():
+        old = baseline.get(key)
+        if not old:
+            continue
+        ratio = cur["median"] / old["median"] if old["median"] else float("inf")
+        if ratio > 1 + threshold:
+            regressions.append((key, old["median"], cur["median"], ratio))
+    return regressions
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--only", default=",".join(CASES), help="逗号分隔的用例名：" + ",".join(CASES))
+    ap.add_argument("--acts", default="1,10,100,300", help="每节活动数，逗号分隔")
+    ap.add_argument("--text-len", type=int, default=60, help="每段活动文字长度")
+    ap.add_argument("--files", type=int, default=48, help="批量导出的文件数")
+    ap.add_argument("--library", type=int, default=10000, help="首页用例的库大小")
+    ap.add_argument("--workers", default=str(app.usable_cpus()), help="进程池大小，逗号分隔")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--out", default="bench_results.json")
+    ap.add_argument("--baseline", help="上次的结果文件")
+    ap.add_argument("--threshold", type=float, default=0.2, help="允许的变慢比例")
+    args = ap.parse_args()
+    args.acts = [int(x) for x in args.acts.split(",") if x]
+    args.workers = [int(x) for x in args.workers.split(",") if x]
+
+    results = {}
+    for name in [x for x in args.only.split(",") if x]:
+        t = time.perf_counter()
+        CASES[name](args, results)
+        print(f"[{name}] {time.perf_counter() - t:.1f}s")
+    for key, r in results.items():
+        print(f"  {key:<45} median {r['median']*1000:10.2f} ms   min {r['min']*1000:10.2f} ms")
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump({
+            "meta": {
+                "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "usable_cpus": app.usable_cpus(),
+                "engine": app.DOCX_ENGINE,
+            },
+            "results": results,
+        }, f, ensure_ascii=False, indent=2)
+    print("结果已写入", args.out)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for key, old, new, ratio in regressions:
+            print(f"❌ 回退 {key}: {old*1000:.2f} ms → {new*1000:.2f} ms（{ratio:.2f}x）")
+        if regressions:
+            sys.exit(1)
+        print(f"✅ 无超过 {args.threshold:.0%} 的回退")
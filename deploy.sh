@@ -9,13 +9,20 @@ PYTHON_BIN="python3"              # Ubuntu22.04 自带 python3
 PORT="9003"
 SERVICE_NAME="teachingscript.service"
 WORKERS="3"
+THREADS="8"                       # 每个 worker 的请求线程数（gthread）
 TIMEOUT="120"                     # gunicorn 超时时间
 UFW_OPEN_PORT="true"              # 系统启用 ufw 时，是否自动放行 9003 端口
+INSTALL_LIBREOFFICE="true"        # PDF 导出：安装 headless LibreOffice、python3-uno 与中文字体
 
 echo "==> 检查/安装基础依赖..."
 export DEBIAN_FRONTEND=noninteractive
 apt-get update -y
 apt-get install -y git ${PYTHON_BIN} python3-venv python3-pip
+VENV_OPTS=""
+if [ "${INSTALL_LIBREOFFICE}" = "true" ]; then
+  apt-get install -y libreoffice-writer-nogui python3-uno fonts-noto-cjk
+  VENV_OPTS="--system-site-packages"   # 让 venv 能 import uno（常驻转换进程）；没有时退化为逐份 soffice --convert-to
+fi
 
 # 创建系统用户（不可登录）
 if ! id -u "${APP_USER}" >/dev/null 2>&1; then
@@ -42,7 +49,7 @@ fi
 # Python 虚拟环境与依赖
 echo "==> 创建/更新虚拟环境并安装依赖"
 if [ ! -d "${APP_DIR}/venv" ]; then
-  sudo -u "${APP_USER}" ${PYTHON_BIN} -m venv "${APP_DIR}/venv"
+  sudo -u "${APP_USER}" ${PYTHON_BIN} -m venv ${VENV_OPTS} "${APP_DIR}/venv"
 fi
 # 升级 pip
 sudo -u "${APP_USER}" "${APP_DIR}/venv/bin/pip" install --upgrade pip wheel setuptools
@@ -70,11 +77,26 @@ Group=${APP_USER}
 WorkingDirectory=${APP_DIR}
 Environment=PYTHONUNBUFFERED=1
 # 如需传参给应用，可在此处添加：Environment=PORT=${PORT}
+# 批量导出可改用直写 OOXML 引擎：Environment=DOCX_ENGINE=ooxml
+# 关闭 /metrics 指标采集：Environment=METRICS=0（快照目录 METRICS_DIR 由 gunicorn.conf.py 在启动时清空、worker 退出时清理）
+# DOCX 渲染缓存目录/容量（字节，0 为关闭）：Environment=DOCX_CACHE_DIR=${APP_DIR}/.cache/docx DOCX_CACHE_MAX_BYTES=536870912
+# PDF 导出：每个 worker 的 LibreOffice 进程数/单份超时秒数：Environment=PDF_WORKERS=2 PDF_TIMEOUT=120
+# 教案改存单个打包文件（mmap 读；首次启动从 jsons/ 导入）：Environment=LESSON_STORE=pack LESSON_PACK=${APP_DIR}/jsons.pack
+# --preload：master 先导入应用并预热文档栈（WARM_UP=1，见 wsgi.py），worker fork 后直接共享；
+# 代价是改代码后需 restart（HUP 只会重新 fork，不会重新导入）
+Environment=WARM_UP=1
+# gthread：每个 worker 多个请求线程，导出占着线程时编辑、保存仍有线程可用；
+# 重活的并发由应用内准入控制限住（全服务器批量导出 2 个、单份渲染 4 个，满了 503 + Retry-After），
+# 按级别调整：Environment=ADMISSION_BULK_LIMIT=2 ADMISSION_BULK_QUEUE=2 ADMISSION_DOCX_LIMIT=4 ADMISSION_WAIT=10
 ExecStart=${APP_DIR}/venv/bin/gunicorn \\
   --workers ${WORKERS} \\
+  --worker-class gthread \\
+  --threads ${THREADS} \\
   --timeout ${TIMEOUT} \\
+  --preload \\
+  --config ${APP_DIR}/gunicorn.conf.py \\
   --bind 0.0.0.0:${PORT} \\
-  app:app
+  wsgi:app
 Restart=always
 RestartSec=3
 
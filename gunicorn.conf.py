@@ -0,0 +1,14 @@
+# gunicorn.conf.py — gunicorn 服务器钩子（deploy.sh 的 ExecStart 用 --config 指定；命令行参数照旧）
+# 钩子都在 master 里执行；--preload 时 app 已经导入，这里的 import 不额外花时间。
+
+
+def on_starting(server):
+    """master 启动：清掉上次运行留下的指标快照。"""
+    import app
+    app.metrics_reset()
+
+
+def child_exit(server, worker):
+    """worker 退出（崩溃、超时被杀、max-requests 回收）：删掉它及其导出进程池的指标快照。"""
+    import app
+    app.metrics_forget(worker.pid)
@@ -1,8 +1,14 @@
+import argparse
+import collections
+import json
 import os
 import re
 import shutil
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 def which_abs(cmd, fallback):
     p = shutil.which(cmd)
@@ -12,13 +18,27 @@ LP        = which_abs("lp",        "/usr/bin/lp")
 LPSTAT    = which_abs("lpstat",    "/usr/bin/lpstat")
 LPOPTIONS = which_abs("lpoptions", "/usr/sbin/lpoptions")
 
+PROBE_TIMEOUT = 10            # 单个 lpstat/lpoptions 探测的超时（秒）
+PRINTER_CACHE_TTL = float(os.environ.get("PRINTER_CACHE_TTL", "30"))
+
 def run(cmd):
+    # LC_ALL=C：让 CUPS 输出英文，解析不受系统语言影响
     try:
-        proc = subprocess.run(cmd, capture_output=True, text=True, check=False)
+        proc = subprocess.run(cmd, capture_output=True, text=True, check=False, timeout=PROBE_TIMEOUT,
+                              env={**os.environ, "LC_ALL": "C"})
         return (proc.stdout or "") + (proc.stderr or "")
     except Exception:
         return ""
 
+def run_checked(cmd):
+    """同 run，但只要 stdout；命令失败（退出码非 0、超时、找不到命令）返回 None，不把报错当成输出。"""
+    try:
+        proc = subprocess.run(cmd, capture_output=True, text=True, check=False, timeout=PROBE_TIMEOUT,
+                              env={**os.environ, "LC_ALL": "C"})
+    except Exception:
+        return None
+    return proc.stdout if proc.returncode == 0 else None
+
 DEVICE_RE = re.compile(r"^device for (.+?):", re.IGNORECASE)
 
 def clean_printer_name(name: str) -> str:
@@ -31,7 +51,7 @@ def clean_printer_name(name: str) -> str:
     # 截断中文状态/英文状态关键词之前
     cut_markers = [
         " 正在", "正在", " 接受", "接受",  # 中文常见
-        " accepting", " is ", " enabled", " disabled",  # 英文常见
+        " not accepting", " accepting", " is ", " enabled", " disabled",  # 英文常见
     ]
     for mk in cut_markers:
         i = name.find(mk)
@@ -43,103 +63,317 @@ def clean_printer_name(name: str) -> str:
         name = name.split(":", 1)[0].strip()
     return name
 
-def list_printers():
-    names = set()
-
-    # 1) 首选：lpstat -v → “device for NAME:” 最稳定
-    out = run([LPSTAT, "-v"])
-    for line in out.splitlines():
-        line = line.strip()
-        m = DEVICE_RE.match(line)
+# ---- 解析器：入参是命令的原始输出文本，可直接拿录下来的输出测试 ----
+def parse_lpstat_v(text: str) -> dict:
+    """lpstat -v：'device for NAME: URI' -> {NAME: URI}"""
+    out = {}
+    for line in text.splitlines():
+        m = DEVICE_RE.match(line.strip())
         if m:
-            names.add(m.group(1).strip())
-
-    # 2) 兜底：lpstat -a / -p
-    if not names:
-        out = run([LPSTAT, "-a"])
-        for line in out.splitlines():
-            line = line.strip()
-            # NAME 开头，后面是状态
-            if line:
-                names.add(clean_printer_name(line))
-
-        out = run([LPSTAT, "-p"])
-        for line in out.splitlines():
-            line = line.strip()
-            # printer NAME is ...
-            if line.lower().startswith("printer "):
-                parts = line.split()
-                if len(parts) >= 2:
-                    names.add(parts[1])
-
-    # 3) 再从 lpoptions 收集（有些环境只在这里能拿到）
-    out = run([LPOPTIONS])
-    if out:
-        toks = out.replace("default", "dest").split()
-        for i, t in enumerate(toks):
-            if t == "dest" and i + 1 < len(toks):
-                names.add(toks[i + 1])
-
-    # 默认打印机
-    default_name = None
-    out = run([LPSTAT, "-d"])
-    if ":" in out:
-        default_name = out.split(":", 1)[1].strip() or None
-        default_name = clean_printer_name(default_name)
-
-    # 清洗一遍名称集合
-    clean = sorted({clean_printer_name(n) for n in names if n})
-    # 把默认也放进去
-    if default_name and default_name not in clean:
-        clean.append(default_name)
-
-    return clean, default_name
-
-def batch_print_pdf(folder, printer, copies=1, two_sided=True):
-    # 绝对路径存在性校验
-    if not os.path.exists(LP):
-        print(f"❌ 未找到 lp 命令：{LP}")
-        sys.exit(1)
+            out[m.group(1).strip()] = line.strip()[m.end():].strip()
+    return out
 
-    # 清洗最终选择的打印机名
-    printer = clean_printer_name(printer)
+def parse_lpstat_a(text: str) -> dict:
+    """lpstat -a：'NAME accepting requests since ...' / 'NAME not accepting requests ...' -> {NAME: bool}"""
+    out = {}
+    for line in text.splitlines():
+        if not line.strip() or line[0].isspace():  # 缩进行是上一台的拒绝原因
+            continue
+        name = clean_printer_name(line)
+        if name:
+            out[name] = " not accepting" not in line and "不接受" not in line
+    return out
 
+def parse_lpstat_p(text: str) -> dict:
+    """lpstat -p：'printer NAME is idle.  enabled since ...' / 'printer NAME disabled since ...'
+    -> {NAME: {"enabled": bool, "state": 'idle'/'printing'/'disabled'}}"""
+    out = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) < 3 or parts[0].lower() != "printer":
+            continue
+        name = parts[1]
+        if parts[2] == "disabled":
+            out[name] = {"enabled": False, "state": "disabled"}
+        else:
+            state = "printing" if "printing" in line else "idle"
+            out[name] = {"enabled": True, "state": state}
+    return out
+
+def parse_lpstat_d(text: str):
+    """lpstat -d：'system default destination: NAME' -> NAME；没有默认打印机时 None"""
+    for line in text.splitlines():
+        if "no system default" in line.lower():
+            return None
+        if ":" in line:
+            return clean_printer_name(line.split(":", 1)[1]) or None
+    return None
+
+def parse_lpoptions(text: str) -> set:
+    """lpoptions（不带参数）：'dest NAME ...' / 'default NAME ...' 里的队列名"""
+    toks = text.replace("default", "dest").split()
+    return {toks[i + 1] for i, t in enumerate(toks) if t == "dest" and i + 1 < len(toks)}
+
+def merge_printers(v: str, a: str, p: str, d: str, o: str) -> list:
+    """把五个探测的输出合成结构化列表：[{name, default, accepting, enabled, state, device}]，按名称排序。"""
+    devices, accepting, status = parse_lpstat_v(v), parse_lpstat_a(a), parse_lpstat_p(p)
+    default_name = parse_lpstat_d(d)
+    names = set(devices) | set(accepting) | set(status) | parse_lpoptions(o)
+    if default_name:
+        names.add(default_name)
+    printers = []
+    for name in sorted({clean_printer_name(n) for n in names if n}):
+        st = status.get(name, {})
+        printers.append({
+            "name": name,
+            "default": name == default_name,
+            "accepting": accepting.get(name),   # None：探测里没出现，状态未知
+            "enabled": st.get("enabled"),
+            "state": st.get("state"),
+            "device": devices.get(name),
+        })
+    return printers
+
+# ---- 发现：五个探测并发跑，结果按 TTL 缓存 ----
+# 只解析 stdout：CUPS 没起来时 stderr 的 "lpstat: ..." 会被当成打印机名/默认打印机。失败的探测按空输出算。
+_printer_cache = None  # (过期时刻, 列表)
+_printer_lock = threading.Lock()
+
+def probe(cmd) -> str:
+    return run_checked(cmd) or ""
+
+def probe_printers() -> list:
+    probes = {
+        "v": [LPSTAT, "-v"],
+        "a": [LPSTAT, "-a"],
+        "p": [LPSTAT, "-p"],
+        "d": [LPSTAT, "-d"],
+        "o": [LPOPTIONS],
+    }
+    with ThreadPoolExecutor(max_workers=len(probes)) as pool:
+        outputs = dict(zip(probes, pool.map(probe, probes.values())))
+    return merge_printers(**outputs)
+
+def discover_printers(refresh: bool = False, ttl: float = None) -> list:
+    """结构化的打印机列表（见 merge_printers）；ttl 秒内重复调用直接返回缓存，refresh=True 强制重新探测。"""
+    global _printer_cache
+    ttl = PRINTER_CACHE_TTL if ttl is None else ttl
+    with _printer_lock:
+        if not refresh and _printer_cache and _printer_cache[0] > time.monotonic():
+            return _printer_cache[1]
+        printers = probe_printers()
+        _printer_cache = (time.monotonic() + ttl, printers)
+        return printers
+
+def list_printers(refresh: bool = False):
+    """兼容旧接口：返回 (名称列表, 默认打印机名)。"""
+    printers = discover_printers(refresh)
+    default_name = next((p["name"] for p in printers if p["default"]), None)
+    return [p["name"] for p in printers], default_name
+
+# ---- 批量打印：并发提交 + 可续跑清单 + 轮询完成 + 失败重试 ----
+# 清单写在 PDF 目录下的 .print_manifest.json，逐个文件记录状态：
+#   pending（未提交）/ submitted（已提交，job 为 CUPS 任务号）/ completed（打印完成）/
+#   failed（提交失败且重试用尽，或任务被取消/中止）
+# 中途中断后用同样的参数再跑一次：completed 的跳过，submitted 的接着轮询，其余重新提交。
+# 轮询时 lpstat 查询失败（CUPS 不可达等）这一轮什么都不改，不会把任务误记为完成。
+MANIFEST_NAME = ".print_manifest.json"
+REQUEST_ID_RE = re.compile(r"request id is (\S+)")
+JOB_LINE_RE = re.compile(r"^(\S+-\d+)\s")
+ALERTS_RE = re.compile(r"^\s+Alerts:\s*(.*)$")
+JOB_FAILED_REASONS = ("job-canceled", "job-aborted", "aborted-by-system", "job-completed-with-errors")
+
+def lp_options(copies=1, two_sided=True) -> list:
     opts = []
     if two_sided:
         opts += ["-o", "sides=two-sided-long-edge"]
     if copies and copies > 1:
         opts += ["-n", str(copies)]
+    return opts
 
-    files = [f for f in os.listdir(folder) if f.lower().endswith(".pdf")]
-    files.sort()
-    if not files:
-        print("⚠️ 目录下没有 .pdf 文件：", folder)
-        return
+def submit_lp(printer: str, paths: list, opts: list) -> str:
+    """一次 lp 提交若干文件（同一个 CUPS 任务），返回任务号；失败抛 RuntimeError（带 lp 原始输出）。"""
+    proc = subprocess.run([LP, "-d", printer] + opts + paths, capture_output=True, text=True,
+                          env={**os.environ, "LC_ALL": "C"})
+    out = (proc.stdout or "") + (proc.stderr or "")
+    m = REQUEST_ID_RE.search(out)
+    if proc.returncode != 0 or not m:
+        raise RuntimeError(out.strip() or f"lp 退出码 {proc.returncode}")
+    return m.group(1)
+
+def parse_job_ids(text: str) -> set:
+    """lpstat -o / -W ... 的输出：每行以任务号 QUEUE-N 开头。"""
+    return {m.group(1) for m in map(JOB_LINE_RE.match, text.splitlines()) if m}
 
-    for fname in files:
-        pdf_path = os.path.join(folder, fname)
-        if not os.path.isfile(pdf_path):
-            print("⚠️ 跳过不存在文件：", pdf_path)
+def parse_finished_jobs(text: str) -> dict:
+    """lpstat -l -W completed 的输出：任务号 -> 失败原因（取消/中止/出错时的 job-state-reasons），打印完成为 None。
+    -W completed 里取消、中止的任务也在，只能靠缩进的 Alerts 行区分。"""
+    out, job = {}, None
+    for line in text.splitlines():
+        m = JOB_LINE_RE.match(line)
+        if m:
+            job = m.group(1)
+            out[job] = None
             continue
-        print(f"🖨️ 打印 → {printer} ：{pdf_path}")
-        cmd = [LP, "-d", printer] + opts + [pdf_path]
-        ret = subprocess.run(cmd, capture_output=True, text=True)
-        if ret.returncode != 0:
-            # 直给原始输出，便于定位
-            print("❌ lp 错误：", (ret.stdout or "") + (ret.stderr or ""))
+        m = ALERTS_RE.match(line)
+        if job and m:
+            bad = [r for r in m.group(1).split() if r.startswith(JOB_FAILED_REASONS)]
+            out[job] = " ".join(bad) or None
+    return out
+
+def active_jobs(printer: str):
+    """还在打印队列里的任务号；lpstat 失败返回 None（不能当成队列已空）。"""
+    text = run_checked([LPSTAT, "-W", "not-completed", "-o", printer])
+    return None if text is None else parse_job_ids(text)
+
+def finished_jobs(printer: str):
+    """已结束的任务号 -> 失败原因或 None（见 parse_finished_jobs）；lpstat 失败返回 None。"""
+    text = run_checked([LPSTAT, "-l", "-W", "completed", "-o", printer])
+    return None if text is None else parse_finished_jobs(text)
+
+def poll_jobs(printer: str, jobs) -> dict:
+    """jobs 里已离开队列的任务 -> 失败原因（取消/中止/出错）或 None（打印完成）；还在队列里的不出现。
+    两次 lpstat 有一次失败就返回 None，调用方这一轮什么都不改。
+    CUPS 不保留任务历史（PreserveJobHistory No）时，离开队列的任务查不到结局，按完成算。"""
+    active = active_jobs(printer)
+    finished = finished_jobs(printer) if active is not None else None
+    if finished is None:
+        return None
+    return {j: finished.get(j) for j in jobs if j not in active}
+
+def load_manifest(folder: str, printer: str, opts: list, restart=False) -> dict:
+    path = os.path.join(folder, MANIFEST_NAME)
+    if not restart:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("printer") == printer and manifest.get("options") == opts:
+                return manifest
+            print("⚠️ 清单里的打印机/选项与本次不同，重新开始：", path)
+        except (OSError, ValueError):
+            pass
+    return {"printer": printer, "options": opts, "files": {}}
+
+def save_manifest(folder: str, manifest: dict):
+    path = os.path.join(folder, MANIFEST_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+def run_print(folder, printer, copies=1, two_sided=True, concurrency=4, per_job=10, retries=2,
+              wait=True, poll_interval=5.0, wait_timeout=3600.0, restart=False, log=print) -> dict:
+    """打印目录下所有 PDF；返回清单（files: 文件名 -> {status, job, attempts, error}）。
+
+    per_job 个文件合成一次 lp 提交（份数 > 1 时逐个提交，否则多份会按整批来排）；
+    同时最多 concurrency 个 lp 在跑；提交失败按 1s、2s、4s… 退避重试 retries 次，
+    多文件的一批仍失败时拆成单个文件各自再试。
+    wait=True 时轮询 lpstat，直到已提交的任务都离开队列或超过 wait_timeout 秒。"""
+    printer = clean_printer_name(printer)
+    opts = lp_options(copies, two_sided)
+    manifest = load_manifest(folder, printer, opts, restart)
+    entries = manifest["files"]
+    present = {f for f in os.listdir(folder) if f.lower().endswith(".pdf")}
+    for name in list(entries):
+        if name not in present and entries[name]["status"] in ("pending", "failed"):
+            del entries[name]  # 文件已删/改名
+    for name in sorted(present):
+        entries.setdefault(name, {"status": "pending", "job": None, "attempts": 0, "error": None})
+    lock = threading.Lock()
+
+    def update(names, **fields):
+        with lock:
+            for n in names:
+                entries[n].update(fields)
+            save_manifest(folder, manifest)
+
+    todo = [n for n, e in sorted(entries.items())
+            if e["status"] in ("pending", "failed") and os.path.isfile(os.path.join(folder, n))]
+    size = 1 if copies and copies > 1 else max(per_job, 1)
+    batches = [todo[i:i + size] for i in range(0, len(todo), size)]
+
+    def submit(batch):
+        for attempt in range(retries + 1):
+            try:
+                job = submit_lp(printer, [os.path.join(folder, n) for n in batch], opts)
+            except RuntimeError as e:
+                update(batch, status="failed", error=str(e), attempts=entries[batch[0]]["attempts"] + 1)
+                if attempt < retries:
+                    time.sleep(2 ** attempt)
+                continue
+            update(batch, status="submitted", job=job, error=None)
+            log(f"🖨️ {job} ← {', '.join(batch)}")
+            return
+        if len(batch) > 1:  # 整批失败：拆成单个再提交，找出是哪个文件的问题
+            for name in batch:
+                submit([name])
+            return
+        log(f"❌ 提交失败（已重试 {retries} 次）：{batch[0]}：{entries[batch[0]]['error']}")
+
+    save_manifest(folder, manifest)
+    if batches:
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+            list(pool.map(submit, batches))
+
+    deadline = time.monotonic() + wait_timeout
+    while wait:
+        waiting = {e["job"] for e in entries.values() if e["status"] == "submitted"}
+        if not waiting:
+            break
+        finished = poll_jobs(printer, waiting)
+        if finished is None:
+            log("⚠️ lpstat 查询失败，稍后重试")
+            finished = {}
+        done = {j for j, reason in finished.items() if reason is None}
+        if done:
+            update([n for n, e in entries.items() if e["job"] in done], status="completed")
+        for job, reason in finished.items():
+            if reason is not None:  # 取消/中止：记为 failed，续跑时重新提交
+                update([n for n, e in entries.items() if e["job"] == job], status="failed", job=None,
+                       error=f"任务 {job} 未打印完成：{reason}")
+                log(f"❌ 任务 {job} 未打印完成：{reason}")
+        if finished:
+            log(f"✅ 已完成 {len(done)} 个任务，剩余 {len(waiting) - len(finished)} 个")
+        elif time.monotonic() > deadline:
+            log(f"⏱️ 等待超时，仍有 {len(waiting)} 个任务在队列里；稍后用同样参数再跑一次可继续跟踪")
+            break
         else:
-            # 可选：显示返回的 job id
-            msg = (ret.stdout or "").strip()
-            if msg:
-                print("✅", msg)
+            time.sleep(poll_interval)
+    return manifest
+
+def batch_print_pdf(folder, printer, copies=1, two_sided=True, **kwargs):
+    # 绝对路径存在性校验
+    if not os.path.exists(LP):
+        print(f"❌ 未找到 lp 命令：{LP}")
+        sys.exit(1)
+    if not any(f.lower().endswith(".pdf") for f in os.listdir(folder)):
+        print("⚠️ 目录下没有 .pdf 文件：", folder)
+        return None
+    manifest = run_print(folder, printer, copies=copies, two_sided=two_sided, **kwargs)
+    counts = collections.Counter(e["status"] for e in manifest["files"].values())
+    print("统计：" + "，".join(f"{k} {v}" for k, v in sorted(counts.items())))
+    return manifest
 
 if __name__ == "__main__":
-    folder = "/Users/asliujinhe/Downloads/export_docx_20250909_125826/"
+    # python print.py [目录] [--printer 名称] [--copies N] [--one-sided] [--concurrency 4] [--per-job 10]
+    #                 [--retries 2] [--no-wait] [--restart]
+    # 不给打印机/份数时交互选择；中断后同样参数再跑一次即可续打（见 .print_manifest.json）
+    ap = argparse.ArgumentParser()
+    ap.add_argument("folder", nargs="?", default="/Users/asliujinhe/Downloads/export_docx_20250909_125826/")
+    ap.add_argument("--printer")
+    ap.add_argument("--copies", type=int)
+    ap.add_argument("--one-sided", action="store_true")
+    ap.add_argument("--concurrency", type=int, default=4, help="同时运行的 lp 数")
+    ap.add_argument("--per-job", type=int, default=10, help="每次 lp 提交的文件数（份数 > 1 时固定为 1）")
+    ap.add_argument("--retries", type=int, default=2)
+    ap.add_argument("--no-wait", action="store_true", help="提交完就退出，不等打印完成")
+    ap.add_argument("--restart", action="store_true", help="忽略已有清单，从头打印")
+    args = ap.parse_args()
+    folder = args.folder
     if not os.path.isdir(folder):
         print("❌ 目录不存在：", folder)
         sys.exit(1)
 
-    printers, default_name = list_printers()
+    printers, default_name = ([args.printer], args.printer) if args.printer else list_printers()
     if not printers and not default_name:
         print("❌ 未解析到打印机，请手动检查：")
         print("   ", LPSTAT, "-p -d")
@@ -157,7 +391,7 @@ if __name__ == "__main__":
         mark = " (默认)" if p == default_name else ""
         print(f"{i}. {p}{mark}")
 
-    choice = input(f"请选择打印机编号（回车使用默认{(' '+default_name) if default_name else ''}）：").strip()
+    choice = "" if args.printer else input(f"请选择打印机编号（回车使用默认{(' '+default_name) if default_name else ''}）：").strip()
     if choice:
         try:
             printer = unique[int(choice) - 1]
@@ -167,8 +401,14 @@ if __name__ == "__main__":
     else:
         printer = default_name or unique[0]
 
-    copies_in = input("份数（回车=1）：").strip()
+    copies_in = str(args.copies) if args.copies else input("份数（回车=1）：").strip()
     copies = int(copies_in) if copies_in.isdigit() and int(copies_in) > 0 else 1
 
-    batch_print_pdf(folder, printer, copies=copies, two_sided=True)
-    print("🎉 全部打印任务已提交（双面）")
+    manifest = batch_print_pdf(folder, printer, copies=copies, two_sided=not args.one_sided,
+                               concurrency=args.concurrency, per_job=args.per_job, retries=args.retries,
+                               wait=not args.no_wait, restart=args.restart)
+    if manifest and all(e["status"] in ("submitted", "completed") for e in manifest["files"].values()):
+        print(f"🎉 全部打印任务已提交（{'单面' if args.one_sided else '双面'}）")
+    elif manifest:
+        print("⚠️ 有文件未能提交，修好后用同样参数再跑一次即可续打")
+        sys.exit(1)
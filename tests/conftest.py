@@ -0,0 +1,87 @@
+# tests/conftest.py — 所有缓存/索引/锁文件放到临时目录，导入 app 之前设好
+import os, sys, glob, json, shutil, tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_DIR = os.path.join(ROOT, "jsons")
+
+_tmp = tempfile.mkdtemp(prefix="tsg_test_")
+for var, sub in (("METRICS_DIR", "metrics"), ("DOCX_CACHE_DIR", "docx"), ("PDF_CACHE_DIR", "pdf"),
+                 ("PDF_PROFILE_DIR", "soffice"), ("EXPORT_JOBS_DIR", "export_jobs"),
+                 ("ADMISSION_DIR", "admission"), ("LIB_INDEX_DB", "library.sqlite3"),
+                 ("LESSON_PACK", "jsons.pack")):
+    os.environ.setdefault(var, os.path.join(_tmp, sub))
+sys.path.insert(0, ROOT)
+
+import app as app_module
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_tmp, ignore_errors=True)
+
+
+@pytest.fixture
+def app():
+    return app_module
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    """jsons/ 里的示例教案拷到临时库目录；进程池的子进程按旧目录 fork，换目录时一并丢掉。"""
+    folder = tmp_path / "jsons"
+    folder.mkdir()
+    for path in sorted(glob.glob(os.path.join(SAMPLE_DIR, "*.json"))):
+        shutil.copy(path, folder)
+    monkeypatch.setattr(app_module, "LIB_DIR", str(folder))
+    monkeypatch.setattr(app_module, "_lesson_store", None)
+    monkeypatch.setattr(app_module, "LIB_INDEX_DB", str(tmp_path / "library.sqlite3"))
+    monkeypatch.setattr(app_module, "_index_ready", False)
+    yield str(folder)
+    if app_module._export_pool is not None:
+        app_module._export_pool.shutdown()
+        app_module._export_pool = None
+
+
+class FakeCups:
+    """PATH 上的假 lp / lpstat / lpoptions（见 fake_cups.py）；respond() 录输出，calls() 看实际调用。"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.responses = {}
+        self.respond()
+
+    def respond(self, **responses):
+        """键是命令行（空格连接，如 "lpstat -v"），值是 stdout 字符串或 {"stdout", "stderr", "code"}。"""
+        for cmd, r in responses.items():
+            self.responses[cmd] = {"stdout": r} if isinstance(r, str) else r
+        with open(os.path.join(self.folder, "responses.json"), "w", encoding="utf-8") as f:
+            json.dump(self.responses, f)
+
+    def fail(self, *cmds, stderr="lpstat: Unable to connect to server.\n"):
+        self.respond(**{cmd: {"stderr": stderr, "code": 1} for cmd in cmds})
+
+    def calls(self) -> list:
+        try:
+            with open(os.path.join(self.folder, "calls.log"), encoding="utf-8") as f:
+                return [json.loads(line)["argv"] for line in f]
+        except FileNotFoundError:
+            return []
+
+
+@pytest.fixture
+def fake_cups(tmp_path, monkeypatch):
+    import print as printing
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_cups.py")
+    for prog in ("lp", "lpstat", "lpoptions"):
+        path = bin_dir / prog
+        path.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{script}" {prog} "$@"\n')
+        path.chmod(0o755)
+    monkeypatch.setenv("FAKE_CUPS", str(tmp_path))
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ.get("PATH", ""))
+    for var, prog in (("LP", "lp"), ("LPSTAT", "lpstat"), ("LPOPTIONS", "lpoptions")):
+        monkeypatch.setattr(printing, var, printing.which_abs(prog, None))
+    monkeypatch.setattr(printing, "_printer_cache", None)
+    return FakeCups(str(tmp_path))
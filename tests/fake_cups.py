@@ -0,0 +1,33 @@
+# tests/fake_cups.py — 假的 lp / lpstat / lpoptions，给测试放到 PATH 上
+# 用法：fake_cups.py <命令名> 参数...；状态目录由环境变量 FAKE_CUPS 指定：
+#   responses.json：{"lpstat -v": {"stdout": ..., "stderr": ..., "code": 0}, ...}，键是命令名 + 参数
+#   （lp 不查表：每次返回下一个任务号 <打印机>-<n>，n 从 next_job 文件读）
+#   calls.log：每次调用一行 JSON（argv 与环境里的 LC_ALL）
+import json
+import os
+import sys
+
+
+def main():
+    state = os.environ["FAKE_CUPS"]
+    prog, args = sys.argv[1], sys.argv[2:]
+    with open(os.path.join(state, "calls.log"), "a", encoding="utf-8") as f:
+        f.write(json.dumps({"argv": [prog] + args, "lc_all": os.environ.get("LC_ALL")}) + "\n")
+    with open(os.path.join(state, "responses.json"), encoding="utf-8") as f:
+        responses = json.load(f)
+    if prog == "lp" and "lp" not in responses:
+        printer = args[args.index("-d") + 1]
+        path = os.path.join(state, "next_job")
+        n = int(open(path).read()) if os.path.exists(path) else 12
+        with open(path, "w") as f:
+            f.write(str(n + 1))
+        print(f"request id is {printer}-{n} ({len([a for a in args if a.endswith('.pdf')])} file(s))")
+        return 0
+    r = responses.get(" ".join([prog] + args), responses.get(prog, {"stderr": f"{prog}: 未录制的调用\n", "code": 1}))
+    sys.stdout.write(r.get("stdout", ""))
+    sys.stderr.write(r.get("stderr", ""))
+    return r.get("code", 0)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
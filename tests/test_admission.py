@@ -0,0 +1,22 @@
+import os
+import re
+
+
+def bulk_inflight(client) -> int:
+    body = client.get("/metrics").get_data(as_text=True)
+    return int(re.search(r'lesson_admission_inflight\{route_class="bulk"\} (\d+)', body).group(1))
+
+
+def test_bulk_export_releases_slot_with_pool_workers(app, library, monkeypatch):
+    """导出进程池的 worker 在持有槽位时 fork 出来，不能把槽位一起带走。"""
+    monkeypatch.setattr(app, "EXPORT_WORKERS", 3)
+    monkeypatch.setattr(app, "EXPORT_MAX_INFLIGHT", 6)
+    limit, _ = app.ADMISSION_LIMITS["bulk"]
+    names = sorted(os.listdir(library))[:4]
+    client = app.app.test_client()
+    for _ in range(limit + 1):  # 槽位漏掉的话，第 limit + 1 次就只剩 503
+        with client.post("/export_selected", data={"selected": names, "action": "docx"}) as r:
+            assert r.status_code == 200
+            assert r.data
+        assert bulk_inflight(client) == 0
+    assert app._export_pool is not None
@@ -0,0 +1,42 @@
+import os
+import time
+
+
+def store(app, folder, name, size):
+    blob = os.urandom(size)
+    app.cache_write(os.path.join(folder, name + ".docx"), blob)
+    app.cache_account(folder, ".docx", len(blob), 1000)
+
+
+def size_file(folder) -> int:
+    with open(os.path.join(folder, ".size"), encoding="ascii") as f:
+        return int(f.read())
+
+
+def test_writes_under_quota_do_not_rescan(app, tmp_path, monkeypatch):
+    scans = []
+    evict = app.evict_cache
+    monkeypatch.setattr(app, "evict_cache", lambda *a: scans.append(a) or evict(*a))
+    for i in range(5):
+        store(app, tmp_path, f"k{i}", 100)
+    assert len(scans) == 1  # 只有第一次（还没有计数）扫了目录
+    assert size_file(tmp_path) == 500
+
+
+def test_write_past_quota_evicts_oldest(app, tmp_path):
+    for i in range(9):
+        store(app, tmp_path, f"k{i}", 100)
+        t = time.time() - 100 + i
+        os.utime(tmp_path / f"k{i}.docx", (t, t))
+    store(app, tmp_path, "k9", 300)  # 1200 > 1000：从最旧的删起
+    names = sorted(n for n in os.listdir(tmp_path) if n.endswith(".docx"))
+    assert names == [f"k{i}.docx" for i in range(2, 10)]
+    assert size_file(tmp_path) == 1000
+
+
+def test_render_docx_cached_hits(app, library, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "DOCX_CACHE_DIR", str(tmp_path))
+    data = app.load_lesson(sorted(os.listdir(library))[0])
+    blob = app.render_docx_cached(data)
+    assert app.render_docx_cached(data) == blob
+    assert size_file(tmp_path) == len(blob)
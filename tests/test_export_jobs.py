@@ -0,0 +1,61 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+
+def dead_pid() -> int:
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+def make_job(app, age, **fields):
+    job = {"id": uuid.uuid4().hex, "state": "running", "done": 0, "total": 1, "action": "docx", "error": None,
+           "download_name": None, "created": time.time() - age, "finished": None, "pid": os.getpid()}
+    job.update(fields)
+    os.makedirs(os.path.join(app.EXPORT_JOBS_DIR, job["id"]))
+    app.write_export_job(job)
+    path = os.path.join(app.EXPORT_JOBS_DIR, job["id"], "status.json")
+    os.utime(path, (time.time() - age, time.time() - age))
+    with open(os.path.join(app.EXPORT_JOBS_DIR, job["id"], "archive.zip.part"), "wb") as f:
+        f.write(b"PK")
+    return job["id"]
+
+
+def test_expiry_covers_finished_dead_and_orphaned_jobs(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "EXPORT_JOBS_DIR", str(tmp_path))
+    ttl = app.EXPORT_JOB_TTL
+    old = ttl + 60
+    finished_old = make_job(app, old, state="done", finished=time.time() - old)
+    finished_new = make_job(app, old, state="done", finished=time.time() - 10)
+    dead_old = make_job(app, old, pid=dead_pid())
+    dead_new = make_job(app, 10, pid=dead_pid())
+    running = make_job(app, old)  # 本进程还活着：再久也不删
+    orphan = tmp_path / uuid.uuid4().hex  # 没写出 status.json 的目录
+    orphan.mkdir()
+    os.utime(orphan, (time.time() - old, time.time() - old))
+
+    app.expire_export_jobs()
+    assert sorted(os.listdir(tmp_path)) == sorted([finished_new, dead_new, running])
+
+
+def test_status_poll_sweeps_at_most_once_per_interval(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "EXPORT_JOBS_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "_last_sweep", 0.0)
+    old = app.EXPORT_JOB_TTL + 60
+    expired = make_job(app, old, pid=dead_pid())
+    live = make_job(app, 0)
+    client = app.app.test_client()
+    with client.get(f"/export_jobs/{live}") as r:
+        assert r.status_code == 200
+    assert not os.path.exists(tmp_path / expired)
+
+    expired = make_job(app, old, pid=dead_pid())
+    with client.get(f"/export_jobs/{live}") as r:
+        assert r.status_code == 200
+    assert os.path.exists(tmp_path / expired)  # 刚扫过，这次不再扫
+    with client.get(f"/export_jobs/{expired}") as r:
+        assert json.loads(r.data)["state"] == "failed"
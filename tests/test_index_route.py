@@ -0,0 +1,34 @@
+import json
+import os
+
+
+def bump_library(library, name, lesson):
+    with open(os.path.join(library, name), "w", encoding="utf-8") as f:
+        json.dump(lesson, f, ensure_ascii=False)
+    st = os.stat(library)  # 目录 mtime 的精度可能较粗：确保 generation 变了
+    os.utime(library, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def test_index_answers_304_for_matching_etag(app, library):
+    client = app.app.test_client()
+    r = client.get("/")
+    assert r.status_code == 200 and r.headers["ETag"]
+    assert "Last-Modified" not in r.headers  # 只有 ETag 能判断列表是否变了
+    r = client.get("/", headers={"If-None-Match": r.headers["ETag"]})
+    assert r.status_code == 304 and not r.data
+
+
+def test_index_ignores_if_modified_since(app, library):
+    client = app.app.test_client()
+    r = client.get("/", headers={"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+    assert r.status_code == 200
+
+
+def test_index_returns_200_after_library_changes(app, library):
+    client = app.app.test_client()
+    etag = client.get("/").headers["ETag"]
+    bump_library(library, "新增课时.json", {"教学课题": "新增课时"})
+    r = client.get("/", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+    assert "新增课时" in r.get_data(as_text=True)
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+
+def lesson(app):
+    return {
+        "教学课题": "Unit 1",
+        "教学目标": "goal",
+        "教学流程": [{title: [{"tea": f"t{i}", "stu": f"s{i}"}] for i, title in enumerate(app.FIXED_TITLES)}],
+    }
+
+
+def test_add_remove_replace_move_copy_test(app):
+    doc = {"教学课题": "Unit 1", "教学反思": "", "教学流程": [{"A": [{"tea": "a"}, {"tea": "b"}]}, {"B": []}]}
+    app.apply_json_patch(doc, [
+        {"op": "test", "path": "/教学课题", "value": "Unit 1"},
+        {"op": "replace", "path": "/教学课题", "value": "Unit 2"},
+        {"op": "add", "path": "/教学流程/0/A/1", "value": {"tea": "inserted"}},
+        {"op": "add", "path": "/教学流程/1/B/-", "value": {"tea": "appended"}},
+        {"op": "move", "from": "/教学流程/0/A/0", "path": "/教学流程/1/B/0"},
+        {"op": "copy", "from": "/教学流程/1/B/1", "path": "/教学流程/0/A/-"},
+        {"op": "remove", "path": "/教学反思"},
+    ])
+    assert doc == {"教学课题": "Unit 2", "教学流程": [
+        {"A": [{"tea": "inserted"}, {"tea": "b"}, {"tea": "appended"}]},
+        {"B": [{"tea": "a"}, {"tea": "appended"}]},
+    ]}
+
+
+def test_pointer_escapes(app):
+    assert app.split_pointer("/教学流程/0/a~1b~0c") == ["教学流程", "0", "a/b~c"]
+    assert app.split_pointer("/x/~01") == ["x", "~1"]  # 先换 ~1 再换 ~0
+    doc = {"教学流程": [{"a/b~c": [{"tea": "old"}]}]}
+    app.apply_json_patch(doc, [{"op": "replace", "path": "/教学流程/0/a~1b~0c/0/tea", "value": "new"}])
+    assert doc == {"教学流程": [{"a/b~c": [{"tea": "new"}]}]}
+
+
+def test_editor_pointer_escape_is_valid_js(app):
+    """EDITOR_JS 里的正则是 /\\//g；Python 字符串里要写成 \\\\/，否则是非法转义。"""
+    assert "replace(/\\//g,'~1')" in app.EDITOR_JS
+
+
+@pytest.mark.parametrize("ops", [
+    [{"op": "replace", "path": "/教学课题"}],                       # 缺 value
+    [{"op": "remove", "path": "/不存在"}],                          # 非白名单字段
+    [{"op": "add", "path": "/教学流程/0/A/01", "value": {}}],       # 前导零下标
+    [{"op": "move", "from": "/教学流程/0", "path": "/教学流程/0/A/0"}],  # 移动到自身内部
+    [{"op": "frobnicate", "path": "/教学课题"}],
+    {"op": "remove", "path": "/教学课题"},                           # 不是列表
+])
+def test_invalid_patches(app, ops):
+    with pytest.raises(app.PatchError):
+        app.apply_json_patch({"教学课题": "x", "教学流程": [{"A": []}]}, ops)
+
+
+def write_lesson(app, library, data) -> str:
+    raw = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+    with open(os.path.join(library, "patch.json"), "wb") as f:
+        f.write(raw)
+    return hashlib.sha256(raw).hexdigest()
+
+
+def patch(app, ops, version):
+    headers = {"If-Match": f'"{version}"'} if version else {}
+    return app.app.test_client().patch("/lesson/patch.json", json=ops, headers=headers)
+
+
+def read_lesson(library):
+    with open(os.path.join(library, "patch.json"), "rb") as f:
+        return f.read()
+
+
+def test_patch_route_applies_and_returns_new_version(app, library):
+    version = write_lesson(app, library, lesson(app))
+    r = patch(app, [{"op": "replace", "path": "/教学课题", "value": "Unit 9"}], version)
+    assert r.status_code == 200
+    raw = read_lesson(library)
+    assert r.get_json()["version"] == hashlib.sha256(raw).hexdigest() == r.headers["ETag"].strip('"')
+    assert json.loads(raw)["教学课题"] == "Unit 9"
+    assert app.load_lesson("patch.json")["教学课题"] == "Unit 9"
+
+
+def test_failed_test_op_leaves_file_untouched(app, library):
+    version = write_lesson(app, library, lesson(app))
+    before = read_lesson(library)
+    r = patch(app, [
+        {"op": "replace", "path": "/教学课题", "value": "Unit 9"},
+        {"op": "test", "path": "/教学目标", "value": "something else"},
+    ], version)
+    assert r.status_code == 422
+    assert read_lesson(library) == before
+
+
+def test_version_mismatch_is_412(app, library):
+    write_lesson(app, library, lesson(app))
+    before = read_lesson(library)
+    r = patch(app, [{"op": "replace", "path": "/教学课题", "value": "Unit 9"}], "0" * 64)
+    assert r.status_code == 412
+    assert read_lesson(library) == before
+
+
+def test_missing_if_match_is_428(app, library):
+    write_lesson(app, library, lesson(app))
+    assert patch(app, [], None).status_code == 428
@@ -0,0 +1,68 @@
+import collections
+import io
+import json
+import os
+
+
+def fresh_cache(app, monkeypatch):
+    monkeypatch.setattr(app, "_lesson_cache", collections.OrderedDict())
+    monkeypatch.setattr(app, "_lesson_cache_bytes", 0)
+
+
+def test_hit_returns_cached_object(app, library, monkeypatch):
+    fresh_cache(app, monkeypatch)
+    name = sorted(os.listdir(library))[0]
+    first = app.load_lesson(name)
+    assert app.load_lesson(name) is first
+
+
+def test_size_or_mtime_change_invalidates(app, library, monkeypatch):
+    fresh_cache(app, monkeypatch)
+    name = sorted(os.listdir(library))[0]
+    path = os.path.join(library, name)
+    first = app.load_lesson(name)
+
+    with open(path, "rb") as f:
+        raw = f.read()
+    with open(path, "wb") as f:
+        f.write(raw + b"\n")  # 大小变了
+    second = app.load_lesson(name)
+    assert second is not first and second == first
+
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))  # 只有 mtime 变了
+    assert app.load_lesson(name) is not second
+
+
+def test_save_file_forgets_cached_lesson(app, library, monkeypatch):
+    fresh_cache(app, monkeypatch)
+    name = sorted(os.listdir(library))[0]
+    data = dict(app.load_lesson(name))
+    data["教学课题"] = "Changed"
+    r = app.app.test_client().post("/save_file", data={"source_filename": name,
+                                                      "json_text": json.dumps(data, ensure_ascii=False)})
+    assert r.status_code == 302
+    assert name not in app._lesson_cache
+    assert app.load_lesson(name)["教学课题"] == "Changed"
+
+
+def test_upload_forgets_stale_entry(app, library, monkeypatch):
+    fresh_cache(app, monkeypatch)
+    # 同名教案删掉又上传：旧缓存项即使 mtime/大小碰巧相同也不能再用
+    app._lesson_cache_put("new.json", 0, 2, {"stale": True})
+    raw = json.dumps({"教学课题": "Brand new", "教学流程": []}, ensure_ascii=False).encode("utf-8")
+    r = app.app.test_client().post("/upload_to_lib", data={"files": [(io.BytesIO(raw), "new.json")]},
+                                   headers={"Accept": "application/json"})
+    assert r.get_json()["outcomes"][0]["status"] == "saved"
+    assert "new.json" not in app._lesson_cache
+    assert app.load_lesson("new.json")["教学课题"] == "Brand new"
+
+
+def test_cache_lock_is_fresh_in_forked_child(app):
+    """fork 时别的线程正持有锁，子进程（导出进程池的 worker）不能卡在第一次查缓存上。"""
+    with app._lesson_cache_lock:
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if app._lesson_cache_lock.acquire(timeout=2) else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
@@ -0,0 +1,111 @@
+import json
+import os
+
+import pytest
+
+
+@pytest.fixture
+def lib(library):
+    """空的临时库：列表/检索结果只含本测试写入的教案。"""
+    for name in os.listdir(library):
+        os.remove(os.path.join(library, name))
+    return library
+
+
+def put(lib, name, title, goal="", mtime=None):
+    """像存储一样写临时文件再 os.replace；顺带把目录 mtime 往后推，generation 一定会变。"""
+    path = os.path.join(lib, name)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"教学课题": title, "教学目标": goal, "教学流程": []}, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    touch_dir(lib)
+
+
+def touch_dir(lib):
+    st = os.stat(lib)
+    os.utime(lib, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def listing(app, q="", **kw):
+    rows, total, _, _ = app.query_library(q, **kw)
+    assert total == len(rows)
+    return [(name, title) for name, _, _, title in rows]
+
+
+def test_reconcile_picks_up_added_changed_and_removed_files(app, lib):
+    put(lib, "a.json", "光合作用")
+    put(lib, "b.json", "细胞分裂")
+    assert listing(app) == [("a.json", "光合作用"), ("b.json", "细胞分裂")]
+
+    put(lib, "c.json", "遗传与变异")           # 新增
+    put(lib, "a.json", "光合作用与呼吸作用")    # 修改
+    os.remove(os.path.join(lib, "b.json"))     # 删除
+    touch_dir(lib)
+    assert listing(app) == [("a.json", "光合作用与呼吸作用"), ("c.json", "遗传与变异")]
+    assert listing(app, "呼吸作用") == [("a.json", "光合作用与呼吸作用")]
+    assert listing(app, "细胞分裂") == []  # 删掉的文件也不再出现在检索结果里
+
+
+def test_reconcile_skips_work_while_generation_is_unchanged(app, lib, monkeypatch):
+    put(lib, "a.json", "光合作用")
+    listing(app)
+    read = []
+    store = app.lesson_store()
+    monkeypatch.setattr(store, "iter_read", lambda names: read.extend(names) or iter(()))
+    monkeypatch.setattr(store, "scan", lambda: pytest.fail("generation 未变不该扫描库"))
+    assert listing(app) == [("a.json", "光合作用")]
+    assert read == []
+
+
+def test_reconcile_rereads_only_changed_files(app, lib, monkeypatch):
+    put(lib, "a.json", "光合作用")
+    put(lib, "b.json", "细胞分裂")
+    listing(app)
+    put(lib, "b.json", "细胞分裂与分化")
+    store = app.lesson_store()
+    real_iter_read, read = store.iter_read, []
+    monkeypatch.setattr(store, "iter_read", lambda names: read.extend(names) or real_iter_read(names))
+    assert listing(app) == [("a.json", "光合作用"), ("b.json", "细胞分裂与分化")]
+    assert read == ["b.json"]
+
+
+def test_search_filters_on_all_grams_and_substring(app, lib):
+    put(lib, "a.json", "光合作用", goal="理解叶绿体的功能")
+    put(lib, "b.json", "呼吸作用", goal="比较光合与呼吸")
+    put(lib, "c.json", "Cell Division")
+    assert [n for n, _ in listing(app, "作用")] == ["a.json", "b.json"]
+    assert [n for n, _ in listing(app, "光合作用")] == ["a.json"]  # b 有「光合」「作用」但不连着
+    assert [n for n, _ in listing(app, "叶绿体")] == ["a.json"]    # 教学目标也参与检索
+    assert [n for n, _ in listing(app, "  cell   DIVISION ")] == ["c.json"]  # 空白归一、不分大小写
+    assert [n for n, _ in listing(app, "光")] == ["a.json", "b.json"]  # 单字没有二元组，直接子串匹配
+    assert listing(app, "线粒体") == []
+
+
+def test_search_results_follow_sort_order_and_pages(app, lib, monkeypatch):
+    monkeypatch.setattr(app, "PAGE_SIZE", 2)
+    put(lib, "c.json", "作用一", mtime=1_000_000)
+    put(lib, "a.json", "作用二二二二二二", mtime=3_000_000)
+    put(lib, "b.json", "作用三三三", mtime=2_000_000)
+    put(lib, "d.json", "无关")
+
+    def names(**kw):
+        rows, total, page, pages = app.query_library("作用", **kw)
+        return [r[0] for r in rows], total, page, pages
+
+    assert names() == (["a.json", "b.json"], 3, 1, 2)
+    assert names(page=2) == (["c.json"], 3, 2, 2)
+    assert names(page=9) == (["c.json"], 3, 2, 2)  # 超出末页按末页
+    assert names(sort="mtime", order="desc")[0] == ["a.json", "b.json"]
+    assert names(sort="size", order="asc")[0] == ["c.json", "b.json"]
+
+
+def test_search_route(app, lib):
+    put(lib, "a.json", "光合作用")
+    put(lib, "b.json", "呼吸作用")
+    r = app.app.test_client().get("/search", query_string={"q": "作用", "sort": "name", "order": "desc"})
+    body = r.get_json()
+    assert body["total"] == 2
+    assert [row["name"] for row in body["results"]] == ["b.json", "a.json"]
+    assert [row["title"] for row in body["results"]] == ["呼吸作用", "光合作用"]
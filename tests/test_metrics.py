@@ -0,0 +1,52 @@
+import json
+import os
+import threading
+import time
+
+
+def test_concurrent_flushes_publish_whole_snapshots(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "METRICS_DIR", str(tmp_path))
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(200):
+                app._inc("lesson_http_requests_total", route="test")
+                app.metrics_flush()
+        except Exception as e:  # 共用一个 .tmp 时 os.replace 会撞上 FileNotFoundError
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    app.metrics_flush()
+    [name] = [n for n in os.listdir(tmp_path) if n.endswith(".json")]
+    with open(tmp_path / name, encoding="utf-8") as f:
+        counters = {n: v for n, l, v in json.load(f)["counters"] if dict(map(tuple, l)).get("route") == "test"}
+    assert counters == {"lesson_http_requests_total": 800}
+
+
+def test_metrics_forget_removes_worker_and_its_pool_children(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "METRICS_DIR", str(tmp_path))
+    for name in ("100.100.json", "100.101.json", "1000.1000.json"):
+        (tmp_path / name).write_text('{"counters": [], "histograms": []}')
+    app.metrics_forget(100)
+    assert sorted(os.listdir(tmp_path)) == ["1000.1000.json"]
+
+
+def test_export_pool_children_join_worker_group(app, library, tmp_path, monkeypatch):
+    metrics_dir = tmp_path / "metrics"
+    monkeypatch.setattr(app, "METRICS_DIR", str(metrics_dir))
+    monkeypatch.setattr(app, "EXPORT_WORKERS", 2)
+    monkeypatch.setattr(app, "EXPORT_MAX_INFLIGHT", 4)
+    monkeypatch.setattr(app, "DOCX_CACHE_MAX_BYTES", 0)
+    names = sorted(os.listdir(library))[:4]
+    assert len(list(app.iter_rendered_docx(names))) == 4
+    time.sleep(app.METRICS_FLUSH_SECONDS * 1.5)  # 等子进程的刷写线程
+    files = os.listdir(metrics_dir)
+    assert files and all(name.startswith(f"{os.getpid()}.") for name in files)
+    app.metrics_forget(os.getpid())
+    assert os.listdir(metrics_dir) == []
@@ -0,0 +1,77 @@
+import os
+
+
+def new_pack(app, tmp_path, monkeypatch):
+    lib = tmp_path / "jsons"
+    lib.mkdir()
+    monkeypatch.setattr(app, "LIB_DIR", str(lib))
+    return str(tmp_path / "library.pack")
+
+
+def record_offsets(app, path):
+    store = app.PackStore(path)
+    return {name: store._index[name][0] for name, _ in store.scan()}
+
+
+def corrupt(path, offset):
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+
+def test_write_keeps_records_after_corrupt_middle_record(app, tmp_path, monkeypatch):
+    path = new_pack(app, tmp_path, monkeypatch)
+    store = app.PackStore(path)
+    for i in range(3):
+        store.write(f"u{i}.json", f'{{"教学课题": "Unit {i}"}}'.encode("utf-8"))
+    corrupt(path, record_offsets(app, path)["u1.json"])  # 内容的第一个字节：crc 不再匹配
+
+    store = app.PackStore(path)
+    assert sorted(n for n, _ in store.scan()) == ["u0.json", "u2.json"]
+    store.write("u3.json", b'{"x": 3}')
+
+    store = app.PackStore(path)
+    assert sorted(n for n, _ in store.scan()) == ["u0.json", "u2.json", "u3.json"]
+    assert store.read("u2.json")[1] == '{"教学课题": "Unit 2"}'.encode("utf-8")
+    assert store.read("u3.json")[1] == b'{"x": 3}'
+
+
+def test_write_skips_record_with_bad_magic(app, tmp_path, monkeypatch):
+    path = new_pack(app, tmp_path, monkeypatch)
+    store = app.PackStore(path)
+    for i in range(3):
+        store.write(f"u{i}.json", b"{}")
+    offsets = record_offsets(app, path)
+    corrupt(path, offsets["u1.json"] - app._REC.size - len(b"u1.json"))  # 记录头的魔数
+
+    store = app.PackStore(path)
+    store.write("u3.json", b"{}")
+    assert sorted(n for n, _ in app.PackStore(path).scan()) == ["u0.json", "u2.json", "u3.json"]
+
+
+def test_write_truncates_torn_tail(app, tmp_path, monkeypatch):
+    path = new_pack(app, tmp_path, monkeypatch)
+    store = app.PackStore(path)
+    store.write("u0.json", b"{}")
+    size = os.path.getsize(path)
+    with open(path, "ab") as f:
+        f.write(app.pack_record("torn.json", b'{"x": 1}', 0)[:-3])  # 写到一半崩溃
+
+    store = app.PackStore(path)
+    store.write("u1.json", b"{}")
+    assert sorted(n for n, _ in app.PackStore(path).scan()) == ["u0.json", "u1.json"]
+    assert os.path.getsize(path) == size + len(app.pack_record("u1.json", b"{}", 0))
+
+
+def test_fork_resets_current_store_lock(app, tmp_path, monkeypatch):
+    path = new_pack(app, tmp_path, monkeypatch)
+    store = app.PackStore(path)
+    monkeypatch.setattr(app, "_lesson_store", store)
+    with store._mu:  # 模拟 fork 时别的线程正持有这把锁
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if store._mu.acquire(timeout=2) else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
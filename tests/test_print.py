@@ -0,0 +1,163 @@
+import json
+import os
+import time
+
+import print as printing
+
+LPSTAT_COMPLETED = """\
+HP-12                   teach             20480   Mon 01 Jan 2024 10:00:00 AM UTC
+\tStatus: The printer is idle.
+\tAlerts: job-completed-successfully
+\tqueued for HP
+HP-13                   teach             20480   Mon 01 Jan 2024 10:01:00 AM UTC
+\tAlerts: job-canceled-by-user
+\tqueued for HP
+HP-14                   teach             20480   Mon 01 Jan 2024 10:02:00 AM UTC
+\tAlerts: aborted-by-system job-completed-with-errors
+\tqueued for HP
+"""
+
+
+ACTIVE = "lpstat -W not-completed -o HP"
+COMPLETED = "lpstat -l -W completed -o HP"
+
+
+def lpstat(fake_cups, active, completed):
+    """录好两条 lpstat 的输出（假命令在 PATH 上，见 fake_cups.py）；给 None 表示这条 lpstat 失败。"""
+    fake_cups.respond(**{ACTIVE: active, COMPLETED: completed})
+    fake_cups.fail(*[cmd for cmd, out in ((ACTIVE, active), (COMPLETED, completed)) if out is None],
+                   stderr="lpstat: Unable to connect to server.\n")
+
+
+def test_parse_finished_jobs_separates_canceled_and_aborted():
+    assert printing.parse_finished_jobs(LPSTAT_COMPLETED) == {
+        "HP-12": None,
+        "HP-13": "job-canceled-by-user",
+        "HP-14": "aborted-by-system job-completed-with-errors",
+    }
+
+
+def test_poll_jobs(fake_cups):
+    lpstat(fake_cups, "HP-15  teach  1024  now\n", LPSTAT_COMPLETED)
+    assert printing.poll_jobs("HP", {"HP-12", "HP-13", "HP-15"}) == {"HP-12": None, "HP-13": "job-canceled-by-user"}
+    assert fake_cups.calls() == [["lpstat", "-W", "not-completed", "-o", "HP"],
+                                 ["lpstat", "-l", "-W", "completed", "-o", "HP"]]
+
+
+def test_poll_jobs_runs_lpstat_in_c_locale(fake_cups, monkeypatch):
+    """Alerts/Status 等关键字按英文解析：中文环境下 lpstat 也要以 C locale 跑。"""
+    monkeypatch.setenv("LC_ALL", "zh_CN.UTF-8")
+    lpstat(fake_cups, "", LPSTAT_COMPLETED)
+    printing.poll_jobs("HP", {"HP-12"})
+    with open(os.path.join(fake_cups.folder, "calls.log"), encoding="utf-8") as f:
+        assert {json.loads(line)["lc_all"] for line in f} == {"C"}
+
+
+def test_poll_jobs_lpstat_failure(fake_cups):
+    lpstat(fake_cups, None, LPSTAT_COMPLETED)
+    assert printing.poll_jobs("HP", {"HP-12"}) is None
+    assert len(fake_cups.calls()) == 1  # 第一条失败就不再查已完成的
+    lpstat(fake_cups, "", None)
+    assert printing.poll_jobs("HP", {"HP-12"}) is None
+
+
+def run_folder(tmp_path, fake_cups, active, completed, names, **kw):
+    folder = tmp_path / "pdfs"
+    folder.mkdir()
+    for name in names:
+        (folder / name).write_bytes(b"%PDF-1.4\n")
+    lpstat(fake_cups, active, completed)
+    printing.run_print(str(folder), "HP", **{"per_job": 1, "concurrency": 1, "poll_interval": 0,
+                                             "wait_timeout": 0, "log": lambda *a: None, **kw})
+    with open(os.path.join(folder, printing.MANIFEST_NAME), encoding="utf-8") as f:
+        return {n: (e["status"], e["job"]) for n, e in json.load(f)["files"].items()}
+
+
+def test_run_print_submits_with_lp(tmp_path, fake_cups):
+    statuses = run_folder(tmp_path, fake_cups, "", LPSTAT_COMPLETED, ["a.pdf", "b.pdf", "c.pdf"],
+                          per_job=2, copies=1)
+    assert statuses == {"a.pdf": ("completed", "HP-12"), "b.pdf": ("completed", "HP-12"),
+                        "c.pdf": ("failed", None)}  # 假 lp 的第二个任务号 HP-13 在录好的输出里是被取消的
+    folder = str(tmp_path / "pdfs")
+    lp_calls = [argv for argv in fake_cups.calls() if argv[0] == "lp"]
+    assert lp_calls == [
+        ["lp", "-d", "HP", "-o", "sides=two-sided-long-edge", os.path.join(folder, "a.pdf"), os.path.join(folder, "b.pdf")],
+        ["lp", "-d", "HP", "-o", "sides=two-sided-long-edge", os.path.join(folder, "c.pdf")],
+    ]
+
+
+def test_run_print_copies_are_submitted_one_file_per_job(tmp_path, fake_cups):
+    run_folder(tmp_path, fake_cups, "", "", ["a.pdf", "b.pdf"], per_job=10, copies=3, two_sided=False)
+    lp_calls = [argv for argv in fake_cups.calls() if argv[0] == "lp"]
+    assert [argv[:5] for argv in lp_calls] == [["lp", "-d", "HP", "-n", "3"]] * 2
+    assert [os.path.basename(argv[-1]) for argv in lp_calls] == ["a.pdf", "b.pdf"]
+
+
+def test_run_print_records_lp_errors(tmp_path, fake_cups):
+    fake_cups.fail("lp", stderr="lp: The printer or class does not exist.\n")
+    statuses = run_folder(tmp_path, fake_cups, "", "", ["a.pdf"], retries=0)
+    assert statuses == {"a.pdf": ("failed", None)}
+    with open(os.path.join(tmp_path, "pdfs", printing.MANIFEST_NAME), encoding="utf-8") as f:
+        assert json.load(f)["files"]["a.pdf"]["error"] == "lp: The printer or class does not exist."
+
+
+def test_run_print_keeps_jobs_submitted_when_lpstat_fails(tmp_path, fake_cups):
+    statuses = run_folder(tmp_path, fake_cups, None, None, ["a.pdf"])
+    assert statuses == {"a.pdf": ("submitted", "HP-12")}  # 续跑时接着轮询，而不是当作已完成跳过
+
+
+def test_run_print_marks_canceled_jobs_failed(tmp_path, fake_cups):
+    statuses = run_folder(tmp_path, fake_cups, "", LPSTAT_COMPLETED, ["a.pdf", "b.pdf", "c.pdf"])
+    assert statuses == {"a.pdf": ("completed", "HP-12"), "b.pdf": ("failed", None), "c.pdf": ("failed", None)}
+
+
+def run_app_print_job(app, fake_cups, monkeypatch, active, completed, names):
+    monkeypatch.setattr(app, "iter_rendered_pdf", lambda names: ((n, b"%PDF-1.4\n") for n in names))
+    monkeypatch.setattr(app, "PRINT_WAIT_TIMEOUT", 0)
+    monkeypatch.setattr(app, "PRINT_POLL_SECONDS", 0)
+    lpstat(fake_cups, active, completed)
+    job = wait_print_job(app, app.submit_print_job(names, "HP")["id"])
+    return job, {f["name"]: f["status"] for f in job["files"]}
+
+
+def wait_print_job(app, job_id, until=lambda job: job["state"] in ("done", "failed"), timeout=10):
+    """等到 until(job) 成立（提交线程把任务交给轮询线程后，由轮询线程结束它）。"""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = app.read_export_job(job_id)
+        if until(job) or time.monotonic() > deadline:
+            return job
+        time.sleep(0.02)
+
+
+def test_print_job_keeps_jobs_submitted_when_lpstat_fails(app, fake_cups, monkeypatch):
+    job, statuses = run_app_print_job(app, fake_cups, monkeypatch, None, None, ["a.json"])
+    assert statuses == {"a.json": "submitted"}
+
+
+def test_print_job_marks_canceled_jobs_failed(app, fake_cups, monkeypatch):
+    job, statuses = run_app_print_job(app, fake_cups, monkeypatch, "", LPSTAT_COMPLETED, ["a.json", "b.json"])
+    assert statuses == {"a.json": "completed", "b.json": "failed"}  # 假 lp 依次给出 HP-12、HP-13
+    assert job["done"] == 2
+    assert job["error"] == "1 个文件失败"
+    assert [argv[:3] for argv in fake_cups.calls() if argv[0] == "lp"] == [["lp", "-d", "HP"]] * 2
+
+
+def test_stuck_printer_does_not_hold_up_the_next_batch(app, fake_cups, monkeypatch):
+    """第一批的任务一直在队列里：第二批照样提交、完成，不用等第一批的轮询超时。"""
+    monkeypatch.setattr(app, "iter_rendered_pdf", lambda names: ((n, b"%PDF-1.4\n") for n in names))
+    monkeypatch.setattr(app, "PRINT_WAIT_TIMEOUT", 60)
+    monkeypatch.setattr(app, "PRINT_POLL_SECONDS", 0.05)
+    lpstat(fake_cups, "HP-12  teach  1024  now\n", "")
+    stuck = app.submit_print_job(["a.json"], "HP")["id"]
+    try:
+        job = wait_print_job(app, stuck, until=lambda job: job["files"][0]["status"] == "submitted")
+        assert job["files"][0]["job"] == "HP-12"
+        second = app.submit_print_job(["b.json"], "HP")["id"]
+        job = wait_print_job(app, second)
+        assert job["state"] == "done" and job["files"][0]["status"] == "completed"
+        assert app.read_export_job(stuck)["state"] == "running"  # 还在等打印机
+    finally:
+        lpstat(fake_cups, "", "")  # 打印机恢复：第一批也结束，轮询线程不再惦记它
+        job = wait_print_job(app, stuck)
+    assert job["state"] == "done" and job["files"][0]["status"] == "completed"
@@ -0,0 +1,72 @@
+import print as printing
+
+LPSTAT_V = """\
+device for HP_LaserJet: ipp://192.168.1.20/ipp/print
+device for Office-Color: dnssd://Office%20Color._ipp._tcp.local/
+"""
+LPSTAT_A = """\
+HP_LaserJet accepting requests since Mon 01 Jan 2024 09:00:00 AM UTC
+Office-Color not accepting requests since Tue 02 Jan 2024 10:00:00 AM UTC -
+\tPaused by admin
+"""
+LPSTAT_P = """\
+printer HP_LaserJet now printing HP_LaserJet-12.  enabled since Mon 01 Jan 2024 09:00:00 AM UTC
+printer Office-Color disabled since Tue 02 Jan 2024 10:00:00 AM UTC -
+\tPaused by admin
+"""
+LPSTAT_D = "system default destination: HP_LaserJet\n"
+LPOPTIONS = "default HP_LaserJet\ndest Spare sides=one-sided\n"
+
+EXPECTED = [
+    {"name": "HP_LaserJet", "default": True, "accepting": True, "enabled": True, "state": "printing",
+     "device": "ipp://192.168.1.20/ipp/print"},
+    {"name": "Office-Color", "default": False, "accepting": False, "enabled": False, "state": "disabled",
+     "device": "dnssd://Office%20Color._ipp._tcp.local/"},
+    {"name": "Spare", "default": False, "accepting": None, "enabled": None, "state": None, "device": None},
+]
+
+
+def test_parsers():
+    assert printing.parse_lpstat_v(LPSTAT_V) == {
+        "HP_LaserJet": "ipp://192.168.1.20/ipp/print",
+        "Office-Color": "dnssd://Office%20Color._ipp._tcp.local/",
+    }
+    assert printing.parse_lpstat_a(LPSTAT_A) == {"HP_LaserJet": True, "Office-Color": False}
+    assert printing.parse_lpstat_p(LPSTAT_P) == {
+        "HP_LaserJet": {"enabled": True, "state": "printing"},
+        "Office-Color": {"enabled": False, "state": "disabled"},
+    }
+    assert printing.parse_lpstat_d(LPSTAT_D) == "HP_LaserJet"
+    assert printing.parse_lpstat_d("no system default destination\n") is None
+    assert printing.parse_lpoptions(LPOPTIONS) == {"HP_LaserJet", "Spare"}
+
+
+def test_merge_printers():
+    assert printing.merge_printers(LPSTAT_V, LPSTAT_A, LPSTAT_P, LPSTAT_D, LPOPTIONS) == EXPECTED
+
+
+def test_discover_printers_runs_real_commands(fake_cups):
+    fake_cups.respond(**{"lpstat -v": LPSTAT_V, "lpstat -a": LPSTAT_A, "lpstat -p": LPSTAT_P,
+                         "lpstat -d": LPSTAT_D, "lpoptions": LPOPTIONS})
+    assert printing.discover_printers() == EXPECTED
+    assert sorted(fake_cups.calls()) == [["lpoptions"], ["lpstat", "-a"], ["lpstat", "-d"],
+                                         ["lpstat", "-p"], ["lpstat", "-v"]]
+    printing.discover_printers()
+    assert len(fake_cups.calls()) == 5  # TTL 内走缓存
+
+
+def test_cups_down_gives_no_printers(fake_cups):
+    """CUPS 没起来：报错只在 stderr，不能被解析成名为 lpstat 的打印机或默认打印机。"""
+    fake_cups.fail("lpstat -v", "lpstat -a", "lpstat -p", "lpstat -d")
+    fake_cups.fail("lpoptions", stderr="lpoptions: Unable to connect to server\n")
+    assert printing.discover_printers() == []
+    assert printing.list_printers(refresh=True) == ([], None)
+
+
+def test_one_failed_probe_keeps_the_rest(fake_cups):
+    fake_cups.respond(**{"lpstat -v": LPSTAT_V, "lpstat -a": LPSTAT_A, "lpstat -p": LPSTAT_P,
+                         "lpoptions": LPOPTIONS})
+    fake_cups.fail("lpstat -d", stderr="lpstat: Error - no default destination available.\n")
+    printers = printing.discover_printers()
+    assert [p["name"] for p in printers] == ["HP_LaserJet", "Office-Color", "Spare"]
+    assert not any(p["default"] for p in printers)
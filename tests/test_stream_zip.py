@@ -0,0 +1,42 @@
+import io
+import os
+import zipfile
+
+
+def failing_render(fail_at):
+    def iter_rendered_docx(names):
+        for i, name in enumerate(names):
+            if i == fail_at:
+                raise RuntimeError("渲染失败")
+            yield name, b"PK fake docx"
+    return iter_rendered_docx
+
+
+def export(app, library, monkeypatch, fail_at):
+    monkeypatch.setattr(app, "iter_rendered_docx", failing_render(fail_at))
+    names = sorted(os.listdir(library))[:3]
+    client = app.app.test_client()
+    with client.post("/export_selected", data={"selected": names, "action": "docx"}) as r:
+        return names, r.status_code, r.headers, r.data
+
+
+def test_first_entry_failure_is_reported_before_headers(app, library, monkeypatch):
+    _, status, headers, _ = export(app, library, monkeypatch, fail_at=0)
+    assert status == 302  # 回到首页报错，而不是一个 200 的空压缩包
+    assert "Content-Disposition" not in headers
+
+
+def test_later_failure_finishes_archive_with_error_entry(app, library, monkeypatch):
+    names, status, _, data = export(app, library, monkeypatch, fail_at=2)
+    assert status == 200
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:  # 中央目录完整，能正常打开
+        assert zf.namelist() == [os.path.splitext(n)[0] + ".docx" for n in names[:2]] + [app.STREAM_ERROR_ENTRY]
+        assert "渲染失败" in zf.read(app.STREAM_ERROR_ENTRY).decode("utf-8")
+
+
+def test_background_export_job_still_fails(app, library, monkeypatch):
+    monkeypatch.setattr(app, "iter_rendered_docx", failing_render(1))
+    job = {"id": "stream-fail", "action": "docx", "done": 0, "total": 2}
+    os.makedirs(os.path.join(app.EXPORT_JOBS_DIR, job["id"]), exist_ok=True)
+    app.run_export_job(job, ["a.json", "b.json"])
+    assert job["state"] == "failed" and job["error"] == "渲染失败"
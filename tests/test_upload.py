@@ -0,0 +1,105 @@
+import io
+import json
+import os
+import zipfile
+
+
+def lesson(title, extra=""):
+    return json.dumps({"教学课题": title, "教学目标": extra, "教学流程": []}, ensure_ascii=False).encode("utf-8")
+
+
+def make_zip(members):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+    buf.seek(0)
+    return buf
+
+
+def upload(app, *files):
+    client = app.app.test_client()
+    r = client.post("/upload_to_lib", data={"files": list(files)}, content_type="multipart/form-data",
+                    headers={"Accept": "application/json"})
+    assert r.status_code == 200
+    return r.get_json()
+
+
+def search(app, q):
+    r = app.app.test_client().get("/search", query_string={"q": q})
+    return [row["name"] for row in r.get_json()["results"]]
+
+
+def test_zip_with_duplicates_and_other_members(app, library):
+    existing = sorted(os.listdir(library))[0]
+    with open(os.path.join(library, existing), "rb") as f:
+        existing_raw = f.read()
+    archive = make_zip([
+        ("课时/植物的光合作用.json", lesson("植物的光合作用")),
+        ("课时/副本.json", lesson("植物的光合作用")),               # 同批内容相同
+        ("课时/" + existing, existing_raw),                          # 与库里已有的相同
+        ("课时/" + existing.replace(".json", "") + " 改.json", existing_raw.replace(b"\n", b"\r\n")),  # JSON 等价
+        (existing, lesson("同名但内容不同的课")),                    # 重名，改成（1）
+        ("说明.txt", b"not a lesson"),                                # 不是 .json，跳过
+        ("__MACOSX/课时/._植物的光合作用.json", b"\x00\x05\x16\x07"),  # macOS 资源叉，跳过
+        ("课时/", b""),
+    ])
+    result = upload(app, (archive, "lessons.zip"))
+    assert result["rejected"] == []
+    renamed = existing.replace(".json", "（1）.json")
+    assert [(o["file"], o["status"], o["name"]) for o in result["outcomes"]] == [
+        ("植物的光合作用.json", "saved", "植物的光合作用.json"),
+        ("副本.json", "duplicate", "植物的光合作用.json"),
+        (existing, "duplicate", existing),
+        (existing.replace(".json", "") + " 改.json", "duplicate", existing),
+        (existing, "renamed", renamed),
+    ]
+    assert not os.path.exists(os.path.join(library, "说明.txt"))
+    assert search(app, "光合作用") == ["植物的光合作用.json"]
+    assert search(app, "同名但内容不同") == [renamed]
+
+
+def test_zip_with_bad_json_stores_nothing(app, library):
+    before = sorted(os.listdir(library))
+    archive = make_zip([
+        ("好的课.json", lesson("细胞的结构")),
+        ("坏的课.json", '{"教学课题": "缺了括号"'.encode("utf-8")),
+        ("缺字段.json", json.dumps({"教学流程": []}).encode("utf-8")),
+    ])
+    result = upload(app, (archive, "lessons.zip"))
+    assert result["outcomes"] == []
+    rejected = {r["file"]: r["error"] for r in result["rejected"]}
+    assert set(rejected) == {"坏的课.json", "缺字段.json"}
+    assert rejected["坏的课.json"].startswith("JSON 解析错误")
+    assert rejected["缺字段.json"] == "缺少字符串字段 教学课题"
+    assert sorted(os.listdir(library)) == before  # 有错误时整个压缩包都不入库
+    assert search(app, "细胞的结构") == []
+
+
+def test_not_a_zip_is_rejected(app, library):
+    result = upload(app, (io.BytesIO(b"plain text"), "lessons.zip"))
+    assert result["outcomes"] == []
+    assert [r["archive"] for r in result["rejected"]] == ["lessons.zip"]
+    assert result["rejected"][0]["error"].startswith("不是有效的 zip")
+
+
+def test_loose_files_invalid_names_and_duplicates(app, library):
+    result = upload(app, (io.BytesIO(lesson("遗传与变异")), "遗传.json"),
+                    (io.BytesIO(lesson("遗传与变异")), "遗传 副本.json"),
+                    (io.BytesIO(b"hello"), "readme.txt"))
+    assert [(o["file"], o["status"]) for o in result["outcomes"]] == [
+        ("遗传.json", "saved"), ("遗传 副本.json", "duplicate"), ("readme.txt", "invalid")]
+    assert search(app, "遗传与变异") == ["遗传.json"]
+
+
+def test_conflict_names_continue_after_highest_suffix(app, library):
+    """（n）取 name_suffix 里该基名用过的最大值 + 1：中间空着的号不会再用。"""
+    upload(app, (io.BytesIO(lesson("第一版")), "光合作用.json"))
+    upload(app, (io.BytesIO(lesson("第三版")), "光合作用（3）.json"))
+    result = upload(app, (io.BytesIO(lesson("第四版")), "光合作用.json"),
+                    (io.BytesIO(lesson("第五版")), "光合作用（1）.json"))
+    assert [(o["status"], o["name"]) for o in result["outcomes"]] == [
+        ("renamed", "光合作用（4）.json"), ("saved", "光合作用（1）.json")]
+    result = upload(app, (io.BytesIO(lesson("第六版")), "光合作用.json"))
+    assert result["outcomes"][0]["name"] == "光合作用（5）.json"
+    assert search(app, "第四版") == ["光合作用（4）.json"]
@@ -0,0 +1,63 @@
+# topdf.py — 批量把教案转成 PDF（Linux，需安装 LibreOffice；与网页导出共用转换池和 PDF 缓存）
+# 用法：
+#   python topdf.py jsons/ -o pdf_out/                   # 目录下所有 .json / .docx
+#   python topdf.py "jsons/Unit 1.json" a.docx -o out/ --workers 4 --timeout 60
+import os, sys, time, argparse
+
+def collect(inputs):
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            files += sorted(os.path.join(item, n) for n in os.listdir(item) if n.lower().endswith((".json", ".docx")))
+        elif item.lower().endswith((".json", ".docx")) and os.path.isfile(item):
+            files.append(item)
+        else:
+            print("⚠️ 跳过：", item)
+    return files
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("inputs", nargs="+", help="教案 .json / .docx 文件或目录")
+    ap.add_argument("-o", "--out", required=True, help="PDF 输出目录")
+    ap.add_argument("--workers", type=int, help="同时运行的 LibreOffice 进程数（默认 PDF_WORKERS 或 2）")
+    ap.add_argument("--timeout", type=float, help="单份文档超时秒数（默认 PDF_TIMEOUT 或 120）")
+    args = ap.parse_args()
+    if args.workers:
+        os.environ["PDF_WORKERS"] = str(args.workers)
+    if args.timeout:
+        os.environ["PDF_TIMEOUT"] = str(args.timeout)
+    import app
+
+    if not app.SOFFICE:
+        print("❌ 未找到 LibreOffice（soffice），请安装或用 SOFFICE 环境变量指定路径")
+        sys.exit(1)
+    files = collect(args.inputs)
+    if not files:
+        print("⚠️ 没有可转换的文件")
+        sys.exit(1)
+    os.makedirs(args.out, exist_ok=True)
+
+    def load(path):
+        with open(path, "rb") as f:
+            raw = f.read()
+        if path.lower().endswith(".docx"):
+            return raw
+        return app.render_docx_cached(app.parse_lesson(raw), docx_name_hint=os.path.splitext(os.path.basename(path))[0])
+
+    t0 = time.perf_counter()
+    pool = app.pdf_pool()
+    futures = [(path, pool.submit(lambda p: app.docx_to_pdf(load(p)), path)) for path in files]
+    failed = 0
+    for i, (path, fut) in enumerate(futures, 1):
+        dst = os.path.join(args.out, os.path.splitext(os.path.basename(path))[0] + ".pdf")
+        try:
+            pdf = fut.result()
+        except Exception as e:
+            failed += 1
+            print(f"❌ [{i}/{len(files)}] {path}: {e}")
+            continue
+        with open(dst, "wb") as f:
+            f.write(pdf)
+        print(f"✅ [{i}/{len(files)}] {dst}")
+    print(f"完成：{len(files) - failed} 成功，{failed} 失败，用时 {time.perf_counter() - t0:.1f}s")
+    sys.exit(1 if failed else 0)
@@ -1,5 +1,11 @@
 # wsgi.py — 生产环境入口（给 gunicorn 用）
 # 假设你的 Flask 实例在仓库根目录的 app.py 里，变量名为 app
-from app import app as application
+import os
+
+from app import app as application, warm_up
 # 同时暴露名为 app 的变量，方便用 "wsgi:app" 这种写法
 app = application
+
+# gunicorn --preload 时本模块在 master 里导入：设 WARM_UP=1 预热一次，fork 出的 worker 共享
+if os.environ.get("WARM_UP") == "1":
+    warm_up()